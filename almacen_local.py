@@ -0,0 +1,92 @@
+"""
+almacen_local.py — SQLite local para estado que tiene que sobrevivir reinicios.
+
+Lo usan la cola de trabajos (trabajos.py), el outbox de notificaciones y
+marcas simples clave/valor (leer_valor / guardar_valor).
+Una sola base por proceso, con WAL para que el hilo de Streamlit lea mientras
+los workers escriben.
+
+Ruta configurable con ALMACEN_LOCAL_DB (default: almacen_local.sqlite3 junto a la app).
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv(
+    "ALMACEN_LOCAL_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "almacen_local.sqlite3"),
+)
+
+_lock = threading.Lock()
+_esquemas_creados = set()
+
+
+def ahora():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def conectar(esquema=None):
+    """Abre una conexión nueva (una por operación: sqlite3 no se comparte entre hilos).
+
+    Args:
+        esquema: DDL a asegurar (CREATE TABLE IF NOT EXISTS ...). Se ejecuta
+            una vez por proceso.
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if esquema and esquema not in _esquemas_creados:
+        with _lock:
+            if esquema not in _esquemas_creados:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(esquema)
+                conn.commit()
+                _esquemas_creados.add(esquema)
+    return conn
+
+
+def a_json(obj):
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def de_json(texto, default=None):
+    if not texto:
+        return default
+    try:
+        return json.loads(texto)
+    except ValueError:
+        logger.warning("JSON inválido en almacen_local")
+        return default
+
+
+# ==========================================
+# CLAVE / VALOR
+# ==========================================
+
+_ESQUEMA_KV = """
+CREATE TABLE IF NOT EXISTS kv (
+    clave TEXT PRIMARY KEY,
+    valor TEXT,
+    actualizado TEXT
+);
+"""
+
+
+def leer_valor(clave, default=None):
+    with conectar(_ESQUEMA_KV) as conn:
+        row = conn.execute("SELECT valor FROM kv WHERE clave = ?", (clave,)).fetchone()
+    return de_json(row["valor"], default) if row else default
+
+
+def guardar_valor(clave, valor):
+    with conectar(_ESQUEMA_KV) as conn:
+        conn.execute(
+            "INSERT INTO kv (clave, valor, actualizado) VALUES (?, ?, ?) "
+            "ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor, actualizado = excluded.actualizado",
+            (clave, a_json(valor), ahora()),
+        )
@@ -9,6 +9,12 @@ from dotenv import load_dotenv
 # Import our data module
 import data
 import notificaciones
+import preproceso_comprobante
+import ocr_comprobantes
+import ocr_backends
+import guardado
+import trabajos
+from captura import captura_comprimida
 
 # Jurisdictions for perception selectboxes
 JURISDICCIONES_ARG = [
@@ -25,6 +31,9 @@ CONCEPTOS_SIN_CARPETA = {
     "VIAJES Y GASTOS DE REPRESENTACION",
 }
 
+# Rendiciones por página en la revisión de excesos (panel admin)
+REVISION_POR_PAGINA = 10
+
 # Load environment variables
 load_dotenv()
 
@@ -65,6 +74,32 @@ if "post_save_prompt" not in st.session_state:
     st.session_state.post_save_prompt = False
 
 
+# Workers en segundo plano: guardados (reanuda los que quedaron a medio hacer) y outbox de mails
+trabajos.iniciar()
+notificaciones.iniciar_envio()
+
+_ICONOS_TRABAJO = {trabajos.PENDIENTE: "⏳", trabajos.EN_CURSO: "🔄", trabajos.OK: "✅", trabajos.ERROR: "❌"}
+
+
+def _mostrar_estado_trabajo(comprobante, key_prefix):
+    """Estado del guardado en segundo plano de un comprobante, con reintento si falló."""
+    trabajo_id = comprobante.get("trabajo_id")
+    if not trabajo_id:
+        return
+    estado, detalle = guardado.estado_guardado(trabajo_id)
+    linea = f"{_ICONOS_TRABAJO.get(estado, '•')} Guardado `{trabajo_id}`: **{estado}**"
+    if detalle:
+        linea += f" — {detalle}"
+    if estado == trabajos.OK and detalle:
+        st.warning(linea)  # guardado, pero sin link de Drive o sin notificación
+    else:
+        st.caption(linea)
+    if estado == trabajos.ERROR:
+        if st.button("🔁 Reintentar guardado", key=f"{key_prefix}_retry_{trabajo_id}"):
+            trabajos.reintentar(trabajo_id)
+            st.rerun()
+
+
 def _generar_rendicion_id():
     """Genera un ID corto y legible: R-YYYYMMDD-XXXX (4 hex chars)."""
     import secrets
@@ -117,6 +152,9 @@ if st.session_state.get("needs_full_reset"):
     st.session_state.needs_full_reset = False
 
 def configure_genai():
+    # Backend local de replay (OCR_BACKEND=replay): no necesita API key
+    if ocr_backends.get_backend().nombre != "gemini":
+        return True
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
         try:
@@ -134,151 +172,31 @@ def configure_genai():
             return False
     return False
 
+@st.cache_data(max_entries=16, show_spinner=False)
+def normalizar_comprobante_cacheado(file_bytes, mime_type):
+    """Normaliza una vez por archivo: los reruns de Streamlit no reprocesan la imagen."""
+    return preproceso_comprobante.normalizar_comprobante(file_bytes, mime_type)
+
 def scan_receipt(image_bytes, mime_type="image/jpeg"):
-    import re
+    """Escanea un comprobante. Devuelve dict (formato del schema) o str de error."""
     try:
-        # Based on check, 2.0-flash is available and supports generateContent
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        prompt = """
-        # ROL
-        Actúas como un **Auditor Contable Senior experto en normativa AFIP (Argentina)**. Tu objetivo es extraer datos estructurados de comprobantes de gastos para un sistema de rendición automatizado. Tu prioridad es la precisión matemática y la correcta categorización impositiva según el TIPO de comprobante.
-
-        # REGLAS DE NEGOCIO (ESTRICTAS)
-
-        ## 1. DETECCIÓN DE CUITs
-        - Las facturas Tipo A y C tienen dos CUITs (Emisor y Receptor).
-        - El **CUIT del PROVEEDOR (Emisor)** siempre está en el ENCABEZADO (parte superior). Es el PRIMERO que aparece. → campo `cuit_proveedor`.
-        - El **CUIT del Cliente (Receptor)** está más abajo en el comprobante. → campo `cuit_cliente`.
-        - Factura B: suele tener solo el CUIT del emisor. `cuit_cliente` = null.
-        - Factura C: aplica la misma regla que la A.
-
-        ## 2. DATOS BÁSICOS DEL COMPROBANTE
-        - **TIPO:** Identifica la LETRA (A, B, C, M) o "TICKET".
-        - **CÓDIGO AFIP:** Busca "COD. XX" (ej: 001, 006, 011). Normalízalo a 3 dígitos.
-        - **PUNTO DE VENTA (SUCURSAL):** 4 o 5 dígitos. Si ves `XXXXX-YYYYYYYY`, el `XXXXX` es la sucursal.
-        - **Opesa/Combustibles:** NO confundas "Nro. Estación" con el PV.
-
-        ## 3. LÓGICA PARA FACTURA TIPO "A" (Discriminación Obligatoria)
-        Debes desglosar cada centavo del ticket en los campos individuales.
-        - **neto_gravado:** base imponible.
-        - **no_gravado:** montos exentos, impuestos internos (combustibles líquidos, fondo hídrico), cargos que NO son IVA ni percepciones.
-        - **exento:** bienes/servicios exentos de IVA si se discriminan.
-        - **IVA:** separar por alícuota (21%, 10.5%, 27%).
-        - **IMPORTANTE:** NO mezclar Percepción Municipal con No Gravado. La Percepción Municipal va en `perc_municipal`.
-
-        ## 4. CLASIFICACIÓN DE LÍNEAS DE PERCEPCIONES (CRÍTICO)
-        Identificá cada línea individualmente. **NO sumes líneas distintas.**
-
-        - Líneas que contengan "PERC IVA" o "PER IVA" o "RG 2408" o "R.G. 2408" → `perc_iva` (un solo valor numérico).
-        - Líneas que contengan "PER IB" o "PERC IIBB" o "Per IIBB" o "ING BRUTOS" → entrada en `perc_iibb_lista`. Cada línea es UNA entrada distinta con su jurisdicción.
-          Para la jurisdicción, usá esta tabla de códigos:
-            CBAD, CBA, CORDOBA → "CORDOBA"
-            CABA, CAPFED, CFED → "CABA"
-            BSAS, BSA, BUENOSAIRES → "BUENOS AIRES"
-            MZA, MENDOZA → "MENDOZA"
-            SFE, SANTAFE → "SANTA FE"
-            NQN, NEUQUEN → "NEUQUEN"
-          Si el código no coincide con ninguno conocido, usá el texto literal en mayúsculas.
-        - Líneas que contengan "Per Mun" o "PERC MUN" o "MUNICIPAL" → `perc_municipal` (objeto único, NO array). Si hay más de una, sumalas en el monto pero registrá la jurisdicción de la primera.
-        - Líneas que contengan "PERC GCIAS" o "PER GAN" o "RG 830" → `perc_ganancias`.
-        - Si el ticket muestra "TOTAL DESCUENTOS" o líneas con valor negativo, ignorarlas.
-        - Si una línea tiene formato "PERC X.XX% [BASE] MONTO", el MONTO es el último número de la línea.
-
-        ## 5. LÓGICA PARA FACTURA TIPO "B" o "C" (Agrupación Total)
-        - **NUNCA DISCRIMINES IMPUESTOS EN B O C.**
-        - Todo el valor del ticket (100%) va al campo `no_gravado`. Todos los demás campos impositivos en 0.
-
-        ## 6. VALIDACIÓN INTERNA ANTES DE DEVOLVER
-        Calculá:
-        `suma = neto_gravado + no_gravado + exento + iva_21 + iva_10_5 + iva_27 + perc_iva + perc_ganancias + sum(perc_iibb_lista[].monto) + (perc_municipal.monto if perc_municipal else 0)`
-        Si `abs(suma - monto_total) > 1`, revisá tu extracción. Si la diferencia persiste, devolvé el JSON con `"warning_total_no_cuadra": true`.
-
-        # FORMATO DE SALIDA (JSON)
-        Devuelve ÚNICAMENTE un objeto JSON con esta estructura exacta:
-
-        {
-          "tipo_factura": "String (A, B, C, M, TICKET)",
-          "codigo_afip": "String (001, 006, etc) o null",
-          "fecha": "DD/MM/AAAA",
-          "proveedor": "String (Nombre o Razón Social)",
-          "cuit_proveedor": "String (11 dígitos sin guiones)",
-          "cuit_cliente": "String (11 dígitos sin guiones) o null",
-          "sucursal": "String (5 dígitos)",
-          "numero_comprobante": "String (8 dígitos)",
-          "neto_gravado": Number,
-          "no_gravado": Number,
-          "exento": Number,
-          "iva_21": Number,
-          "iva_10_5": Number,
-          "iva_27": Number,
-          "perc_iva": Number,
-          "perc_ganancias": Number,
-          "perc_iibb_lista": [
-            {"jurisdiccion": "String", "monto": Number}
-          ],
-          "perc_municipal": {"jurisdiccion": "String", "monto": Number} o null,
-          "monto_total": Number,
-          "warning_total_no_cuadra": Boolean (true si la suma no cuadra)
-        }
-
-        ## REGLAS DE SEGURIDAD (LEGIBILIDAD)
-        - **SI EL TICKET ES ILEGIBLE, ESTÁ BORROSO O CORTADO:** No intentes adivinar datos.
-        - Devuelve `null` en los campos que no puedas leer con certeza absoluta (especialmente CUITs y Montos).
-        - El sistema detectará los `null` y pedirá carga manual al usuario.
-        - Prioriza siempre la precisión sobre la inferencia.
-        """
-        
-        image_parts = [{"mime_type": mime_type, "data": image_bytes}]
-        # MULTI-MODEL FALLBACK ENGINE (robust failover across free Gemini models)
-        models_to_try = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.0-flash-lite"]
-        response = None
-        last_error = ""
-
-        # Phase 1: Try all models instantly
-        for m_name in models_to_try:
-            try:
-                alt_model = genai.GenerativeModel(m_name)
-                response = alt_model.generate_content([prompt, image_parts[0]])
-                if response and response.text:
-                    break
-            except Exception as ex:
-                last_error = str(ex)
-                continue
-
-        # Phase 2: If no response, retry with gemini-2.5-flash after brief pause
-        if not response or not getattr(response, "text", None):
-            import time
-            time.sleep(2)
-            try:
-                alt_model = genai.GenerativeModel("gemini-2.5-flash")
-                response = alt_model.generate_content([prompt, image_parts[0]])
-            except Exception as ex:
-                last_error = str(ex)
-        if not response or not getattr(response, "text", None):
-            if response and hasattr(response, "candidates") and response.candidates and response.candidates[0].finish_reason:
-                return f"Error: La IA bloqueó la respuesta (Razón: {response.candidates[0].finish_reason})"
-            return f"Error al consultar la IA: {last_error if last_error else 'No se pudo extraer texto del comprobante'}"
-        text = response.text
-        
-        # Robust JSON extraction using Regex (Simple block finder compatible with Python 're')
-        json_match = re.search(r'(\{.*\})', text, re.DOTALL)
-        if json_match:
-            try:
-                json_text = json_match.group(1)
-                return json.loads(json_text)
-            except:
-                pass
-        
-        # Fallback to manual stripping if regex fails or JSON is malformed
-        text = text.replace("```json", "").replace("```", "").strip()
-        if not text:
-             return "Error: No se encontró JSON en la respuesta de la IA."
-             
-        return json.loads(text)
+        return ocr_comprobantes.escanear_comprobante(image_bytes, mime_type)
     except Exception as e:
         return f"Error details: {str(e)}"
 
+def scan_receipts_batch(archivos):
+    """Escanea varios comprobantes en lote. Devuelve un resultado por archivo."""
+    try:
+        return ocr_comprobantes.escanear_lote(archivos)
+    except Exception as e:
+        return [f"Error details: {str(e)}"] * len(archivos)
+
+def aplicar_resultado_escaneo(scan_result):
+    """Carga el resultado de un escaneo en los campos del formulario."""
+    st.session_state.scanned_data = scan_result
+    for key, value in ocr_comprobantes.campos_formulario(scan_result).items():
+        st.session_state[key] = value
+
 # ==========================================
 # MAIN LAYOUT - SINGLE COLUMN LINEAR FLOW
 # ==========================================
@@ -293,7 +211,7 @@ if st.session_state.get("post_save_prompt"):
     last = st.session_state.comprobantes_guardados[-1] if n_guardados else None
     with st.container(border=True):
         st.success(
-            f"✅ Comprobante guardado a la rendición "
+            f"✅ Comprobante registrado en la rendición "
             f"**{st.session_state.rendicion_id}** "
             f"({n_guardados} comprobante{'s' if n_guardados != 1 else ''} en total)"
         )
@@ -303,6 +221,8 @@ if st.session_state.get("post_save_prompt"):
                 f"**Último:** {last['concepto']} — ${last['monto']:,.2f} "
                 f"({last['numero']}){estado_badge}"
             )
+            _mostrar_estado_trabajo(last, "post_save")
+            st.caption("El guardado sigue en segundo plano: podés cargar el próximo comprobante.")
         st.markdown("¿Agregar otro comprobante a esta rendición o finalizar?")
         col_add, col_fin = st.columns(2)
         if col_add.button("➕ Agregar otro comprobante", type="primary", use_container_width=True, key="btn_add_more"):
@@ -340,6 +260,9 @@ if rendicion_en_curso:
                     f"{idx}. **{c['concepto']}** - ${c['monto']:,.2f} "
                     f"({c['numero']}){estado_badge}"
                 )
+                _mostrar_estado_trabajo(c, f"banner_{idx}")
+            if st.button("🔄 Actualizar estado", key="banner_refresh_trabajos"):
+                st.rerun()
 
 # --- CARD 1: DATOS DE LA RENDICIÓN (compartidos por todos los comprobantes) ---
 with st.container(border=True):
@@ -446,11 +369,24 @@ with st.container(border=True):
     st.caption("💡 **Múltiples comprobantes:** Podés seleccionar varios archivos (PDFs/fotos) juntos. El sistema te permitirá procesar e imputar cada uno bajo la misma rendición.")
     st.subheader("📷 Comprobante (Opcional)")
     
-    tab_cam, tab_upload = st.tabs(["📷 Cámara", "📁 Subir archivos"])
+    tab_movil, tab_cam, tab_upload = st.tabs(["📱 Foto (datos móviles)", "📷 Cámara", "📁 Subir archivos"])
     
     final_image_bytes = None
     final_mime_type = "image/jpeg" # Default
     
+    with tab_movil:
+        # Comprime en el navegador antes de subir: recomendado desde el celular
+        movil_bytes, movil_mime, movil_info = captura_comprimida(
+            key=f"captura_movil_{st.session_state.uploader_key}"
+        )
+        if movil_bytes:
+            final_image_bytes = movil_bytes
+            final_mime_type = movil_mime
+            st.caption(
+                f"📶 Subido {movil_info['bytes_finales'] / 1024:,.0f} KB "
+                f"(original {movil_info['bytes_originales'] / 1024:,.0f} KB)"
+            )
+
     with tab_cam:
         cam_input = st.camera_input("Tomar foto")
         if cam_input: 
@@ -480,30 +416,71 @@ with st.container(border=True):
                 )
                 st.session_state.multi_file_idx = sel_file_idx
                 active_file = files_input[sel_file_idx]
+
+                # Escaneo en lote: un solo request para todos los comprobantes
+                lote_key = tuple((f.name, f.size) for f in files_input)
+                if st.session_state.get("scan_lote_key") != lote_key:
+                    st.session_state.scan_lote_key = lote_key
+                    st.session_state.scan_lote = {}
+                    st.session_state.scan_lote_aplicado = None
+                pendientes_lote = [i for i in range(len(files_input)) if i not in st.session_state.scan_lote]
+                if pendientes_lote and st.button(
+                    f"✨ Escanear todos ({len(pendientes_lote)})", use_container_width=True
+                ):
+                    if configure_genai() or all("pdf" in str(files_input[i].type).lower() for i in pendientes_lote):
+                        with st.spinner(f"🔍 Escaneando {len(pendientes_lote)} comprobantes..."):
+                            archivos = [
+                                normalizar_comprobante_cacheado(files_input[i].getvalue(), files_input[i].type)[:2]
+                                for i in pendientes_lote
+                            ]
+                            for i, res in zip(pendientes_lote, scan_receipts_batch(archivos)):
+                                st.session_state.scan_lote[i] = res
+                    else:
+                        st.error("Error de configuración API Key")
+
+                if st.session_state.scan_lote:
+                    n_ok = sum(1 for r in st.session_state.scan_lote.values() if isinstance(r, dict))
+                    st.caption(f"✨ {n_ok} de {len(files_input)} comprobantes escaneados en lote")
+                # Al pasar a un comprobante ya escaneado, precargar sus datos una sola vez
+                lote_res = st.session_state.scan_lote.get(sel_file_idx)
+                if isinstance(lote_res, dict) and st.session_state.scan_lote_aplicado != sel_file_idx:
+                    st.session_state.scan_lote_aplicado = sel_file_idx
+                    aplicar_resultado_escaneo(lote_res)
+                elif isinstance(lote_res, str):
+                    st.warning(f"No se pudo escanear este comprobante en lote: {lote_res}")
                 
             final_image_bytes = active_file.getvalue()
             final_mime_type = active_file.type
 
+    # Normalización (EXIF, recorte, resolución OCR, páginas útiles del PDF).
+    # Las imágenes se escanean y se suben normalizadas; el PDF recortado va
+    # solo al OCR y a Drive se sube el original completo (no perder páginas).
+    archivo_drive_bytes, archivo_drive_mime = final_image_bytes, final_mime_type
+    if final_image_bytes:
+        final_image_bytes, final_mime_type, prep_info = normalizar_comprobante_cacheado(
+            final_image_bytes, final_mime_type
+        )
+        if "pdf" not in str(archivo_drive_mime).lower():
+            archivo_drive_bytes, archivo_drive_mime = final_image_bytes, final_mime_type
+        if prep_info["bytes_ahorrados"] > 0:
+            pct_ahorro = prep_info["bytes_ahorrados"] / prep_info["bytes_originales"] * 100
+            st.caption(
+                f"🗜️ Comprobante optimizado: {prep_info['bytes_originales'] / 1024:,.0f} KB → "
+                f"{prep_info['bytes_finales'] / 1024:,.0f} KB (-{pct_ahorro:.0f}%)"
+            )
+
     # SCAN BUTTON (Visible whenever there is a file from Camera OR Uploader)
     if final_image_bytes:
         if st.button("✨ Escanear con IA", type="primary", use_container_width=True):
-            if configure_genai():
+            # PDFs digitales se pueden parsear localmente aun sin API Key
+            if configure_genai() or "pdf" in str(final_mime_type).lower():
                 with st.status("🔍 Procesando comprobante...", expanded=True) as status:
                     st.write(f"Conectando con IA ({final_mime_type})...")
                     scan_result = scan_receipt(final_image_bytes, final_mime_type)
                     
                     if isinstance(scan_result, dict):
                         st.write("Analizando datos extraídos...")
-                        st.session_state.scanned_data = scan_result
-                        st.session_state.scan_suc_input = str(scan_result.get("sucursal") or "").replace("-","")
-                        st.session_state.scan_num_input = str(scan_result.get("numero_comprobante") or "").replace("-","")
-                        st.session_state.scan_tipo_input = str(scan_result.get("tipo_factura") or "C").upper().strip()
-                        if st.session_state.scan_tipo_input not in ["A", "B", "C", "M", "Ticket"]:
-                            st.session_state.scan_tipo_input = "C"
-                        
-                        st.session_state.scan_cuit_input = str(scan_result.get("cuit_proveedor") or scan_result.get("cuit") or "")
-                        st.session_state.scan_cuit_cliente_input = str(scan_result.get("cuit_cliente") or "")
-                        st.session_state.scan_provider_input = str(scan_result.get("proveedor") or "")
+                        aplicar_resultado_escaneo(scan_result)
                         
                         status.update(label="✅ Escaneo completado!", state="complete", expanded=False)
                     else:
@@ -539,35 +516,11 @@ if final_image_bytes or modo_manual:
         default_num = str(data_ia.get("numero_comprobante") or "").replace("-","")
         default_afip = str(data_ia.get("codigo_afip") or "")
 
-        # New Auditor Fields - parse from flat JSON (new format) or nested desglose (legacy)
-        monto_ticket_total = float(data_ia.get("monto_total") or data_ia.get("monto_total_columna_Z") or 0.0)
-        monto_neto = float(data_ia.get("neto_gravado") or 0.0)
-        # Build desglose from flat fields (new Gemini format)
-        if "neto_gravado" in data_ia and "desglose" not in data_ia:
-            # New format - build compatible desglose for backward compat
-            iibb_lista = data_ia.get("perc_iibb_lista") or []
-            perc_muni = data_ia.get("perc_municipal") or {}
-            desglose = {
-                "neto_gravado_aux": monto_neto,
-                "columna_R_no_gravado": float(data_ia.get("no_gravado") or 0),
-                "columna_S_iva_21": float(data_ia.get("iva_21") or 0),
-                "columna_T_iva_105": float(data_ia.get("iva_10_5") or 0),
-                "columna_U_iva_27": float(data_ia.get("iva_27") or 0),
-                "columna_V_perc_iva": float(data_ia.get("perc_iva") or 0),
-                "columna_W_perc_ganancias": float(data_ia.get("perc_ganancias") or 0),
-                "columna_X_perc_iibb": float(iibb_lista[0]["monto"]) if iibb_lista else 0,
-                "columna_Y_jurisdiccion_code": iibb_lista[0].get("jurisdiccion", "") if iibb_lista else "",
-                "monto_total_columna_Z": monto_ticket_total,
-            }
-            # Store extended perception data in session for the form
-            st.session_state.perc_iibb_lista = iibb_lista
-            st.session_state.perc_municipal = perc_muni
-        else:
-            # Legacy format
-            desglose = data_ia.get("desglose", {})
-            monto_neto = float(desglose.get("neto_gravado_aux") or 0.0)
-            st.session_state.perc_iibb_lista = []
-            st.session_state.perc_municipal = {}
+        # New Auditor Fields - flat JSON (new format) or nested desglose (legacy)
+        desglose, iibb_lista, perc_muni, monto_neto, monto_ticket_total = ocr_comprobantes.desglose_formulario(data_ia)
+        # Store extended perception data in session for the form
+        st.session_state.perc_iibb_lista = iibb_lista
+        st.session_state.perc_municipal = perc_muni
         st.session_state.desglose_data = desglose
         # Validation Check
         if data_ia.get("warning_total_no_cuadra"):
@@ -961,36 +914,19 @@ if st.button("💾 Guardar comprobante", type="primary", use_container_width=Tru
             "monto_total_columna_Z": monto_ticket_total,
         }
 
-        # 1. Upload to Drive (ONCE)
-        ticket_link = ""
-        uploaded_once = False
-        if final_image_bytes:
-            with st.spinner("Subiendo Ticket a Drive..."):
-                ext = "pdf" if "pdf" in final_mime_type else "jpg"
-                fname = f"TICKET_{cuit_input}_{num_comp_input}.{ext}"
-                link, file_id, error_msg = data.upload_receipt_to_drive(final_image_bytes, fname, final_mime_type)
-                if link:
-                    ticket_link = link
-                    uploaded_once = True
-                    st.toast("✅ Archivo subido a Drive")
-                else:
-                    st.error(f"Error subiendo archivo a Drive: {error_msg}")
-
         # Original amounts (before proration) for CONTROL_SALDOS
         monto_ticket_total_original = monto_ticket_total
         monto_neto_original = monto_gravado_total_base
         no_gravado_original = desglose_base.get("columna_R_no_gravado", 0.0)
 
-        # 2. PRORATION LOGIC & SAVE LOOP
+        # 1. PRORATION LOGIC (payload por carpeta)
         folders = [f.strip() for f in folder_number.split(",") if f.strip()]
         if not folders:
             folders = ["REPRESENTACION"]  # Default for gastos de representacion
         import math
         N = len(folders)
         
-        success_count = 0
-        
-        progress_bar = st.progress(0)
+        payloads = []
         
         for idx, folder_code in enumerate(folders):
              # Calculate Prorated Amounts
@@ -1054,53 +990,26 @@ if st.button("💾 Guardar comprobante", type="primary", use_container_width=Tru
                 "rendicion_id": rendicion_id,
             }
              
-             # Determine estado override for excess
-             estado_ov = "PENDIENTE REVISIÓN" if excede_sugerido else None
-
-             # Log to GSheets
-             try:
-                 if data.log_rendicion_to_sheet(payload, ticket_link, estado_override=estado_ov):
-                     success_count += 1
-                     try:
-                         data.actualizar_control_saldos(payload)
-                     except Exception as e:
-                         st.toast(f"⚠️ Error actualizando saldos: {e}")
-             except Exception as e:
-                 st.error(f"Error guardando carpeta {folder_code}: {e}")
-
-             progress_bar.progress((idx + 1) / N)
-
-        if success_count == N:
-            # Send email notification if excess (idempotent via session flag)
-            # Key includes rendicion_id + comprobante number so two comprobantes
-            # con mismo concepto/monto en la misma rendición no se pisen.
-            mail_key = f"_mail_sent_{rendicion_id}_{cuit_input}_{num_comp_input}"
-            if excede_sugerido and mail_key not in st.session_state:
-                st.session_state[mail_key] = True
-                try:
-                    gsheets_client, _ = data.get_gsheets_client()
-                    sheet_id = os.getenv("GSHEET_ID", "")
-                    try:
-                        if "GSHEET_ID" in st.secrets:
-                            sheet_id = st.secrets["GSHEET_ID"]
-                    except Exception:
-                        pass
-                    if gsheets_client and sheet_id:
-                        # Use last payload (representative for the mail)
-                        mail_ok, mail_msg = notificaciones.enviar_alerta_exceso(
-                            payload, ticket_link, gsheets_client, sheet_id
-                        )
-                        if not mail_ok:
-                            st.warning(
-                                "El comprobante se guardó. No se pudo enviar la notificación "
-                                f"automática, contactá a administración. ({mail_msg})"
-                            )
-                except Exception as e:
-                    st.warning(
-                        "El comprobante se guardó. No se pudo enviar la notificación "
-                        f"automática, contactá a administración. ({e})"
-                    )
+             payloads.append(payload)
+
+        # 2. Encolar el guardado (Drive + log + saldos + alerta) en segundo plano.
+        # El operador recibe el ID del trabajo y sigue con el próximo comprobante.
+        estado_ov = "PENDIENTE REVISIÓN" if excede_sugerido else None
+        archivo_guardado, nombre_archivo = None, ""
+        if archivo_drive_bytes:
+            ext = "pdf" if "pdf" in archivo_drive_mime else "jpg"
+            archivo_guardado = archivo_drive_bytes
+            nombre_archivo = f"TICKET_{cuit_input}_{num_comp_input}.{ext}"
+        try:
+            trabajo_id = guardado.encolar_guardado(
+                payloads, archivo_guardado, nombre_archivo, archivo_drive_mime,
+                estado_override=estado_ov, excede_sugerido=excede_sugerido,
+            )
+        except Exception as e:
+            trabajo_id = None
+            st.error(f"No se pudo registrar el guardado: {e}")
 
+        if trabajo_id:
             # Add summary to "rendición en curso" list so the banner refleja
             # cuántos comprobantes ya cargó el usuario.
             suc_pad = pto_vta_input.zfill(5) if pto_vta_input and pto_vta_input.isdigit() else pto_vta_input
@@ -1112,6 +1021,7 @@ if st.button("💾 Guardar comprobante", type="primary", use_container_width=Tru
                 "monto": float(monto_imputar or 0),
                 "numero": numero_str,
                 "estado": estado_resumen,
+                "trabajo_id": trabajo_id,
             })
 
             # Show post-save prompt on next rerun: "¿Agregar otro comprobante o finalizar?"
@@ -1121,9 +1031,6 @@ if st.button("💾 Guardar comprobante", type="primary", use_container_width=Tru
             st.session_state.needs_partial_reset = True
             st.rerun()
 
-        else:
-            st.warning(f"⚠️ Se guardaron {success_count} de {N} carpetas. Revise la consola.")
-
 
 # ==========================================
 # ADMINISTRACIÓN — EXPORTACIÓN DUX
@@ -1153,11 +1060,19 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
             st.error("Configurar FECHA_INICIO_EXPORT_DUX en CONFIG_EMPRESA antes del primer export.")
             fecha_inicio_dux = ""  # Will block export via validation
 
+        dux_solo_nuevas = st.checkbox(
+            "Solo nuevas desde el último lote", key="dux_solo_nuevas",
+            help="Exporta lo que no salió en ningún lote anterior (filas nuevas del log, "
+                 "estén donde estén, y las que antes no tenían estado exportable). "
+                 "Ignora el rango de fechas.",
+        )
         col_f1, col_f2 = st.columns(2)
         with col_f1:
-            dux_fecha_desde = st.date_input("Fecha desde", value=first_day, key="dux_fecha_desde")
+            dux_fecha_desde = st.date_input("Fecha desde", value=first_day, key="dux_fecha_desde",
+                                            disabled=dux_solo_nuevas)
         with col_f2:
-            dux_fecha_hasta = st.date_input("Fecha hasta", value=last_day, key="dux_fecha_hasta")
+            dux_fecha_hasta = st.date_input("Fecha hasta", value=last_day, key="dux_fecha_hasta",
+                                            disabled=dux_solo_nuevas)
 
         # Export mode toggle
         dux_modo = st.radio(
@@ -1176,12 +1091,22 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
                 "faltantes. Si DUX rechaza re-imports, NO uses este modo."
             )
 
+        # Filtros con los que se validó: si cambian, hay que volver a validar
+        dux_params = (dux_fecha_desde, dux_fecha_hasta, modo_parcial, dux_solo_nuevas)
+
         # Validation step
-        if st.button("Validar antes de exportar", use_container_width=True, key="btn_validar_dux"):
-            # Clear lookup caches so admin sees fresh data after edits
-            data._leer_maestro_conceptos_dux.clear()
-            data._leer_codigos_empleado_dux.clear()
-            data._leer_config_empresa.clear()
+        col_val, col_maestros = st.columns([3, 1])
+        with col_maestros:
+            if st.button("🔄 Releer maestros", use_container_width=True, key="btn_releer_maestros_dux",
+                         help="Relee MAESTRO_CONCEPTOS_DUX, USUARIOS y CONFIG_EMPRESA (si no, se cachean 5 min)"):
+                data._leer_maestro_conceptos_dux.clear()
+                data._leer_codigos_empleado_dux.clear()
+                data._leer_config_empresa.clear()
+                st.session_state["dux_validation_passed"] = False
+        with col_val:
+            validar_dux = st.button("Validar antes de exportar", use_container_width=True, key="btn_validar_dux")
+        if validar_dux:
+            st.session_state.pop("dux_snapshot", None)
             with st.spinner("Validando rendiciones..."):
                 from dux_export import validar_rendiciones_para_export
                 # Get renditions using the same filter logic as export
@@ -1190,13 +1115,16 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
                     fecha_hasta=dux_fecha_hasta,
                     modo_parcial=modo_parcial,
                     fecha_inicio_dux=fecha_inicio_dux,
+                    solo_nuevas=dux_solo_nuevas,
                 )
                 if validation_result is None:
                     st.error("No se pudo leer RENDICIONES_LOG")
                 elif isinstance(validation_result, str):
                     st.warning(validation_result)
                 elif isinstance(validation_result, tuple):
-                    errores, warn_list = validation_result
+                    errores, warn_list, snapshot = validation_result
+                    st.session_state["dux_snapshot"] = snapshot
+                    st.session_state["dux_validacion_params"] = dux_params
                     if errores:
                         st.session_state["dux_validation_passed"] = False
                         st.error(f"Export DUX abortado: {len(errores)} errores bloqueantes")
@@ -1224,33 +1152,118 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
                         st.success("Validación OK — sin errores. Podés exportar.")
                         st.session_state["dux_validation_passed"] = True
 
-        # Export button — only enabled after validation passes
-        export_enabled = st.session_state.get("dux_validation_passed", False)
-        if st.button("Exportar a EXPORT_DUX", type="primary", use_container_width=True,
-                     disabled=not export_enabled, key="btn_exportar_dux"):
-            with st.spinner("Generando exportación Dux..."):
-                success, msg, count = data.escribir_export_dux_en_sheet(
-                    fecha_desde=dux_fecha_desde,
-                    fecha_hasta=dux_fecha_hasta,
-                    modo_parcial=modo_parcial,
-                    fecha_inicio_dux=fecha_inicio_dux,
-                )
+        # Export — only enabled after validation passes
+        export_enabled = (st.session_state.get("dux_validation_passed", False)
+                          and st.session_state.get("dux_validacion_params") == dux_params)
+        if st.session_state.get("dux_validation_passed") and not export_enabled:
+            st.info("Cambiaron los filtros desde la última validación: volvé a validar.")
+        dux_destino = st.radio(
+            "Destino del export",
+            ["Descargar Excel (.xlsx)", "Descargar CSV", "Escribir en hoja EXPORT_DUX"],
+            key="dux_export_destino",
+            horizontal=True,
+            help="La descarga genera el archivo en memoria sin tocar la planilla.",
+        )
+
+        if dux_destino == "Escribir en hoja EXPORT_DUX":
+            if st.button("Exportar a EXPORT_DUX", type="primary", use_container_width=True,
+                         disabled=not export_enabled, key="btn_exportar_dux"):
+                barra_export = st.progress(0.0, text="Generando exportación Dux...")
+                with st.spinner("Generando exportación Dux..."):
+                    success, msg, count = data.escribir_export_dux_en_sheet(
+                        fecha_desde=dux_fecha_desde,
+                        fecha_hasta=dux_fecha_hasta,
+                        modo_parcial=modo_parcial,
+                        fecha_inicio_dux=fecha_inicio_dux,
+                        solo_nuevas=dux_solo_nuevas,
+                        progreso=lambda hechas, total: barra_export.progress(
+                            hechas / total, text=f"Escribiendo EXPORT_DUX: {hechas}/{total} filas"),
+                        snapshot=st.session_state.get("dux_snapshot"),
+                    )
+                barra_export.empty()
                 if success:
                     st.success(f"✅ {msg}")
                     st.session_state["dux_validation_passed"] = False
                 else:
                     st.error(f"❌ Error en exportación Dux")
                     st.code(msg)
+        else:
+            formato = "csv" if "CSV" in dux_destino else "xlsx"
+            if st.button("Generar archivo", type="primary", use_container_width=True,
+                         disabled=not export_enabled, key="btn_generar_archivo_dux"):
+                with st.spinner("Generando archivo Dux..."):
+                    success, msg, contenido, nombre = data.generar_archivo_export_dux(
+                        formato=formato,
+                        fecha_desde=dux_fecha_desde,
+                        fecha_hasta=dux_fecha_hasta,
+                        modo_parcial=modo_parcial,
+                        fecha_inicio_dux=fecha_inicio_dux,
+                        solo_nuevas=dux_solo_nuevas,
+                        snapshot=st.session_state.get("dux_snapshot"),
+                    )
+                if success:
+                    st.session_state["dux_archivo"] = (contenido, nombre, formato)
+                    st.session_state["dux_validation_passed"] = False
+                    st.success(f"✅ {msg}")
+                else:
+                    st.session_state.pop("dux_archivo", None)
+                    st.error(f"❌ Error en exportación Dux")
+                    st.code(msg)
+
+            archivo_dux = st.session_state.get("dux_archivo")
+            if archivo_dux and archivo_dux[2] == formato:
+                contenido, nombre, _ = archivo_dux
+                st.download_button(
+                    f"⬇️ Descargar {nombre}", data=contenido, file_name=nombre,
+                    mime=data.FORMATOS_EXPORT_DUX[formato][1], use_container_width=True,
+                    key="btn_descargar_dux",
+                )
 
         st.markdown("---")
+        recalculo_completo = st.checkbox(
+            "Recálculo completo", value=False, key="chk_recalculo_completo",
+            help="Revisa todas las facturas y elimina filas huérfanas. Sin tildar, solo las facturas con movimientos desde el último recálculo.",
+        )
         if st.button("🔄 Recalcular Saldos", use_container_width=True):
             with st.spinner("Recalculando saldos..."):
-                success, msg, count = data.recalcular_control_saldos()
+                success, msg, count = data.recalcular_control_saldos(completo=recalculo_completo)
                 if success:
                     st.success(f"✅ {msg}")
                 else:
                     st.error(f"❌ {msg}")
 
+        st.markdown("---")
+        st.subheader("📧 Notificaciones")
+        resumen_mails = notificaciones.resumen_outbox()
+        st.caption(
+            f"Outbox: {resumen_mails.get('PENDIENTE', 0)} pendiente(s), "
+            f"{resumen_mails.get('ENVIADO', 0)} enviada(s), {resumen_mails.get('ERROR', 0)} con error. "
+            f"Las alertas de una misma rendición se agrupan en un solo mail."
+        )
+        if resumen_mails.get("PENDIENTE") and st.button("📨 Enviar alertas pendientes ahora", key="btn_outbox_flush"):
+            with st.spinner("Enviando alertas..."):
+                n_mails = notificaciones.procesar_outbox(forzar=True)
+            st.success(f"✅ {n_mails} mail(s) enviados")
+
+        st.markdown("---")
+        st.subheader("🧾 Guardados con error")
+        fallidos = guardado.guardados_con_error()
+        if not fallidos:
+            st.caption("No hay guardados en error.")
+        for trabajo in fallidos:
+            col_tr1, col_tr2 = st.columns([4, 1])
+            with col_tr1:
+                st.caption(
+                    f"❌ `{trabajo['id']}` ({trabajo['creado'][:16]}) — {trabajo['usuario']} — "
+                    f"CUIT {trabajo['proveedor_cuit']} comp. {trabajo['comprobante']} — "
+                    f"carpetas {', '.join(trabajo['carpetas'])} — {trabajo['pasos']} paso(s) hechos — "
+                    f"{trabajo['error']}"
+                )
+            with col_tr2:
+                if st.button("🔁 Reintentar", key=f"admin_retry_{trabajo['id']}", use_container_width=True):
+                    trabajos.reintentar(trabajo["id"])
+                    st.rerun()
+
         st.markdown("---")
         st.subheader("📁 Mantenimiento de Drive")
         st.caption("Si hay comprobantes anteriores que no se pueden abrir o descargar, hace clic abajo para reparar sus permisos y moverlos a la carpeta compartida.")
@@ -1271,39 +1284,61 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
         admin_name = st.text_input("Nombre del revisor", placeholder="Ej: Juan Pablo Mastrangelo", key="admin_reviewer_name")
 
         if st.button("Cargar pendientes de revisión", use_container_width=True, key="btn_load_pendientes"):
+            st.session_state["revision_cargada"] = True
+            st.session_state["rev_pagina"] = 1
             with st.spinner("Leyendo rendiciones pendientes..."):
-                st.session_state["pendientes_revision"] = data.leer_pendientes_revision()
+                data.consultar_pendientes_revision(recargar=True)
 
-        pendientes = st.session_state.get("pendientes_revision", [])
-
-        if pendientes:
-            # Filters
-            col_rf1, col_rf2, col_rf3 = st.columns(3)
+        if st.session_state.get("revision_cargada"):
+            # Filters (se resuelven contra el índice de pendientes, sin releer el log)
+            col_rf1, col_rf2, col_rf3, col_rf4 = st.columns(4)
             with col_rf1:
-                fechas_disponibles = sorted(set(p["fecha"] for p in pendientes))
                 rev_fecha_desde = st.date_input("Desde", value=None, key="rev_fecha_desde")
             with col_rf2:
                 rev_fecha_hasta = st.date_input("Hasta", value=None, key="rev_fecha_hasta")
-            with col_rf3:
-                oficinas_disp = sorted(set(p["oficina"] for p in pendientes))
-                rev_oficina = st.selectbox("Oficina", ["Todas"] + oficinas_disp, key="rev_oficina_filter")
-
-            # Apply filters
-            filtered = pendientes
-            if rev_fecha_desde:
-                filtered = [p for p in filtered if str(p["fecha"])[:10] >= rev_fecha_desde.isoformat()]
-            if rev_fecha_hasta:
-                filtered = [p for p in filtered if str(p["fecha"])[:10] <= rev_fecha_hasta.isoformat()]
-            if rev_oficina and rev_oficina != "Todas":
-                filtered = [p for p in filtered if p["oficina"] == rev_oficina]
 
-            st.caption(f"Mostrando {len(filtered)} de {len(pendientes)} pendientes")
+            facetas = data.consultar_pendientes_revision(por_pagina=1) or {}
+            with col_rf3:
+                rev_oficina = st.selectbox("Oficina", ["Todas"] + facetas.get("oficinas", []), key="rev_oficina_filter")
+            with col_rf4:
+                rev_usuario = st.selectbox("Usuario", ["Todos"] + facetas.get("usuarios", []), key="rev_usuario_filter")
+
+            filtro_actual = (rev_fecha_desde, rev_fecha_hasta, rev_oficina, rev_usuario)
+            if st.session_state.get("rev_filtro_previo") != filtro_actual:
+                st.session_state["rev_filtro_previo"] = filtro_actual
+                st.session_state["rev_pagina"] = 1
+
+            consulta = data.consultar_pendientes_revision(
+                fecha_desde=rev_fecha_desde,
+                fecha_hasta=rev_fecha_hasta,
+                oficina=rev_oficina,
+                usuario=rev_usuario,
+                pagina=st.session_state.get("rev_pagina", 1),
+                por_pagina=REVISION_POR_PAGINA,
+            )
+            if consulta is None:
+                st.error("No se pudieron leer las rendiciones pendientes.")
+                consulta = {"items": [], "total": 0, "pagina": 1, "paginas": 1}
+            st.session_state["rev_pagina"] = consulta["pagina"]
+
+        if st.session_state.get("revision_cargada") and consulta["total"]:
+            st.caption(
+                f"Mostrando {len(consulta['items'])} de {consulta['total']} pendientes "
+                f"(página {consulta['pagina']} de {consulta['paginas']})"
+            )
 
-            for i, pend in enumerate(filtered):
+            seleccion = st.session_state.setdefault("rev_seleccion", set())
+            for i, pend in enumerate(consulta["items"]):
                 with st.container(border=True):
-                    st.markdown(
+                    col_tit, col_sel = st.columns([4, 1])
+                    col_tit.markdown(
                         f"**{pend['usuario']}** — {pend['oficina']} — {pend['fecha']}"
                     )
+                    if col_sel.checkbox("Seleccionar", value=pend["clave"] in seleccion,
+                                        key=f"rev_sel_{pend['clave']}"):
+                        seleccion.add(pend["clave"])
+                    else:
+                        seleccion.discard(pend["clave"])
                     c1, c2, c3 = st.columns(3)
                     c1.metric("Concepto", pend["concepto"])
                     c2.metric("Monto Imputado", f"${float(pend.get('monto_imputar', 0) or 0):,.2f}")
@@ -1323,18 +1358,14 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
 
                     col_a, col_r = st.columns(2)
                     with col_a:
-                        if st.button("Aprobar", key=f"aprobar_{pend['row_idx']}_{i}", type="primary"):
+                        if st.button("Aprobar", key=f"aprobar_{pend['clave']}_{i}", type="primary"):
                             if not admin_name:
                                 st.error("Ingresá tu nombre de revisor")
                             else:
-                                ok, msg = data.aprobar_rendicion(pend["row_idx"], admin_name)
+                                ok, msg = data.aprobar_rendicion(pend["clave"], admin_name)
                                 if ok:
+                                    # aprobar_rendicion ya la quitó del índice de pendientes
                                     st.success(f"Aprobada: {msg}")
-                                    # Remove from local list
-                                    st.session_state["pendientes_revision"] = [
-                                        p for p in st.session_state["pendientes_revision"]
-                                        if p["row_idx"] != pend["row_idx"]
-                                    ]
                                     st.rerun()
                                 else:
                                     st.error(f"Error: {msg}")
@@ -1343,26 +1374,90 @@ with st.expander("⚙️ Administración (Exportación Dux)", expanded=False):
                         motivo = st.text_area(
                             "Motivo de rechazo",
                             placeholder="Obligatorio para rechazar",
-                            key=f"motivo_{pend['row_idx']}_{i}",
+                            key=f"motivo_{pend['clave']}_{i}",
                             height=68
                         )
-                        if st.button("Rechazar", key=f"rechazar_{pend['row_idx']}_{i}", type="secondary"):
+                        if st.button("Rechazar", key=f"rechazar_{pend['clave']}_{i}", type="secondary"):
                             if not admin_name:
                                 st.error("Ingresá tu nombre de revisor")
                             elif not motivo or not motivo.strip():
                                 st.error("El motivo de rechazo es obligatorio")
                             else:
-                                ok, msg = data.rechazar_rendicion(pend["row_idx"], admin_name, motivo.strip())
+                                ok, msg = data.rechazar_rendicion(pend["clave"], admin_name, motivo.strip())
                                 if ok:
                                     st.success(f"Rechazada: {msg}")
-                                    st.session_state["pendientes_revision"] = [
-                                        p for p in st.session_state["pendientes_revision"]
-                                        if p["row_idx"] != pend["row_idx"]
-                                    ]
                                     st.rerun()
                                 else:
                                     st.error(f"Error: {msg}")
-        elif "pendientes_revision" in st.session_state:
+
+            # Acciones en lote sobre las seleccionadas (de cualquier página)
+            st.markdown("**Acciones en lote**")
+            col_lote1, col_lote2 = st.columns(2)
+            with col_lote1:
+                if st.button("Seleccionar toda la página", key="rev_sel_pagina", use_container_width=True):
+                    for pend in consulta["items"]:
+                        seleccion.add(pend["clave"])
+                        st.session_state.pop(f"rev_sel_{pend['clave']}", None)
+                    st.rerun()
+            with col_lote2:
+                if st.button("Limpiar selección", key="rev_sel_limpiar", disabled=not seleccion,
+                             use_container_width=True):
+                    for clave in seleccion:
+                        st.session_state.pop(f"rev_sel_{clave}", None)
+                    seleccion.clear()
+                    st.rerun()
+
+            if seleccion:
+                st.caption(f"{len(seleccion)} rendición(es) seleccionada(s)")
+                motivo_lote = st.text_area("Motivo de rechazo (para todas las seleccionadas)",
+                                           key="motivo_lote", height=68)
+                col_la, col_lr = st.columns(2)
+                accion_lote = None
+                with col_la:
+                    if st.button(f"Aprobar seleccionadas ({len(seleccion)})", type="primary",
+                                 key="rev_aprobar_lote", use_container_width=True):
+                        accion_lote = "aprobar"
+                with col_lr:
+                    if st.button(f"Rechazar seleccionadas ({len(seleccion)})", type="secondary",
+                                 key="rev_rechazar_lote", use_container_width=True):
+                        accion_lote = "rechazar"
+
+                if accion_lote and not admin_name:
+                    st.error("Ingresá tu nombre de revisor")
+                elif accion_lote == "rechazar" and not (motivo_lote or "").strip():
+                    st.error("El motivo de rechazo es obligatorio")
+                elif accion_lote:
+                    with st.spinner("Procesando rendiciones seleccionadas..."):
+                        if accion_lote == "aprobar":
+                            ok, msg, resultados = data.aprobar_rendiciones(sorted(seleccion), admin_name)
+                        else:
+                            ok, msg, resultados = data.rechazar_rendiciones(sorted(seleccion), admin_name,
+                                                                            motivo_lote.strip())
+                    if ok:
+                        for clave in resultados:
+                            seleccion.discard(clave)
+                            st.session_state.pop(f"rev_sel_{clave}", None)
+                        st.success(f"✅ {msg}")
+                        st.rerun()
+                    else:
+                        st.error(f"Error: {msg}")
+
+            if consulta["paginas"] > 1:
+                col_prev, col_pag, col_next = st.columns([1, 2, 1])
+                with col_prev:
+                    if st.button("◀ Anterior", disabled=consulta["pagina"] <= 1, key="rev_pag_prev",
+                                 use_container_width=True):
+                        st.session_state["rev_pagina"] = consulta["pagina"] - 1
+                        st.rerun()
+                with col_pag:
+                    st.markdown(f"<div style='text-align:center'>Página {consulta['pagina']} / {consulta['paginas']}</div>",
+                                unsafe_allow_html=True)
+                with col_next:
+                    if st.button("Siguiente ▶", disabled=consulta["pagina"] >= consulta["paginas"], key="rev_pag_next",
+                                 use_container_width=True):
+                        st.session_state["rev_pagina"] = consulta["pagina"] + 1
+                        st.rerun()
+        elif st.session_state.get("revision_cargada"):
             st.info("No hay rendiciones pendientes de revisión.")
 
     elif admin_input:
@@ -0,0 +1,150 @@
+"""
+bench_dux_export.py — Benchmark offline del export Dux (ENC/DET → .xlsx).
+
+Genera rendiciones sintéticas con la forma de RENDICIONES_LOG (claves
+internas de SHEET_KEY_MAP), las pasa por agrupar_por_comprobante →
+iterar_filas_dux → exportar_excel_dux y reporta filas por segundo y pico de
+memoria. Sin Sheets ni credenciales.
+
+Uso:
+  # Un año típico
+  python bench_dux_export.py --rendiciones 20000
+
+  # Ver que la memoria no crece con el período
+  python bench_dux_export.py --rendiciones 5000 --memoria
+  python bench_dux_export.py --rendiciones 50000 --memoria
+
+  # Generación ENC/DET sola, serie vs. núcleos asignados
+  python bench_dux_export.py --rendiciones 50000 --solo-generacion --procesos 1
+  python bench_dux_export.py --rendiciones 50000 --solo-generacion --procesos 0
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+import dux_export
+
+CUITS_PROPIOS = ["30570717630"]
+CONCEPTOS = {"FLETE TERRESTRE": 911, "HONORARIOS DESPACHANTE": 5102, "GASTOS GENERALES OF. BS.AS.": 5148}
+USUARIOS = {"DAVID REQUELME": 319, "FABRICIO DAURIA": 361, "USUARIO SIN CODIGO": None}
+
+
+def generar_rendiciones(n, semilla=0):
+    """n rendiciones sintéticas; ~1/3 de los comprobantes prorrateados en 2-3 carpetas."""
+    rng = random.Random(semilla)
+    rendiciones = []
+    i = 0
+    while len(rendiciones) < n:
+        propia = rng.random() < 0.4
+        neto = round(rng.uniform(1000, 200000), 2)
+        iva = round(neto * 0.21, 2) if propia else 0.0
+        iibb = round(neto * 0.03, 2) if propia and rng.random() < 0.5 else 0.0
+        total = round(neto + iva + iibb, 2)
+        carpetas = rng.choice([1, 1, 2, 3])
+        comprobante = {
+            "fecha": f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "usuario": rng.choice(list(USUARIOS)),
+            "oficina": "BUENOS AIRES",
+            "tipo_operacion": "Importacion",
+            "cliente": "Cliente sintético",
+            "concepto": rng.choice(list(CONCEPTOS)).title(),
+            "factura_tipo": "A" if propia else rng.choice(["B", "C"]),
+            "codigo_afip": "001" if propia else "006",
+            "sucursal": f"{rng.randint(1, 99):05d}",
+            "numero_factura": f"{i:08d}",
+            "cuit_proveedor": f"30{rng.randint(10**8, 10**9 - 1)}",
+            "cuit_cliente": CUITS_PROPIOS[0] if propia else "",
+            "perc_iibb_2": 0, "jurisdiccion_iibb_2": "", "perc_iibb_3": 0, "jurisdiccion_iibb_3": "",
+            "perc_municipal": 0, "jurisdiccion_municipal": "",
+            "iva_105": 0, "iva_27": 0, "perc_iva": 0, "perc_ganancias": 0,
+            "monto_total": total, "estado": "CERRADO",
+        }
+        for c in range(carpetas):
+            frac = 1 / carpetas
+            rendiciones.append({
+                **comprobante,
+                "id_operacion": f"B{i}",
+                "numero_carpeta": f"IMP-{i:05d}-{c}",
+                "neto_gravado": round(neto * frac, 2) if propia else 0,
+                "no_gravado": 0 if propia else round(total * frac, 2),
+                "iva_21": round(iva * frac, 2),
+                "perc_iibb": round(iibb * frac, 2), "jurisdiccion": "CABA" if iibb else "",
+                "monto_a_imputar": round(total * frac, 2),
+            })
+        i += 1
+    return rendiciones[:n]
+
+
+def correr(rendiciones, output_path, procesos=1):
+    """Pipeline completo en streaming. Devuelve (filas escritas, segundos).
+
+    Sin output_path solo genera las filas (sin escribir el .xlsx).
+    """
+    t0 = time.perf_counter()
+    grupos = dux_export.agrupar_por_comprobante(rendiciones)
+    filas = dux_export.iterar_filas_dux(
+        grupos, CUITS_PROPIOS,
+        tabla_conceptos=dux_export.tabla_codigos(CONCEPTOS),
+        tabla_empleados=dux_export.tabla_codigos({k: v for k, v in USUARIOS.items() if v is not None}),
+        procesos=procesos,
+    )
+    if output_path:
+        n_filas = dux_export.exportar_excel_dux(filas, output_path)
+    else:
+        n_filas = sum(1 for _ in filas)
+    return n_filas, time.perf_counter() - t0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del export Dux")
+    parser.add_argument("--rendiciones", type=int, default=5000)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--memoria", action="store_true", help="medir pico de memoria (tracemalloc, más lento)")
+    parser.add_argument("--salida", help="ruta del .xlsx (default: temporal, se borra)")
+    parser.add_argument("--procesos", type=int, default=1, help="procesos para generar ENC/DET (0 = núcleos asignados, con tope)")
+    parser.add_argument("--solo-generacion", action="store_true", help="medir solo ENC/DET, sin escribir el .xlsx")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    rendiciones = generar_rendiciones(args.rendiciones, args.semilla)
+    if args.solo_generacion:
+        output_path = None
+    else:
+        output_path = args.salida or os.path.join(tempfile.mkdtemp(prefix="bench_dux_"), "export_dux.xlsx")
+
+    if args.memoria:
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    n_filas, segundos = correr(rendiciones, output_path, args.procesos or None)
+    if args.memoria:
+        pico = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+
+    print("=" * 50)
+    print("BENCHMARK EXPORT DUX " + ("(solo generación ENC/DET)" if args.solo_generacion else "(write-only, streaming)"))
+    print("=" * 50)
+    print(f"  Rendiciones:         {len(rendiciones):,}")
+    print(f"  Filas ENC/DET:       {n_filas:,}")
+    print(f"  Procesos:            {args.procesos or dux_export.procesos_disponibles()}")
+    print(f"  Tiempo total:        {segundos:,.2f} s")
+    print(f"  Throughput:          {n_filas / segundos:,.0f} filas/s")
+    if output_path:
+        print(f"  Archivo:             {os.path.getsize(output_path) / 1024:,.0f} KB")
+    if args.memoria:
+        print(f"  Pico de memoria:     {pico / 1024 / 1024:,.1f} MB (sobre las rendiciones en memoria)")
+
+    if output_path and not args.salida:
+        os.remove(output_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+bench_ocr.py — Benchmark offline del pipeline escaneo → formulario.
+
+Corre un corpus de comprobantes por el mismo camino que app.py
+(normalizar_comprobante → escanear_comprobante / escanear_lote →
+campos_formulario + desglose_formulario) usando el backend de replay de
+ocr_backends, sin API key ni red.
+
+Uso:
+  # Corpus real con fixtures grabados (OCR_GRABAR_FIXTURES=1 al usar la app)
+  python bench_ocr.py --corpus comprobantes/ --fixtures fixtures/ocr
+
+  # Corpus sintético (sin archivos): N comprobantes con fixtures generados
+  python bench_ocr.py --sintetico 50 --latencia-ms 400 --tasa-error 0.05
+
+  # Comparar individual vs. lote
+  python bench_ocr.py --sintetico 30 --lote
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import statistics
+
+import ocr_backends
+import ocr_comprobantes
+import preproceso_comprobante
+
+EXTENSIONES_MIME = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".pdf": "application/pdf"}
+
+
+def cargar_corpus(directorio):
+    """Lista de (nombre, bytes, mime) de las imágenes/PDFs del directorio."""
+    corpus = []
+    for nombre in sorted(os.listdir(directorio)):
+        mime = EXTENSIONES_MIME.get(os.path.splitext(nombre)[1].lower())
+        if mime:
+            with open(os.path.join(directorio, nombre), "rb") as f:
+                corpus.append((nombre, f.read(), mime))
+    return corpus
+
+
+def generar_corpus_sintetico(n, fixtures_dir, semilla=0):
+    """Genera n "imágenes" opacas con su fixture de extracción.
+
+    Los bytes no son una imagen real: el backend de replay solo usa su hash,
+    y la normalización devuelve el original cuando no puede abrirlo.
+    """
+    rng = random.Random(semilla)
+    os.makedirs(fixtures_dir, exist_ok=True)
+    corpus = []
+    for i in range(n):
+        file_bytes = f"comprobante-sintetico-{semilla}-{i}".encode() + rng.randbytes(2048)
+        tipo = rng.choice(["A", "A", "B", "C", "TICKET"])
+        neto = round(rng.uniform(1000, 90000), 2)
+        iva = round(neto * 0.21, 2) if tipo == "A" else 0.0
+        perc = round(neto * 0.03, 2) if tipo == "A" and rng.random() < 0.5 else 0.0
+        total = round(neto + iva + perc, 2)
+        fixture = {
+            "tipo_factura": tipo,
+            "codigo_afip": "001" if tipo == "A" else "006",
+            "fecha": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2026",
+            "proveedor": f"PROVEEDOR SINTETICO {i}",
+            "cuit_proveedor": f"30{rng.randint(10**8, 10**9 - 1)}",
+            "cuit_cliente": "30570717630" if tipo == "A" else None,
+            "sucursal": f"{rng.randint(1, 99):05d}",
+            "numero_comprobante": f"{rng.randint(1, 10**7):08d}",
+            "neto_gravado": neto if tipo == "A" else 0.0,
+            "no_gravado": 0.0 if tipo == "A" else total,
+            "exento": 0.0, "iva_21": iva, "iva_10_5": 0.0, "iva_27": 0.0,
+            "perc_iva": 0.0, "perc_ganancias": 0.0,
+            "perc_iibb_lista": [{"jurisdiccion": "CORDOBA", "monto": perc}] if perc else [],
+            "perc_municipal": None,
+            "monto_total": total,
+        }
+        with open(os.path.join(fixtures_dir, f"{ocr_backends.huella_archivo(file_bytes)}.json"), "w") as f:
+            json.dump(fixture, f)
+        corpus.append((f"sintetico_{i:03d}.jpg", file_bytes, "image/jpeg"))
+    return corpus
+
+
+def _a_formulario(resultado):
+    """Último tramo del pipeline: lo que app.py carga en el form."""
+    if not isinstance(resultado, dict):
+        return None
+    campos = ocr_comprobantes.campos_formulario(resultado)
+    desglose = ocr_comprobantes.desglose_formulario(resultado)[0]
+    return campos, desglose
+
+
+def correr(corpus, lote=False):
+    """Pasa el corpus por el pipeline. Devuelve métricas por archivo."""
+    normalizados = []
+    t_prep = time.perf_counter()
+    for nombre, file_bytes, mime in corpus:
+        nb, nm, _ = preproceso_comprobante.normalizar_comprobante(file_bytes, mime)
+        normalizados.append((nombre, nb, nm))
+    t_prep = time.perf_counter() - t_prep
+
+    metricas = []
+    if lote:
+        t0 = time.perf_counter()
+        resultados = ocr_comprobantes.escanear_lote([(b, m) for _, b, m in normalizados])
+        total_ms = (time.perf_counter() - t0) * 1000
+        for (nombre, _, _), res in zip(normalizados, resultados):
+            metricas.append({"archivo": nombre, "ok": _a_formulario(res) is not None,
+                             "latencia_ms": total_ms / max(1, len(normalizados))})
+    else:
+        for nombre, nb, nm in normalizados:
+            t0 = time.perf_counter()
+            res = ocr_comprobantes.escanear_comprobante(nb, nm)
+            form = _a_formulario(res)
+            metricas.append({"archivo": nombre, "ok": form is not None,
+                             "latencia_ms": (time.perf_counter() - t0) * 1000})
+    return metricas, t_prep
+
+
+def _percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de OCR")
+    parser.add_argument("--corpus", help="directorio con imágenes/PDFs")
+    parser.add_argument("--fixtures", default=ocr_backends.FIXTURES_DIR_DEFAULT)
+    parser.add_argument("--sintetico", type=int, default=0, help="generar N comprobantes sintéticos")
+    parser.add_argument("--latencia-ms", type=float, default=0)
+    parser.add_argument("--tasa-error", type=float, default=0.0)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--lote", action="store_true", help="usar escanear_lote")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    fixtures_dir = args.fixtures
+    if args.sintetico:
+        fixtures_dir = tempfile.mkdtemp(prefix="bench_ocr_")
+        corpus = generar_corpus_sintetico(args.sintetico, fixtures_dir, args.semilla)
+    elif args.corpus:
+        corpus = cargar_corpus(args.corpus)
+    else:
+        parser.error("indicar --corpus o --sintetico N")
+    if not corpus:
+        print("Corpus vacío.")
+        return 1
+
+    backend = ocr_backends.BackendReplay(fixtures_dir=fixtures_dir, latencia_ms=args.latencia_ms,
+                                         tasa_error=args.tasa_error, semilla=args.semilla)
+    ocr_backends.set_backend(backend)
+
+    t0 = time.perf_counter()
+    metricas, t_prep = correr(corpus, lote=args.lote)
+    total_s = time.perf_counter() - t0
+
+    latencias = [m["latencia_ms"] for m in metricas]
+    n_ok = sum(1 for m in metricas if m["ok"])
+    print("=" * 50)
+    print(f"BENCHMARK OCR ({'lote' if args.lote else 'individual'}, backend {backend.nombre})")
+    print("=" * 50)
+    print(f"  Comprobantes:        {len(metricas)}")
+    print(f"  Al formulario OK:    {n_ok} ({n_ok / len(metricas) * 100:.0f}%)")
+    print(f"  Llamadas al backend: {backend.llamadas} ({backend.llamadas / len(metricas):.2f} por comprobante)")
+    print(f"  Normalización:       {t_prep * 1000:,.0f} ms total")
+    print(f"  Latencia p50/p95:    {statistics.median(latencias):,.0f} / {_percentil(latencias, 95):,.0f} ms")
+    print(f"  Throughput:          {len(metricas) / total_s:,.1f} comprobantes/s")
+    return 0 if n_ok == len(metricas) or args.tasa_error > 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+captura.py — Componente de captura que comprime la foto en el navegador.
+
+Los operadores de campo suben desde el celular con datos móviles y
+st.camera_input / st.file_uploader mandan el archivo original (varios MB)
+antes de que el servidor pueda hacer nada. Este componente redimensiona y
+re-encodea la foto a JPEG en el navegador, así lo que viaja por la red ya
+es la versión liviana.
+
+El frontend es HTML estático en componentes/captura_comprimida/ (sin build).
+
+Uso:  from captura import captura_comprimida
+"""
+
+import os
+import base64
+import logging
+
+import streamlit.components.v1 as components
+
+from preproceso_comprobante import MAX_LADO_OCR, CALIDAD_JPEG
+
+logger = logging.getLogger(__name__)
+
+_COMPONENTE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "componentes", "captura_comprimida")
+_captura_componente = components.declare_component("captura_comprimida", path=_COMPONENTE_DIR)
+
+
+def captura_comprimida(key=None, max_lado=MAX_LADO_OCR, calidad=CALIDAD_JPEG):
+    """Renderiza el botón de captura y devuelve la foto ya comprimida.
+
+    Args:
+        key: key de Streamlit (cambiarla resetea el componente).
+        max_lado: lado mayor en px al que se reduce la foto en el navegador.
+        calidad: calidad JPEG 1-100 (misma escala que preproceso_comprobante).
+
+    Returns:
+        (bytes, str, dict) o (None, None, None): (archivo, mime, info). info
+        trae bytes_originales / bytes_finales medidos en el dispositivo.
+    """
+    valor = _captura_componente(max_lado=max_lado, calidad=calidad / 100.0,
+                                key=key, default=None)
+    if not valor or not valor.get("data"):
+        return None, None, None
+
+    try:
+        file_bytes = base64.b64decode(valor["data"])
+    except Exception as e:
+        logger.warning(f"Captura comprimida inválida: {e}")
+        return None, None, None
+
+    info = {
+        "nombre": valor.get("nombre", ""),
+        "bytes_originales": int(valor.get("bytes_originales") or len(file_bytes)),
+        "bytes_finales": len(file_bytes),
+        "ancho": valor.get("ancho"),
+        "alto": valor.get("alto"),
+    }
+    return file_bytes, valor.get("mime", "image/jpeg"), info
@@ -2,8 +2,14 @@
 import streamlit as st
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+import re
+import json
+import time
+import hashlib
 import logging
+import threading
 from datetime import datetime
+from collections import OrderedDict
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -473,6 +479,20 @@ def get_codigo_empleado_dux(usuario):
     return mapping.get(str(usuario).strip().upper())
 
 
+def tablas_codigos_dux():
+    """Tablas inmutables de códigos Dux para un export (una lectura por hoja).
+
+    Returns:
+        (Mapping, Mapping): (concepto → código, usuario → código), vacías sin credenciales.
+    """
+    client, _ = get_gsheets_client()
+    sheet_id = _get_sheet_id()
+    if not client or not sheet_id:
+        return tabla_codigos({}), tabla_codigos({})
+    return (tabla_codigos(_leer_maestro_conceptos_dux(client, sheet_id)),
+            tabla_codigos(_leer_codigos_empleado_dux(client, sheet_id)))
+
+
 def get_cuits_propios():
     """Returns list of Expoconsult CUITs from CONFIG_EMPRESA.
 
@@ -772,6 +792,12 @@ def sync_data_from_sheets():
         except Exception as e:
             logger.warning(f"Could not migrate RENDICIONES_LOG headers: {e}")
 
+        # 11. IMPUTACIONES_LEDGER — Create and seed from RENDICIONES_LOG if missing
+        try:
+            crear_hoja_ledger(sh)
+        except Exception as e:
+            logger.warning(f"Could not ensure {LEDGER_SHEET}: {e}")
+
         return True, "Sync OK"
 
     except gspread.exceptions.SpreadsheetNotFound:
@@ -850,66 +876,75 @@ def upload_receipt_to_drive(file_bytes, file_name, mime_type):
         logger.error(f"Drive Upload Error: {e}")
         return None, None, str(e)
 
+def _factura_disponible(id_factura, saldo, **extra):
+    """Dict de factura para el formulario a partir del ID Factura (suc 5 + num 8)."""
+    id_factura = str(id_factura)
+    sucursal, numero = (id_factura[:5], id_factura[5:]) if len(id_factura) == 13 and id_factura.isdigit() else ("", id_factura)
+    # CONTROL_SALDOS no guarda el tipo: las facturas con saldo son las de respaldo (C por defecto)
+    return {"tipo": "C", "sucursal": sucursal.zfill(5), "numero": numero.zfill(8), "id_factura": id_factura,
+            "saldo": saldo, **extra}
+
+
 def find_available_invoice_balance(cuit_provider, amount_needed):
     """
-    Searches 'CONTROL_SALDOS' for invoices from this provider with 'Saldo Disponible' >= amount_needed.
-    Returns: dict with invoice data (suc, num, tipo) or None.
+    Busca en CONTROL_SALDOS la factura del proveedor con el menor saldo
+    restante que alcance para amount_needed (mejor ajuste, vía INDICE_SALDOS).
+
+    Returns:
+        dict con tipo, sucursal, numero, id_factura y saldo, o None.
     """
     try:
-        client, email = get_gsheets_client()
-        if not client: return None
-        
-        sheet_id = os.getenv("GSHEET_ID")
-        sheet_name = os.getenv("GSHEET_NAME", "SISTEMA_RENDICIONES")
-        try:
-            if "GSHEET_ID" in st.secrets:
-                sheet_id = st.secrets["GSHEET_ID"]
-            if "GSHEET_NAME" in st.secrets:
-                sheet_name = st.secrets["GSHEET_NAME"]
-        except: pass
-
-        if sheet_id:
-            sh = client.open_by_key(sheet_id)
-        else:
-            sh = client.open(sheet_name)
-            
+        _, sh = _get_sheet_handle()
         ws = sh.worksheet("CONTROL_SALDOS")
-        
-        rows = ws.get_all_records() # Expects headers in row 1
-        
-        # Candidates list
-        candidates = []
-        
-        for r in rows:
-            # Check CUIT (Handle string/int types)
-            row_cuit = str(r.get("Cuit_Proveedor", "")).replace("-","").strip()
-            target_cuit = str(cuit_provider).replace("-","").strip()
-            
-            if row_cuit == target_cuit:
-                try:
-                    saldo = float(str(r.get("Saldo Restante", 0)).replace("$","").replace(",",""))
-                except:
-                    saldo = 0.0
-                
-                if saldo >= amount_needed:
-                    # Found a candidate
-                    return {
-                        "tipo": r.get("Tipo", "C"),
-                        "sucursal": str(r.get("Sucursal", "")).zfill(5),
-                        "numero": str(r.get("Numero", "")).zfill(8),
-                        "saldo": saldo
-                    }
-        return None
+        with INDICE_SALDOS.bloqueo():
+            INDICE_SALDOS.asegurar(ws, sh.id)
+            encontrada = INDICE_SALDOS.mejor_ajuste(cuit_provider, safe_float(amount_needed))
+        if not encontrada:
+            return None
+        return _factura_disponible(encontrada["id_factura"], encontrada["saldo"])
     except Exception as e:
         logger.warning(f"Error searching balances: {e}")
         return None
 
+
+def asignar_saldos_disponibles(cuit_provider, amount_needed):
+    """
+    Reparte amount_needed entre las facturas con saldo del proveedor: una sola
+    si alguna alcanza (mejor ajuste); si no, varias de mayor a menor saldo.
+
+    Returns:
+        list de dicts como find_available_invoice_balance más "monto" (lo que
+        se imputa a cada una). Vacía si el saldo total no alcanza.
+    """
+    try:
+        _, sh = _get_sheet_handle()
+        ws = sh.worksheet("CONTROL_SALDOS")
+        with INDICE_SALDOS.bloqueo():
+            INDICE_SALDOS.asegurar(ws, sh.id)
+            asignacion = INDICE_SALDOS.asignar(cuit_provider, safe_float(amount_needed))
+        return [_factura_disponible(a["id_factura"], a["saldo"], monto=a["monto"]) for a in asignacion]
+    except Exception as e:
+        logger.warning(f"Error asignando saldos: {e}")
+        return []
+
+def nuevo_id_operacion():
+    """ID Operación: timestamp + sufijo aleatorio.
+
+    Con los guardados en segundo plano dos trabajos pueden loguear la misma
+    carpeta en el mismo segundo; el sufijo mantiene única la clave_fila.
+    """
+    import uuid
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6].upper()}"
+
+
 def log_rendicion_to_sheet(payload, ticket_url="", estado_override=None):
     """
     Appends a new row to RENDICIONES_LOG tab with updated columns.
 
     Args:
-        payload: dict with rendition data.
+        payload: dict with rendition data. payload["id_operacion"] (compartido
+                 por las carpetas de un guardado) se usa como ID Operación;
+                 si falta se genera uno con nuevo_id_operacion().
         ticket_url: URL of uploaded receipt in Drive.
         estado_override: if set, overrides the Puchito-calculated estado
                          (e.g. "PENDIENTE REVISIÓN" for excess amounts).
@@ -936,7 +971,7 @@ def log_rendicion_to_sheet(payload, ticket_url="", estado_override=None):
         ws_log = sh.worksheet("RENDICIONES_LOG")
         
         # Mapping payload to columns (22 COLUMNS NOW)
-        row_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        row_id = str(payload.get("id_operacion") or "").strip() or nuevo_id_operacion()
         
         # Parse and Pad Components for Robust Keys
         suc_raw = str(payload.get("sucursal_factura", "") or "").strip()
@@ -1049,9 +1084,22 @@ def log_rendicion_to_sheet(payload, ticket_url="", estado_override=None):
 
         # Use explicit range update instead of append_row to prevent column shifting.
         # append_row can misalign when the sheet grid has extra empty columns.
-        next_row = len(ws_log.get_all_values()) + 1
+        valores_log = ws_log.get_all_values()
+        if payload.get("id_operacion"):
+            # Reintento de un guardado cuyo log salió pero no quedó registrado:
+            # la fila ya está (misma clave), no se agrega otra.
+            clave = clave_fila(row[0], row[4])
+            for i, existente in enumerate(valores_log[1:], start=2):
+                if len(existente) > 4 and clave_fila(existente[0], existente[4]) == clave:
+                    logger.info(f"RENDICIONES_LOG: {clave} ya estaba en la fila {i} — no se duplica")
+                    return True
+        next_row = len(valores_log) + 1
         cell_range = f"A{next_row}:AQ{next_row}"
         ws_log.update(range_name=cell_range, values=[row])
+        _marcar_log_modificado(sh)
+        INDICE_FILAS_LOG.agregar(next_row, row[0], row[4], row[40], sh.id)
+        if estado_saldo == ESTADO_PENDIENTE_REVISION:
+            INDICE_PENDIENTES.agregar(_fila_a_pendiente(next_row, row), sh.id)
         return True
     except Exception as e:
         logger.error(f"Error logging to sheet: {e}")
@@ -1121,208 +1169,138 @@ def _calcular_estado_saldo(saldo_restante):
 
 def actualizar_control_saldos(payload):
     """
-    Actualiza la hoja CONTROL_SALDOS tras guardar una rendición.
-    Si la factura ya existe (CUIT + ID Factura), actualiza imputado/saldo/estado.
-    Si no existe, crea una fila nueva.
+    Registra la imputación de una rendición en el ledger y actualiza
+    CONTROL_SALDOS (vista materializada del ledger).
 
     Returns:
         (bool, str): (éxito, mensaje)
     """
-    try:
-        client, email = get_gsheets_client()
-        if not client:
-            return False, f"No se pudieron generar credenciales. Email: {email}"
+    eventos = eventos_imputacion([payload])
+    if not eventos:
+        return True, "Sin CUIT/ID Factura: no se registra saldo"
+    ok, msg = registrar_eventos_ledger(eventos)
+    if not ok:
+        return False, msg
+    return materializar_saldos(eventos)
 
-        sheet_id = os.getenv("GSHEET_ID")
-        sheet_name = os.getenv("GSHEET_NAME", "SISTEMA_RENDICIONES")
-        try:
-            if "GSHEET_ID" in st.secrets:
-                sheet_id = st.secrets["GSHEET_ID"]
-            if "GSHEET_NAME" in st.secrets:
-                sheet_name = st.secrets["GSHEET_NAME"]
-        except:
-            pass
 
-        if sheet_id:
-            sh = client.open_by_key(sheet_id)
-        else:
-            sh = client.open(sheet_name)
+SALDOS_HEADER = ["Cuit_Proveedor", "ID Factura", "Respaldo (Neto/Total)", "Total Imputado", "Saldo Restante", "Estado Dux"]
 
-        ws = sh.worksheet("CONTROL_SALDOS")
 
-        # Construir ID Factura
-        suc_raw = str(payload.get("sucursal_factura", "") or "").strip()
-        num_raw = str(payload.get("numero_factura", "") or "").strip()
-        suc = suc_raw.zfill(5) if suc_raw.isdigit() else suc_raw
-        num = num_raw.zfill(8) if num_raw.isdigit() else num_raw
-        id_factura = f"{suc}{num}"
+def _fila_saldo(cuit, id_factura, sal):
+    saldo = sal["respaldo"] - sal["imputado"]
+    return [cuit, id_factura, round(sal["respaldo"], 2), round(sal["imputado"], 2),
+            round(saldo, 2), _calcular_estado_saldo(saldo)]
 
-        cuit = str(payload.get("proveedor_cuit", "")).strip()
-        monto_a_imputar = safe_float(payload.get("monto_a_imputar", 0))
 
-        # Buscar fila existente con mismo CUIT (col A) + ID Factura (col B)
-        all_values = ws.get_all_values()
-        fila_encontrada = None
-        fila_idx = None  # 1-based row index in sheet
+def _celda_distinta(actual, nuevo):
+    if isinstance(nuevo, (int, float)):
+        return str(actual).strip() == "" or abs(safe_float(actual) - nuevo) >= 0.005
+    return str(actual).strip() != str(nuevo).strip()
 
-        for i, row in enumerate(all_values):
-            if i == 0:
-                continue  # Skip header
-            if len(row) >= 2:
-                row_cuit = str(row[0]).strip()
-                row_id = str(row[1]).strip()
-                if row_cuit == cuit and row_id == id_factura:
-                    fila_encontrada = row
-                    fila_idx = i + 1  # 1-based
-                    break
-
-        if fila_encontrada:
-            # Actualizar fila existente
-            respaldo = safe_float(fila_encontrada[2]) if len(fila_encontrada) > 2 else 0.0
-            total_imputado = safe_float(fila_encontrada[3]) if len(fila_encontrada) > 3 else 0.0
-            total_imputado += monto_a_imputar
-            saldo = respaldo - total_imputado
-            estado = _calcular_estado_saldo(saldo)
-
-            ws.batch_update([
-                {'range': f'D{fila_idx}', 'values': [[round(total_imputado, 2)]]},
-                {'range': f'E{fila_idx}', 'values': [[round(saldo, 2)]]},
-                {'range': f'F{fila_idx}', 'values': [[estado]]},
-            ])
-            return True, f"Saldo actualizado: {id_factura} -> {estado} (${saldo:,.2f})"
-        else:
-            # Crear fila nueva
-            tipo = str(payload.get("tipo_factura", "")).strip().upper()
-            if tipo == "A":
-                respaldo = safe_float(payload.get("monto_neto_original", 0)) + \
-                           safe_float(payload.get("no_gravado_original", 0))
-            else:
-                respaldo = safe_float(payload.get("monto_ticket_total_original", 0))
-
-            saldo = respaldo - monto_a_imputar
-            estado = _calcular_estado_saldo(saldo)
-
-            ws.append_row([
-                cuit,
-                id_factura,
-                round(respaldo, 2),
-                round(monto_a_imputar, 2),
-                round(saldo, 2),
-                estado,
-            ])
-            return True, f"Nuevo saldo creado: {id_factura} -> {estado} (${saldo:,.2f})"
 
-    except Exception as e:
-        logger.error(f"Error actualizando CONTROL_SALDOS: {e}")
-        return False, str(e)
-
-
-def recalcular_control_saldos():
+def recalcular_control_saldos(completo=False):
     """
-    Recalcula CONTROL_SALDOS completo desde RENDICIONES_LOG.
-    Lee todas las rendiciones, agrupa por CUIT + ID Factura,
-    calcula respaldo/imputado/saldo/estado, y reescribe la hoja.
+    Recalcula CONTROL_SALDOS como fold sobre IMPUTACIONES_LEDGER y escribe
+    solo las celdas que cambian (sin clear(): la hoja nunca queda vacía).
+
+    Incremental (default): solo las facturas con eventos nuevos desde la
+    última corrida (marca en almacen_local). Completo: todas las facturas, y
+    además elimina filas huérfanas/duplicadas que no están en el ledger.
+    Si el ledger no existe (primera vez), se crea sembrado desde RENDICIONES_LOG.
 
     Returns:
-        (bool, str, int): (éxito, mensaje, filas actualizadas)
+        (bool, str, int): (éxito, mensaje, facturas con cambios)
     """
     try:
-        client, email = get_gsheets_client()
-        if not client:
-            return False, f"No se pudieron generar credenciales. Email: {email}", 0
-
-        sheet_id = os.getenv("GSHEET_ID")
-        sheet_name = os.getenv("GSHEET_NAME", "SISTEMA_RENDICIONES")
-        try:
-            if "GSHEET_ID" in st.secrets:
-                sheet_id = st.secrets["GSHEET_ID"]
-            if "GSHEET_NAME" in st.secrets:
-                sheet_name = st.secrets["GSHEET_NAME"]
-        except:
-            pass
-
-        if sheet_id:
-            sh = client.open_by_key(sheet_id)
+        _, sh = _get_sheet_handle()
+        clave_marca = f"saldos_recalculados_hasta:{sh.id}"
+
+        # 1. Leer el ledger y determinar las facturas sucias
+        eventos = leer_ledger(sh)
+        if not eventos:
+            return False, f"{LEDGER_SHEET} está vacío.", 0
+        marca = almacen_local.leer_valor(clave_marca)
+        if marca is None or marca > len(eventos):
+            completo = True  # sin marca (o ledger recortado a mano): pasada completa
+        if completo:
+            sucias = None
         else:
-            sh = client.open(sheet_name)
+            sucias = {(ev["cuit"], ev["id_factura"]) for ev in eventos[marca:]}
+            if not sucias:
+                return True, "Sin cambios desde el último recálculo", 0
 
-        # 1. Leer RENDICIONES_LOG
-        ws_log = sh.worksheet("RENDICIONES_LOG")
-        all_records = ws_log.get_all_records()
-
-        if not all_records:
-            return False, "RENDICIONES_LOG está vacía.", 0
-
-        # 2. Agrupar por CUIT + ID Factura
-        grupos = {}
-        for record in all_records:
-            cuit = str(record.get("Cuit_Proveedor_AI", "")).strip()
-            suc_raw = str(record.get("Sucursal", "") or "").strip()
-            num_raw = str(record.get("Número_de_factura", "") or "").strip()
-            suc = suc_raw.zfill(5) if suc_raw.isdigit() else suc_raw
-            num = num_raw.zfill(8) if num_raw.isdigit() else num_raw
-            id_factura = f"{suc}{num}"
-
-            if not cuit or not id_factura or id_factura == "0000000000000":
-                continue
+        # 2. Fold (solo de las facturas sucias en modo incremental)
+        saldos = plegar_ledger(ev for ev in eventos if sucias is None or (ev["cuit"], ev["id_factura"]) in sucias)
 
-            key = f"{cuit}|{id_factura}"
-            if key not in grupos:
-                grupos[key] = {
-                    "cuit": cuit,
-                    "id_factura": id_factura,
-                    "tipo": str(record.get("factura_tipo", "")).strip().upper(),
-                    "records": [],
-                }
-            grupos[key]["records"].append(record)
-
-        # 3. Calcular saldos
-        filas_saldos = []
-        for key, grupo in grupos.items():
-            primer = grupo["records"][0]
-            tipo = grupo["tipo"]
-
-            # Determinar Respaldo (uses REAL header names from production sheet)
-            if tipo == "A":
-                respaldo = safe_float(primer.get("Gravado", 0)) + \
-                           safe_float(primer.get("No_Gravado", 0))
-            else:
-                respaldo = safe_float(primer.get("Monto Ticket", 0))
-
-            # Sumar todos los monto_a_imputar
-            total_imputado = sum(
-                safe_float(r.get("Monto a Imputar", 0))
-                for r in grupo["records"]
-            )
-
-            saldo = respaldo - total_imputado
-            estado = _calcular_estado_saldo(saldo)
-
-            filas_saldos.append([
-                grupo["cuit"],
-                grupo["id_factura"],
-                round(respaldo, 2),
-                round(total_imputado, 2),
-                round(saldo, 2),
-                estado,
-            ])
-
-        # 4. Limpiar y reescribir CONTROL_SALDOS
+        # 3. Diff contra la hoja actual
         ws_saldos = sh.worksheet("CONTROL_SALDOS")
-        ws_saldos.clear()
-
-        # Must match REAL production headers in CONTROL_SALDOS
-        header = ["Cuit_Proveedor", "ID Factura", "Respaldo (Neto/Total)", "Total Imputado", "Saldo Restante", "Estado Dux"]
-        all_data = [header] + filas_saldos
-
-        if len(filas_saldos) > 0:
-            total_rows = 1 + len(filas_saldos)
-            cell_range = f"A1:F{total_rows}"
-            ws_saldos.update(range_name=cell_range, values=all_data)
-
-        msg = f"Recalculado: {len(filas_saldos)} facturas procesadas"
+        with INDICE_SALDOS.bloqueo():
+            valores = ws_saldos.get_all_values()
+            if not valores:
+                valores = [SALDOS_HEADER]
+            filas_por_clave, huerfanas = {}, []
+            for i, row in enumerate(valores[1:], start=2):
+                k = (str(row[0]).strip(), str(row[1]).strip()) if len(row) >= 2 else ("", "")
+                if not k[0] and not k[1]:
+                    continue
+                if k in filas_por_clave or (completo and (k not in saldos or not saldos[k]["imputada"])):
+                    huerfanas.append(i)
+                else:
+                    filas_por_clave[k] = i
+
+            updates, nuevas, n_cambios = [], [], 0
+            for k, sal in saldos.items():
+                if not sal["imputada"]:
+                    continue  # solo reversiones: no hay factura que mostrar
+                fila_nueva = _fila_saldo(k[0], k[1], sal)
+                fila_idx = filas_por_clave.get(k)
+                if fila_idx is None:
+                    nuevas.append(fila_nueva)
+                    n_cambios += 1
+                    continue
+                actual = list(valores[fila_idx - 1]) + [""] * 6
+                cambio = False
+                for col in range(2, 6):  # C..F
+                    if _celda_distinta(actual[col], fila_nueva[col]):
+                        updates.append({"range": f"{'ABCDEF'[col]}{fila_idx}", "values": [[fila_nueva[col]]]})
+                        valores[fila_idx - 1] = (list(valores[fila_idx - 1]) + [""] * 6)[:6]
+                        valores[fila_idx - 1][col] = fila_nueva[col]
+                        cambio = True
+                n_cambios += cambio
+
+            if nuevas:
+                inicio = len(valores) + 1
+                updates.append({"range": f"A{inicio}:F{inicio + len(nuevas) - 1}", "values": nuevas})
+                valores.extend(nuevas)
+            if valores[0][:6] != SALDOS_HEADER:
+                updates.append({"range": "A1:F1", "values": [SALDOS_HEADER]})
+                valores[0] = SALDOS_HEADER
+
+            # 4. Escribir solo el diff
+            try:
+                if updates:
+                    ws_saldos.batch_update(updates)
+                if huerfanas:
+                    # De abajo hacia arriba para no correr los índices
+                    sh.batch_update({"requests": [
+                        {"deleteDimension": {"range": {"sheetId": ws_saldos.id, "dimension": "ROWS",
+                                                       "startIndex": i - 1, "endIndex": i}}}
+                        for i in sorted(huerfanas, reverse=True)
+                    ]})
+                    for i in sorted(huerfanas, reverse=True):
+                        del valores[i - 1]
+            except Exception:
+                INDICE_SALDOS.invalidar()
+                raise
+            INDICE_SALDOS.cargar_desde_valores(valores, sh.id)
+
+        almacen_local.guardar_valor(clave_marca, len(eventos))
+        modo = "completo" if completo else f"incremental ({len(sucias)} facturas)"
+        msg = (f"Recalculado {modo}: {n_cambios} facturas con cambios, "
+               f"{len(huerfanas)} filas eliminadas, {len(updates)} rangos escritos")
         logger.info(msg)
-        return True, msg, len(filas_saldos)
+        return True, msg, n_cambios
 
     except Exception as e:
         import traceback
@@ -1384,6 +1362,7 @@ def _revalidate_log(client, sheet_key, providers_db):
         
         if updates:
             ws.batch_update(updates)
+            _marcar_log_modificado(sh)
             return len(updates)
             
         return 0
@@ -1420,8 +1399,105 @@ def _get_sheet_handle():
     return client, sh
 
 
+ESTADO_PENDIENTE_REVISION = "PENDIENTE REVISIÓN"
+MAX_FILAS_BATCH_GET = 200  # con más pendientes conviene leer el log entero
+
+
+def _fila_a_pendiente(row_idx, row):
+    """Fila de RENDICIONES_LOG → dict de pendiente de revisión."""
+    row = list(row) + [""] * (43 - len(row))
+    return {
+        "clave": clave_fila(row[0], row[4]),  # ID estable para aprobar/rechazar
+        "row_idx": row_idx,  # 1-based for gspread
+        "id_operacion": row[0],
+        "fecha": row[1],
+        "usuario": row[2],
+        "oficina": row[3],
+        "numero_carpeta": row[4],
+        "concepto": row[7],
+        "monto_sugerido": row[8],
+        "tipo_factura": row[9],
+        "sucursal": row[11],
+        "numero_factura": row[12],
+        "proveedor_cuit": row[15],
+        "proveedor_nombre": "",  # not stored directly — use CUIT lookup
+        "monto_total_ticket": row[25],
+        "monto_imputar": row[26],
+        "ticket_url": row[27],
+        "estado": str(row[28]).strip(),
+        "rendicion_id": row[40],
+    }
+
+
+def _cargar_indice_pendientes(sh):
+    """Carga INDICE_PENDIENTES leyendo solo la columna AC y las filas pendientes.
+
+    Con muchas pendientes (> MAX_FILAS_BATCH_GET) lee el log entero en una llamada.
+    """
+    ws = sh.worksheet("RENDICIONES_LOG")
+    estados = ws.col_values(29)  # AC = Estado Saldos
+    filas = [i + 1 for i, estado in enumerate(estados)
+             if i > 0 and str(estado).strip() == ESTADO_PENDIENTE_REVISION]
+
+    if len(filas) > MAX_FILAS_BATCH_GET:
+        all_rows = ws.get_all_values()
+        pendientes = [_fila_a_pendiente(f, all_rows[f - 1]) for f in filas if f - 1 < len(all_rows)]
+    elif filas:
+        rangos = ws.batch_get([f"A{f}:AQ{f}" for f in filas])
+        pendientes = [_fila_a_pendiente(f, rango[0] if rango else []) for f, rango in zip(filas, rangos)]
+    else:
+        pendientes = []
+
+    # Filas cortas (< 31 columnas) se ignoraban antes: mismas reglas
+    pendientes = [p for p in pendientes if p["estado"] == ESTADO_PENDIENTE_REVISION]
+    INDICE_PENDIENTES.cargar(pendientes, sh.id)
+
+
+def consultar_pendientes_revision(fecha_desde=None, fecha_hasta=None, oficina=None, usuario=None,
+                                  pagina=1, por_pagina=20, recargar=False):
+    """Consulta paginada de rendiciones en PENDIENTE REVISIÓN.
+
+    Usa INDICE_PENDIENTES (se carga la primera vez, al vencer o con recargar=True).
+
+    Args:
+        fecha_desde / fecha_hasta: date o "YYYY-MM-DD" inclusive.
+        oficina / usuario: filtro exacto ("Todas"/None = sin filtro).
+        pagina: 1-based.
+
+    Returns:
+        dict: items (dicts como leer_pendientes_revision), total, paginas,
+        pagina, oficinas y usuarios disponibles. None si falla la lectura.
+    """
+    try:
+        _, sh = _get_sheet_handle()
+        with INDICE_PENDIENTES.bloqueo():
+            if recargar or not INDICE_PENDIENTES.vigente(sh.id):
+                _cargar_indice_pendientes(sh)
+
+        def _iso(f):
+            return f.isoformat() if hasattr(f, "isoformat") else (str(f)[:10] if f else None)
+
+        oficina = None if oficina == "Todas" else oficina
+        usuario = None if usuario == "Todos" else usuario
+        filtro = (_iso(fecha_desde), _iso(fecha_hasta), oficina, usuario)
+        pagina = max(1, pagina)
+        items, total = INDICE_PENDIENTES.consultar(*filtro, pagina=pagina, por_pagina=por_pagina)
+        paginas_total = max(1, -(-total // por_pagina))
+        if pagina > paginas_total:  # la página quedó vacía (se aprobaron/rechazaron las últimas)
+            pagina = paginas_total
+            items, total = INDICE_PENDIENTES.consultar(*filtro, pagina=pagina, por_pagina=por_pagina)
+        return {
+            "items": items, "total": total, "pagina": pagina, "paginas": paginas_total,
+            "oficinas": INDICE_PENDIENTES.valores("oficina"),
+            "usuarios": INDICE_PENDIENTES.valores("usuario"),
+        }
+    except Exception as e:
+        logger.error(f"Error reading pending reviews: {e}")
+        return None
+
+
 def leer_pendientes_revision():
-    """Lee RENDICIONES_LOG y devuelve filas con estado PENDIENTE REVISIÓN.
+    """Devuelve todas las filas de RENDICIONES_LOG en PENDIENTE REVISIÓN.
 
     Returns:
         list[dict]: cada dict tiene keys: row_idx (1-based sheet row),
@@ -1429,215 +1505,573 @@ def leer_pendientes_revision():
         concepto, monto_sugerido, monto_imputar, proveedor_cuit,
         proveedor_nombre, ticket_url, estado.
     """
-    try:
-        _, sh = _get_sheet_handle()
-        ws = sh.worksheet("RENDICIONES_LOG")
-        all_rows = ws.get_all_values()
+    resultado = consultar_pendientes_revision(por_pagina=10**9)
+    return resultado["items"] if resultado else []
 
-        if len(all_rows) < 2:
-            return []
 
-        results = []
-        for i, row in enumerate(all_rows):
-            if i == 0:
-                continue  # header
-            if len(row) < 31:
-                continue
+def _estado_aprobacion(row):
+    """Estado al aprobar: regla del Puchito sobre Z (ticket) y AA (imputado)."""
+    monto_ticket = safe_float(row[25])    # Z: Monto Total Ticket
+    monto_imputar = safe_float(row[26])   # AA: Monto a Imputar
+    saldo_pendiente = abs(monto_ticket - monto_imputar)
 
-            estado = str(row[28]).strip()  # AC = index 28
-            if estado != "PENDIENTE REVISIÓN":
-                continue
+    if saldo_pendiente == 0:
+        return "CERRADO"
+    elif saldo_pendiente < 1000:
+        return "LISTA PARA AJUSTE"
+    return "PENDIENTE"
 
-            results.append({
-                "row_idx": i + 1,  # 1-based for gspread
-                "id_operacion": row[0],
-                "fecha": row[1],
-                "usuario": row[2],
-                "oficina": row[3],
-                "numero_carpeta": row[4],
-                "concepto": row[7],
-                "monto_sugerido": row[8],
-                "tipo_factura": row[9],
-                "sucursal": row[11],
-                "numero_factura": row[12],
-                "proveedor_cuit": row[15],
-                "proveedor_nombre": "",  # not stored directly — use CUIT lookup
-                "monto_total_ticket": row[25],
-                "monto_imputar": row[26],
-                "ticket_url": row[27],
-                "estado": estado,
-                "rendicion_id": row[40] if len(row) > 40 else "",
-            })
-
-        return results
-    except Exception as e:
-        logger.error(f"Error reading pending reviews: {e}")
-        return []
 
+def _cargar_indice_filas_log(ws, clave):
+    """Recarga INDICE_FILAS_LOG leyendo solo las columnas de IDs (A, E, AO)."""
+    ids_op, carpetas, rids = ws.batch_get(["A2:A", "E2:E", "AO2:AO"], major_dimension="COLUMNS")
+    INDICE_FILAS_LOG.cargar(ids_op[0] if ids_op else [], carpetas[0] if carpetas else [],
+                            rids[0] if rids else [], clave)
 
-def aprobar_rendicion(row_idx, admin_user):
-    """Aprueba una rendición en PENDIENTE REVISIÓN.
 
-    Recalcula el estado usando la regla del Puchito y escribe las columnas
-    de auditoría (Revisado_Por, Fecha_Revision).
+def _resolver_claves(sh, ws, claves, rendicion_ids=()):
+    """Claves de fila / Rendicion_IDs → {clave: row_idx} vía INDICE_FILAS_LOG.
+
+    Si alguna clave no está en el índice (fila agregada por otro proceso) se
+    recarga una vez. Las claves que igual no aparecen quedan fuera.
+    """
+    with INDICE_FILAS_LOG.bloqueo():
+        recien_cargado = not INDICE_FILAS_LOG.vigente(sh.id)
+        if recien_cargado:
+            _cargar_indice_filas_log(ws, sh.id)
+        if not recien_cargado and (any(INDICE_FILAS_LOG.resolver(c) is None for c in claves) or
+                                   any(not INDICE_FILAS_LOG.filas_de_rendicion(r) for r in rendicion_ids)):
+            _cargar_indice_filas_log(ws, sh.id)
+        filas = {c: INDICE_FILAS_LOG.resolver(c) for c in claves}
+        for rid in rendicion_ids:
+            for f in INDICE_FILAS_LOG.filas_de_rendicion(rid):
+                filas.setdefault(f"@{f}", f)  # clave provisoria: se reemplaza al leer la fila
+    return {c: f for c, f in filas.items() if f}
+
+
+def _leer_filas_pendientes(sh, ws, claves, rendicion_ids=()):
+    """Resuelve las claves a filas, las lee en un solo batch_get y separa las que siguen pendientes.
+
+    Cada fila leída se verifica contra su clave (ID Operación + carpeta). Si no
+    coincide, el índice quedó viejo (filas insertadas u ordenadas): se recargan
+    solo las columnas de IDs y se relee lo que se movió, una vez.
+
+    Args:
+        claves: claves de fila (pend["clave"]).
+        rendicion_ids: además, todas las filas de estas rendiciones.
+
+    Returns:
+        (dict, dict): ({clave: (row_idx, fila)} pendientes, {clave: motivo} no procesables)
+    """
+    rendicion_ids = {str(r).strip() for r in rendicion_ids}
+    resultados = {c: "No se encontró la rendición en el log" for c in claves}
+    filas = _resolver_claves(sh, ws, claves, rendicion_ids)
+    leidas = {}
+    for intento in range(2):
+        if not filas:
+            break
+        rangos = ws.batch_get([f"A{f}:AQ{f}" for f in filas.values()])
+        movidas = {}
+        for (c, f), rango in zip(filas.items(), rangos):
+            row = list(rango[0] if rango else []) + [""] * 43
+            real = clave_fila(row[0], row[4])
+            if real == c or (c.startswith("@") and str(row[40]).strip() in rendicion_ids):
+                leidas[real] = (f, row)
+            else:
+                movidas[c] = f
+        if not movidas or intento:
+            break
+        logger.warning(f"Índice de filas del log desactualizado (v{INDICE_FILAS_LOG.version}): "
+                       f"{len(movidas)} fila(s) movidas, recargando IDs")
+        with INDICE_FILAS_LOG.bloqueo():
+            _cargar_indice_filas_log(ws, sh.id)
+        INDICE_PENDIENTES.invalidar()  # sus números de fila también quedaron viejos
+        ya_leidas = {f for f, _ in leidas.values()}
+        filas = {c: INDICE_FILAS_LOG.resolver(c) for c in movidas if not c.startswith("@")}
+        for rid in rendicion_ids:
+            for f in INDICE_FILAS_LOG.filas_de_rendicion(rid):
+                if f not in ya_leidas:
+                    filas.setdefault(f"@{f}", f)
+        filas = {c: f for c, f in filas.items() if f}
+
+    pendientes = {}
+    for c, (row_idx, row) in leidas.items():
+        resultados.pop(c, None)
+        estado_actual = str(row[28]).strip()
+        if estado_actual != ESTADO_PENDIENTE_REVISION:
+            INDICE_PENDIENTES.quitar(row_idx)
+            if c in claves:  # las de rendicion_ids que ya no están pendientes no se informan
+                revisado_por = str(row[34]).strip() or "desconocido"
+                resultados[c] = f"Esta rendición ya fue procesada (estado: {estado_actual}, por: {revisado_por})"
+        else:
+            pendientes[c] = (row_idx, row)
+    return pendientes, resultados
+
+
+def aprobar_rendiciones(claves, admin_user, rendicion_ids=()):
+    """Aprueba varias rendiciones en PENDIENTE REVISIÓN de una vez.
+
+    Las filas se ubican por clave (ID Operación + carpeta) o por Rendicion_ID
+    a través de INDICE_FILAS_LOG, no por número de fila. Verifica el estado de
+    todas con un batch_get y escribe Estado (regla del Puchito), Revisado_Por
+    y Fecha_Revision con un único batch_update. Las que ya no están
+    pendientes se saltean.
 
     Args:
-        row_idx: 1-based row index in RENDICIONES_LOG.
+        claves: claves de fila (pend["clave"]).
         admin_user: name of the admin who approved.
+        rendicion_ids: además, todas las filas pendientes de estas rendiciones.
 
     Returns:
-        (bool, str): (success, message)
+        (bool, str, dict): (éxito, mensaje, {clave: resultado por fila})
     """
+    claves = list(dict.fromkeys(claves))
+    if not claves and not rendicion_ids:
+        return True, "Nada para aprobar", {}
     try:
         _, sh = _get_sheet_handle()
         ws = sh.worksheet("RENDICIONES_LOG")
-
-        row = ws.row_values(row_idx)
-        estado_actual = str(row[28]).strip() if len(row) > 28 else ""
-        if estado_actual != "PENDIENTE REVISIÓN":
-            revisado_por = str(row[34]).strip() if len(row) > 34 else "desconocido"
-            return False, f"Esta rendición ya fue procesada (estado: {estado_actual}, por: {revisado_por})"
-
-        # Recalculate estado using Puchito rule
-        monto_ticket = safe_float(row[25])    # Z: Monto Total Ticket
-        monto_imputar = safe_float(row[26])   # AA: Monto a Imputar
-        saldo_pendiente = abs(monto_ticket - monto_imputar)
-
-        if saldo_pendiente == 0:
-            nuevo_estado = "CERRADO"
-        elif saldo_pendiente < 1000:
-            nuevo_estado = "LISTA PARA AJUSTE"
-        else:
-            nuevo_estado = "PENDIENTE"
+        pendientes, resultados = _leer_filas_pendientes(sh, ws, claves, rendicion_ids)
 
         fecha_rev = datetime.now().isoformat()
+        updates = []
+        nuevos_estados = {}
+        for c, (row_idx, row) in pendientes.items():
+            nuevos_estados[c] = _estado_aprobacion(row)
+            # Column letters reconciled with production layout:
+            # AC=Estado Saldos, AI=Revisado_Por, AN=Fecha_Revision
+            updates += [
+                {"range": f"AC{row_idx}", "values": [[nuevos_estados[c]]]},
+                {"range": f"AI{row_idx}", "values": [[admin_user]]},
+                {"range": f"AN{row_idx}", "values": [[fecha_rev]]},
+            ]
+        if updates:
+            ws.batch_update(updates)
+            _marcar_log_modificado(sh)
 
-        # Column letters reconciled with production layout:
-        # AC=Estado Saldos, AI=Revisado_Por, AN=Fecha_Revision
-        ws.batch_update([
-            {"range": f"AC{row_idx}", "values": [[nuevo_estado]]},
-            {"range": f"AI{row_idx}", "values": [[admin_user]]},
-            {"range": f"AN{row_idx}", "values": [[fecha_rev]]},
-        ])
-
-        logger.info(f"Rendición {row_idx} aprobada -> {nuevo_estado} por {admin_user}")
-        return True, f"Aprobada -> {nuevo_estado}"
+        for c, nuevo_estado in nuevos_estados.items():
+            INDICE_PENDIENTES.quitar(pendientes[c][0])
+            resultados[c] = f"Aprobada -> {nuevo_estado}"
+        logger.info(f"{len(nuevos_estados)} rendiciones aprobadas por {admin_user}: {sorted(nuevos_estados)}")
+        msg = f"{len(nuevos_estados)} aprobadas"
+        if len(resultados) > len(nuevos_estados):
+            msg += f", {len(resultados) - len(nuevos_estados)} no procesables"
+        return bool(nuevos_estados), msg, resultados
 
     except Exception as e:
-        logger.error(f"Error approving rendition {row_idx}: {e}")
-        return False, str(e)
+        logger.error(f"Error approving renditions {claves} {list(rendicion_ids)}: {e}")
+        return False, str(e), {}
 
 
-def rechazar_rendicion(row_idx, admin_user, motivo):
-    """Rechaza una rendición en PENDIENTE REVISIÓN.
+def rechazar_rendiciones(claves, admin_user, motivo, rendicion_ids=()):
+    """Rechaza varias rendiciones en PENDIENTE REVISIÓN de una vez.
 
-    Sets estado to RECHAZADO, writes motivo and audit columns.
-    Also reverts the imputación in CONTROL_SALDOS atomically.
+    Ubica las filas como aprobar_rendiciones. Un batch_get para verificar
+    estados, una sola reversión en lote de las imputaciones (un append al
+    ledger + una materialización) y un único batch_update del log. Si la
+    reversión falla, el log no se toca; si quedó en el ledger pero no se pudo
+    materializar, el log se actualiza igual y se devuelve False con el aviso.
 
     Args:
-        row_idx: 1-based row index in RENDICIONES_LOG.
+        claves: claves de fila (pend["clave"]).
         admin_user: name of the admin who rejected.
-        motivo: mandatory rejection reason.
+        motivo: mandatory rejection reason (el mismo para todas).
+        rendicion_ids: además, todas las filas pendientes de estas rendiciones.
 
     Returns:
-        (bool, str): (success, message)
+        (bool, str, dict): (éxito, mensaje, {clave: resultado por fila})
     """
+    claves = list(dict.fromkeys(claves))
+    if not claves and not rendicion_ids:
+        return True, "Nada para rechazar", {}
     try:
         _, sh = _get_sheet_handle()
         ws_log = sh.worksheet("RENDICIONES_LOG")
-
-        row = ws_log.row_values(row_idx)
-        estado_actual = str(row[28]).strip() if len(row) > 28 else ""
-        if estado_actual != "PENDIENTE REVISIÓN":
-            revisado_por = str(row[34]).strip() if len(row) > 34 else "desconocido"
-            return False, f"Esta rendición ya fue procesada (estado: {estado_actual}, por: {revisado_por})"
-
-        # Extract data needed to revert CONTROL_SALDOS
-        cuit = str(row[15]).strip()
-        suc_raw = str(row[11]).strip()
-        num_raw = str(row[12]).strip()
-        suc = suc_raw.zfill(5) if suc_raw.isdigit() else suc_raw
-        num = num_raw.zfill(8) if num_raw.isdigit() else num_raw
-        id_factura = f"{suc}{num}"
-        monto_a_revertir = safe_float(row[26])  # AA: Monto a Imputar
-
-        # Step 1: Revert CONTROL_SALDOS
-        revert_ok = _revertir_imputacion_saldos(sh, cuit, id_factura, monto_a_revertir)
-        if not revert_ok:
-            return False, "No se pudo revertir la imputación en CONTROL_SALDOS. El estado no fue modificado."
+        pendientes, resultados = _leer_filas_pendientes(sh, ws_log, claves, rendicion_ids)
+        if not pendientes:
+            return False, "Ninguna rendición seleccionada sigue pendiente", resultados
+
+        # Step 1: Revert CONTROL_SALDOS (todas juntas)
+        reversiones = [
+            _evento(EVENTO_REVERSION, str(row[15]).strip(), _id_factura(row[11], row[12]), 0.0,
+                    safe_float(row[26]),  # AA: Monto a Imputar
+                    rendicion_id=row[40], carpeta=row[4], origen="rechazo")
+            for _, row in pendientes.values()
+        ]
+        revertida, error_saldos = _revertir_imputaciones_saldos(sh, reversiones)
+        if not revertida:
+            return False, "No se pudo revertir la imputación en CONTROL_SALDOS. El estado no fue modificado.", resultados
 
         # Step 2: Update RENDICIONES_LOG (only if revert succeeded)
         fecha_rev = datetime.now().isoformat()
-        try:
+        updates = []
+        for row_idx, _ in pendientes.values():
             # Column letters reconciled with production layout:
             # AC=Estado Saldos, AH=Motivo_Rechazo, AI=Revisado_Por, AN=Fecha_Revision
-            ws_log.batch_update([
+            updates += [
                 {"range": f"AC{row_idx}", "values": [["RECHAZADO"]]},
                 {"range": f"AH{row_idx}", "values": [[motivo]]},
                 {"range": f"AI{row_idx}", "values": [[admin_user]]},
                 {"range": f"AN{row_idx}", "values": [[fecha_rev]]},
-            ])
+            ]
+        try:
+            ws_log.batch_update(updates)
+            _marcar_log_modificado(sh)
         except Exception as e:
             # Revert already happened — log the inconsistency
-            logger.error(f"CRITICAL: CONTROL_SALDOS reverted but RENDICIONES_LOG update failed for row {row_idx}: {e}")
-            return False, f"Se revirtió el saldo pero falló actualizar el log: {e}"
+            logger.error(f"CRITICAL: CONTROL_SALDOS reverted but RENDICIONES_LOG update failed for {sorted(pendientes)}: {e}")
+            return False, f"Se revirtió el saldo pero falló actualizar el log: {e}", resultados
+
+        for c, (row_idx, _) in pendientes.items():
+            INDICE_PENDIENTES.quitar(row_idx)
+            resultados[c] = ("Rechazada y saldo revertido" if not error_saldos else
+                             "Rechazada, pero CONTROL_SALDOS no se actualizó — ejecutá 'Recalcular Saldos'")
+        logger.info(f"{len(pendientes)} rendiciones rechazadas por {admin_user}: {motivo}")
+        if error_saldos:
+            return False, (f"{len(pendientes)} rechazadas y revertidas en el ledger, pero CONTROL_SALDOS "
+                           f"no se actualizó ({error_saldos}). Ejecutá 'Recalcular Saldos'."), resultados
+        msg = f"{len(pendientes)} rechazadas y saldos revertidos"
+        if len(resultados) > len(pendientes):
+            msg += f", {len(resultados) - len(pendientes)} no procesables"
+        return True, msg, resultados
+
+    except Exception as e:
+        logger.error(f"Error rejecting renditions {claves} {list(rendicion_ids)}: {e}")
+        return False, str(e), {}
+
+
+def aprobar_rendicion(clave, admin_user):
+    """Aprueba una rendición en PENDIENTE REVISIÓN.
+
+    Recalcula el estado usando la regla del Puchito y escribe las columnas
+    de auditoría (Revisado_Por, Fecha_Revision).
+
+    Args:
+        clave: clave de fila (ID Operación + carpeta, pend["clave"]).
+        admin_user: name of the admin who approved.
+
+    Returns:
+        (bool, str): (success, message)
+    """
+    ok, msg, resultados = aprobar_rendiciones([clave], admin_user)
+    return ok, resultados.get(clave, msg)
 
-        logger.info(f"Rendición {row_idx} rechazada por {admin_user}: {motivo}")
-        return True, "Rechazada y saldo revertido"
 
+def rechazar_rendicion(clave, admin_user, motivo):
+    """Rechaza una rendición en PENDIENTE REVISIÓN.
+
+    Sets estado to RECHAZADO, writes motivo and audit columns.
+    Also reverts the imputación in CONTROL_SALDOS atomically.
+
+    Args:
+        clave: clave de fila (ID Operación + carpeta, pend["clave"]).
+        admin_user: name of the admin who rejected.
+        motivo: mandatory rejection reason.
+
+    Returns:
+        (bool, str): (success, message)
+    """
+    ok, msg, resultados = rechazar_rendiciones([clave], admin_user, motivo)
+    return ok, resultados.get(clave, msg)
+
+
+def _revertir_imputaciones_saldos(sh, reversiones):
+    """Reverts imputaciones: appends the REVERSION events and re-materializes (one batch each).
+
+    Returns:
+        (bool, str): (reversión registrada en el ledger, error al materializar
+        CONTROL_SALDOS o "" si se actualizó). Con la reversión ya en el ledger
+        el rechazo no se puede deshacer (reintentarlo la duplicaría): el caller
+        sigue con el log y reporta el error de materialización.
+    """
+    try:
+        ok, msg = registrar_eventos_ledger(reversiones, sh=sh)
+        if not ok:
+            logger.error(f"Error reverting CONTROL_SALDOS: {msg}")
+            return False, msg
     except Exception as e:
-        logger.error(f"Error rejecting rendition {row_idx}: {e}")
+        logger.error(f"Error reverting CONTROL_SALDOS: {e}")
         return False, str(e)
 
+    try:
+        ok, msg = materializar_saldos(reversiones, sh=sh)
+    except Exception as e:
+        ok, msg = False, str(e)
+    if not ok:
+        # El ledger ya tiene la reversión: "Recalcular Saldos" la materializa
+        logger.error(f"Reversión registrada en ledger pero CONTROL_SALDOS no se actualizó: {msg}")
+        return True, msg
+    return True, ""
 
-def _revertir_imputacion_saldos(sh, cuit, id_factura, monto_a_revertir):
-    """Reverts an imputación in CONTROL_SALDOS by subtracting the amount.
 
-    Returns True on success, False on failure.
+# ==========================================
+# 4b. LEDGER DE IMPUTACIONES (append-only)
+# ==========================================
+# Fuente de verdad de los saldos: cada save agrega eventos IMPUTACION (un
+# append por save) y cada rechazo un evento REVERSION. CONTROL_SALDOS es una
+# vista materializada: se actualiza incrementalmente con los eventos nuevos y
+# recalcular_control_saldos la reconstruye con un fold sobre el ledger.
+
+LEDGER_SHEET = "IMPUTACIONES_LEDGER"
+LEDGER_STAGING_SHEET = "IMPUTACIONES_LEDGER_SIEMBRA"
+LEDGER_HEADERS = ["ID_Evento", "Fecha_Evento", "Tipo_Evento", "Cuit_Proveedor", "ID Factura",
+                  "Respaldo", "Monto", "Rendicion_ID", "Carpeta", "Origen"]
+EVENTO_IMPUTACION = "IMPUTACION"
+EVENTO_REVERSION = "REVERSION"
+
+
+def crear_hoja_ledger(sh):
+    """Creates IMPUTACIONES_LEDGER if it doesn't exist. Returns (worksheet, creada).
+
+    Al crearla la siembra desde RENDICIONES_LOG, así el ledger arranca con la
+    historia completa antes del primer evento nuevo. La siembra se hace en
+    LEDGER_STAGING_SHEET y se renombra recién cuando el append terminó: si
+    falla, IMPUTACIONES_LEDGER sigue sin existir y la próxima llamada vuelve
+    a sembrar desde cero (nunca queda un ledger con solo el header).
     """
     try:
-        ws = sh.worksheet("CONTROL_SALDOS")
-        all_values = ws.get_all_values()
+        return sh.worksheet(LEDGER_SHEET), False
+    except gspread.exceptions.WorksheetNotFound:
+        pass
+    try:
+        sh.del_worksheet(sh.worksheet(LEDGER_STAGING_SHEET))
+        logger.info(f"{LEDGER_STAGING_SHEET}: siembra anterior incompleta descartada")
+    except gspread.exceptions.WorksheetNotFound:
+        pass
+    ws = sh.add_worksheet(title=LEDGER_STAGING_SHEET, rows=1000, cols=len(LEDGER_HEADERS))
+    ws.update(range_name="A1:J1", values=[LEDGER_HEADERS])
+    _sembrar_ledger_desde_log(sh, ws)
+    ws.update_title(LEDGER_SHEET)
+    logger.info(f"{LEDGER_SHEET} created")
+    return ws, True
+
+
+def _id_factura(sucursal, numero):
+    """ID Factura = sucursal (5) + número (8), con padding solo si son numéricos."""
+    suc_raw = str(sucursal or "").strip()
+    num_raw = str(numero or "").strip()
+    suc = suc_raw.zfill(5) if suc_raw.isdigit() else suc_raw
+    num = num_raw.zfill(8) if num_raw.isdigit() else num_raw
+    return f"{suc}{num}"
+
+
+def _evento(tipo, cuit, id_factura, respaldo, monto, rendicion_id="", carpeta="", origen=""):
+    import uuid
+    return {
+        "id_evento": uuid.uuid4().hex[:12].upper(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "tipo": tipo,
+        "cuit": str(cuit).strip(),
+        "id_factura": str(id_factura).strip(),
+        "respaldo": round(safe_float(respaldo), 2),
+        "monto": round(safe_float(monto), 2),
+        "rendicion_id": str(rendicion_id or ""),
+        "carpeta": str(carpeta or ""),
+        "origen": origen,
+    }
+
+
+def _respaldo_factura(tipo, neto, no_gravado, total):
+    """Respaldo de la factura: A → neto + no gravado; resto → total del ticket."""
+    if str(tipo).strip().upper() == "A":
+        return safe_float(neto) + safe_float(no_gravado)
+    return safe_float(total)
+
+
+def eventos_imputacion(payloads, origen="guardado"):
+    """Payloads de log_rendicion_to_sheet → eventos IMPUTACION (sin I/O)."""
+    eventos = []
+    for payload in payloads:
+        cuit = str(payload.get("proveedor_cuit", "")).strip()
+        id_factura = _id_factura(payload.get("sucursal_factura"), payload.get("numero_factura"))
+        if not cuit or not id_factura or id_factura == "0000000000000":
+            continue
+        respaldo = _respaldo_factura(payload.get("tipo_factura", ""), payload.get("monto_neto_original", 0),
+                                     payload.get("no_gravado_original", 0),
+                                     payload.get("monto_ticket_total_original", 0))
+        eventos.append(_evento(EVENTO_IMPUTACION, cuit, id_factura, respaldo,
+                               payload.get("monto_a_imputar", 0),
+                               rendicion_id=payload.get("rendicion_id", ""),
+                               carpeta=payload.get("numero_carpeta", ""), origen=origen))
+    return eventos
 
-        for i, row in enumerate(all_values):
-            if i == 0:
-                continue
-            if len(row) < 2:
+
+def _evento_a_fila(ev):
+    return [ev["id_evento"], ev["fecha"], ev["tipo"], ev["cuit"], ev["id_factura"],
+            ev["respaldo"], ev["monto"], ev["rendicion_id"], ev["carpeta"], ev["origen"]]
+
+
+def _fila_a_evento(row):
+    row = list(row) + [""] * (len(LEDGER_HEADERS) - len(row))
+    return {
+        "id_evento": row[0], "fecha": row[1], "tipo": str(row[2]).strip().upper(),
+        "cuit": str(row[3]).strip(), "id_factura": str(row[4]).strip(),
+        "respaldo": safe_float(row[5]), "monto": safe_float(row[6]),
+        "rendicion_id": row[7], "carpeta": row[8], "origen": row[9],
+    }
+
+
+def plegar_ledger(eventos, saldos=None):
+    """Fold de eventos sobre saldos por (cuit, id_factura).
+
+    Args:
+        eventos: eventos en orden de ledger. Un ID_Evento repetido (append
+            reintentado después de un éxito no registrado) se cuenta una vez.
+        saldos: estado inicial (incremental); None = desde cero.
+
+    Returns:
+        dict: (cuit, id_factura) → {"respaldo", "imputado", "imputada"}.
+        "imputada" indica si la factura tuvo al menos una IMPUTACION.
+    """
+    saldos = {} if saldos is None else saldos
+    vistos = set()
+    for ev in eventos:
+        if ev["id_evento"]:
+            if ev["id_evento"] in vistos:
                 continue
-            row_cuit = str(row[0]).strip()
-            row_id = str(row[1]).strip()
-            if row_cuit == cuit and row_id == id_factura:
-                fila_idx = i + 1
-                respaldo = safe_float(row[2]) if len(row) > 2 else 0.0
-                total_imputado = safe_float(row[3]) if len(row) > 3 else 0.0
-
-                total_imputado = max(0, total_imputado - monto_a_revertir)
-                saldo = respaldo - total_imputado
-                estado = _calcular_estado_saldo(saldo)
+            vistos.add(ev["id_evento"])
+        k = (ev["cuit"], ev["id_factura"])
+        sal = saldos.setdefault(k, {"respaldo": 0.0, "imputado": 0.0, "imputada": False})
+        if ev["tipo"] == EVENTO_IMPUTACION:
+            if not sal["imputada"]:
+                sal["respaldo"] = ev["respaldo"]  # la primera imputación fija el respaldo
+            sal["imputada"] = True
+            sal["imputado"] += ev["monto"]
+        elif ev["tipo"] == EVENTO_REVERSION:
+            sal["imputado"] = max(0.0, sal["imputado"] - ev["monto"])
+    return saldos
 
-                ws.batch_update([
-                    {"range": f"D{fila_idx}", "values": [[round(total_imputado, 2)]]},
-                    {"range": f"E{fila_idx}", "values": [[round(saldo, 2)]]},
-                    {"range": f"F{fila_idx}", "values": [[estado]]},
-                ])
-                logger.info(f"CONTROL_SALDOS reverted: {id_factura} imputado={total_imputado} saldo={saldo}")
-                return True
 
-        # No matching row found — might be a manual entry without CONTROL_SALDOS
-        logger.warning(f"No CONTROL_SALDOS row for CUIT={cuit} ID={id_factura} — skipping revert")
-        return True  # Not an error, just no balance row to revert
+def leer_ledger(sh):
+    """Todos los eventos del ledger, en orden."""
+    ws, _ = crear_hoja_ledger(sh)
+    valores = ws.get_all_values()
+    return [_fila_a_evento(r) for r in valores[1:] if len(r) > 4 and r[0]]
 
+
+def registrar_eventos_ledger(eventos, sh=None):
+    """Agrega los eventos al ledger con un único append (sin leer nada).
+
+    Returns:
+        (bool, str): (éxito, mensaje)
+    """
+    if not eventos:
+        return True, "Sin eventos"
+    try:
+        if sh is None:
+            _, sh = _get_sheet_handle()
+        ws, creada = crear_hoja_ledger(sh)
+        if creada:
+            # La siembra ya leyó RENDICIONES_LOG, que incluye las filas de este
+            # guardado (se loguean antes): solo faltan las reversiones.
+            eventos = [ev for ev in eventos if ev["tipo"] == EVENTO_REVERSION]
+            if not eventos:
+                return True, "Ledger sembrado desde RENDICIONES_LOG"
+        ws.append_rows([_evento_a_fila(ev) for ev in eventos], value_input_option="RAW")
+        return True, f"{len(eventos)} evento(s) en ledger"
     except Exception as e:
-        logger.error(f"Error reverting CONTROL_SALDOS: {e}")
-        return False
+        logger.error(f"Error escribiendo {LEDGER_SHEET}: {e}")
+        return False, str(e)
+
+
+def materializar_saldos(eventos, sh=None):
+    """Materializa en CONTROL_SALDOS las facturas afectadas por `eventos`.
+
+    Los valores salen del fold del ledger (que ya tiene `eventos`) para esas
+    facturas, no del índice más los eventos: se escriben absolutos, así que
+    reintentarlo después de un éxito no registrado no imputa dos veces. El
+    índice de filas solo ubica la fila (no lee CONTROL_SALDOS salvo para
+    cargarlo). Un único batch_update.
+
+    Returns:
+        (bool, str): (éxito, mensaje)
+    """
+    if not eventos:
+        return True, "Sin eventos"
+    try:
+        if sh is None:
+            _, sh = _get_sheet_handle()
+        ws = sh.worksheet("CONTROL_SALDOS")
+        afectadas = {(ev["cuit"], ev["id_factura"]) for ev in eventos}
+        saldos = plegar_ledger(ev for ev in leer_ledger(sh) if (ev["cuit"], ev["id_factura"]) in afectadas)
+
+        with INDICE_SALDOS.bloqueo():
+            INDICE_SALDOS.asegurar(ws, sh.id)
+
+            updates, nuevas, mensajes = [], [], []
+            proxima = INDICE_SALDOS.proxima_fila()
+            for (cuit, id_factura), sal in saldos.items():
+                entrada = INDICE_SALDOS.buscar(cuit, id_factura)
+                if not entrada and not sal["imputada"]:
+                    logger.warning(f"No CONTROL_SALDOS row for CUIT={cuit} ID={id_factura} — skipping revert")
+                    continue
+                saldo = sal["respaldo"] - sal["imputado"]
+                estado = _calcular_estado_saldo(saldo)
+                mensajes.append(f"{id_factura} -> {estado} (${saldo:,.2f})")
+                if entrada:
+                    updates.append({"range": f"D{entrada['fila']}:F{entrada['fila']}",
+                                    "values": [[round(sal["imputado"], 2), round(saldo, 2), estado]]})
+                else:
+                    nuevas.append((cuit, id_factura, proxima + len(nuevas), sal,
+                                   [cuit, id_factura, round(sal["respaldo"], 2), round(sal["imputado"], 2),
+                                    round(saldo, 2), estado]))
+            if nuevas:
+                # Filas nuevas contiguas al final: un solo rango
+                updates.append({"range": f"A{nuevas[0][2]}:F{nuevas[-1][2]}", "values": [n[4] for n in nuevas]})
+
+            try:
+                if updates:
+                    ws.batch_update(updates)
+            except Exception:
+                INDICE_SALDOS.invalidar()
+                raise
+            for (cuit, id_factura), sal in saldos.items():
+                INDICE_SALDOS.actualizar(cuit, id_factura, imputado=sal["imputado"])
+            for cuit, id_factura, fila, sal, _ in nuevas:
+                INDICE_SALDOS.agregar(cuit, id_factura, fila, sal["respaldo"], sal["imputado"])
+
+        return True, "Saldo actualizado: " + "; ".join(mensajes) if mensajes else "Sin cambios"
+    except Exception as e:
+        logger.error(f"Error actualizando CONTROL_SALDOS: {e}")
+        return False, str(e)
+
+
+def _sembrar_ledger_desde_log(sh, ws_ledger):
+    """Primera vez: genera eventos IMPUTACION desde RENDICIONES_LOG.
+
+    Las filas RECHAZADO no se siembran (su imputación ya fue revertida).
+    """
+    all_records = sh.worksheet("RENDICIONES_LOG").get_all_records()
+    eventos = []
+    for record in all_records:
+        if str(record.get("Estado Saldos", "")).strip().upper() == "RECHAZADO":
+            continue
+        cuit = str(record.get("Cuit_Proveedor_AI", "")).strip()
+        id_factura = _id_factura(record.get("Sucursal", ""), record.get("Número_de_factura", ""))
+        if not cuit or not id_factura or id_factura == "0000000000000":
+            continue
+        # Uses REAL header names from production sheet
+        respaldo = _respaldo_factura(record.get("factura_tipo", ""), record.get("Gravado", 0),
+                                     record.get("No_Gravado", 0), record.get("Monto Ticket", 0))
+        eventos.append(_evento(EVENTO_IMPUTACION, cuit, id_factura, respaldo,
+                               record.get("Monto a Imputar", 0),
+                               rendicion_id=record.get("Rendicion_ID", ""),
+                               carpeta=record.get("Número de Carpeta (Obligatorio)", ""), origen="migracion"))
+    if eventos:
+        ws_ledger.append_rows([_evento_a_fila(ev) for ev in eventos], value_input_option="RAW")
+        logger.info(f"{LEDGER_SHEET} sembrado con {len(eventos)} eventos desde RENDICIONES_LOG")
+    return eventos
 
 
 # ==========================================
 # 5. EXPORTACIÓN DUX
 # ==========================================
 
-from dux_export import (agrupar_por_comprobante, generar_filas_dux, DUX_HEADERS,
-                        safe_float, validar_rendiciones_para_export)
+import almacen_local
+from indices import INDICE_EXPORTADOS, INDICE_FILAS_LOG, INDICE_PENDIENTES, INDICE_SALDOS, clave_fila
+from dux_export import (agrupar_por_comprobante, generar_filas_dux, iterar_filas_dux, DUX_HEADERS,
+                        exportar_csv_dux, exportar_excel_dux, safe_float, safe_int, tabla_codigos,
+                        validar_rendiciones_para_export)
 
 
 # Maps REAL production headers → internal keys used by dux_export and business logic.
@@ -1690,10 +2124,34 @@ SHEET_KEY_MAP = {
 }
 
 
+# State filter: always exclude PENDIENTE REVISIÓN and RECHAZADO
+ESTADOS_EXCLUIDOS_EXPORT = {"PENDIENTE REVISIÓN", "RECHAZADO"}
+# Mode A: only terminal states
+ESTADOS_TERMINALES_EXPORT = {"CERRADO", "LISTA PARA AJUSTE"}
+
+
+def _exportable(rend, modo_parcial):
+    estado = str(rend.get("estado", "")).strip().upper()
+    if estado in ESTADOS_EXCLUIDOS_EXPORT:
+        return False
+    return modo_parcial or estado in ESTADOS_TERMINALES_EXPORT
+
+
+def _mapear_fila_log(row, fila_log):
+    """Fila posicional de RENDICIONES_LOG (A..AQ) → dict con claves internas."""
+    rend = {internal_key: (row[i] if i < len(row) else "")
+            for i, internal_key in enumerate(SHEET_KEY_MAP.values())}
+    rend["fila_log"] = fila_log
+    rend["clave"] = clave_fila(rend["id_operacion"], rend["numero_carpeta"])
+    return rend
+
+
 def _leer_y_filtrar_rendiciones(fecha_desde=None, fecha_hasta=None,
                                  modo_parcial=False, fecha_inicio_dux=""):
     """Reads RENDICIONES_LOG, maps to internal keys, and applies filters.
 
+    Each dict also carries "fila_log" (1-based row) and "clave" (clave_fila).
+
     Returns:
         list[dict] or None: filtered renditions, or None on error.
     """
@@ -1708,10 +2166,12 @@ def _leer_y_filtrar_rendiciones(fecha_desde=None, fecha_hasta=None,
         return None
 
     rendiciones = []
-    for record in all_records:
+    for i, record in enumerate(all_records):
         mapped = {}
         for sheet_key, internal_key in SHEET_KEY_MAP.items():
             mapped[internal_key] = record.get(sheet_key, "")
+        mapped["fila_log"] = i + 2
+        mapped["clave"] = clave_fila(mapped["id_operacion"], mapped["numero_carpeta"])
         rendiciones.append(mapped)
 
     # Date cutoff from CONFIG_EMPRESA
@@ -1729,63 +2189,539 @@ def _leer_y_filtrar_rendiciones(fecha_desde=None, fecha_hasta=None,
         rendiciones = [r for r in rendiciones
                        if str(r.get("fecha", ""))[:10] <= fecha_hasta_str]
 
-    # State filter: always exclude PENDIENTE REVISIÓN and RECHAZADO
-    EXCLUIR = {"PENDIENTE REVISIÓN", "RECHAZADO"}
-    rendiciones = [r for r in rendiciones
-                   if str(r.get("estado", "")).strip().upper() not in EXCLUIR]
+    # State + mode filter
+    return [r for r in rendiciones if _exportable(r, modo_parcial)]
 
-    # Mode filter
-    if not modo_parcial:
-        # Mode A: only terminal states
-        ESTADOS_TERMINALES = {"CERRADO", "LISTA PARA AJUSTE"}
-        rendiciones = [r for r in rendiciones
-                       if str(r.get("estado", "")).strip().upper() in ESTADOS_TERMINALES]
 
-    return rendiciones
+# ==========================================
+# 5b. LOTES DE EXPORT DUX
+# ==========================================
+# Cada export registra un lote en EXPORT_DUX_LOTES y en EXPORT_DUX_ITEMS las
+# claves de fila (ID Operación + carpeta) que exportó por primera vez. El
+# modo "solo nuevas" no depende de números de fila (el log se puede ordenar o
+# tener filas insertadas): lee solo las columnas de clave, fecha y estado,
+# descarta lo ya exportado según INDICE_EXPORTADOS y lo que todavía no es
+# exportable por estado, y trae completas únicamente las filas que quedan.
+# ITEMS crece con las filas exportadas, no con la cantidad de exports, y el
+# índice lee solo su cola al vencer el TTL.
+
+LOTES_EXPORT_SHEET = "EXPORT_DUX_LOTES"
+LOTES_EXPORT_HEADERS = ["ID_Lote", "Fecha", "Modo", "Diferidas", "Filas_ENC_DET",
+                        "Rendiciones", "Desde", "Hasta"]
+ITEMS_EXPORT_SHEET = "EXPORT_DUX_ITEMS"
+ITEMS_EXPORT_HEADERS = ["ID_Lote", "Clave_Fila", "Fila_Log", "Estado"]
+# Columnas del log que alcanzan para decidir qué filas leer completas
+RANGOS_CLAVES_LOG = ["A2:A", "B2:B", "E2:E", "AC2:AC"]  # ID, fecha, carpeta, estado
+
+
+def crear_hojas_lotes_export(sh):
+    """Creates EXPORT_DUX_LOTES / EXPORT_DUX_ITEMS if missing. Returns (ws_lotes, ws_items)."""
+    hojas = []
+    for nombre, headers in ((LOTES_EXPORT_SHEET, LOTES_EXPORT_HEADERS),
+                            (ITEMS_EXPORT_SHEET, ITEMS_EXPORT_HEADERS)):
+        try:
+            hojas.append(sh.worksheet(nombre))
+        except gspread.exceptions.WorksheetNotFound:
+            ws = sh.add_worksheet(title=nombre, rows=1000, cols=len(headers))
+            ws.update(range_name="A1", values=[headers])
+            logger.info(f"{nombre} created")
+            hojas.append(ws)
+    return tuple(hojas)
+
+
+def _asegurar_indice_exportados(sh):
+    """Carga INDICE_EXPORTADOS si no está vigente: completo la primera vez,
+    después solo las filas de EXPORT_DUX_ITEMS agregadas desde la última lectura."""
+    with INDICE_EXPORTADOS.bloqueo():
+        if INDICE_EXPORTADOS.vigente(sh.id):
+            return
+        _, ws_items = crear_hojas_lotes_export(sh)
+        incremental = INDICE_EXPORTADOS.cargado_para(sh.id)
+        if incremental:
+            desde = INDICE_EXPORTADOS.filas_leidas + 1
+            valores = ws_items.get(f"A{desde}:D") if desde <= ws_items.row_count else []
+            filas_leidas = INDICE_EXPORTADOS.filas_leidas + len(valores)
+        else:
+            valores = ws_items.get_all_values()
+            filas_leidas = len(valores)
+            valores = valores[1:]
+        items = [(r[1], r[3]) for r in valores if len(r) >= 4 and r[1]]
+        INDICE_EXPORTADOS.cargar(items, filas_leidas, sh.id, incremental=incremental)
+
+
+def _rangos_contiguos(filas):
+    """[3, 4, 5, 9] → ["A3:AQ5", "A9:AQ9"] (filas ordenadas)."""
+    rangos, inicio = [], None
+    for i, f in enumerate(filas):
+        if inicio is None:
+            inicio = f
+        if i + 1 == len(filas) or filas[i + 1] != f + 1:
+            rangos.append((inicio, f))
+            inicio = None
+    return rangos
+
+
+def _leer_rendiciones_nuevas(sh, modo_parcial=False, fecha_inicio_dux=""):
+    """Filas del log que no salieron en ningún lote y ya son exportables.
+
+    Returns:
+        dict: rendiciones (exportables ahora), diferidas (cuántas no
+        exportadas siguen sin estado exportable).
+    """
+    _asegurar_indice_exportados(sh)
+    ws_log = sh.worksheet("RENDICIONES_LOG")
+
+    # 1. Columnas de clave/fecha/estado → filas a leer completas
+    columnas = [(c[0] if c else []) for c in ws_log.batch_get(RANGOS_CLAVES_LOG, major_dimension="COLUMNS")]
+    ids, fechas, carpetas, estados = (list(c) for c in columnas)
+    n = len(ids)
+    filas, diferidas = [], 0
+    for i in range(n):
+        id_op = str(ids[i]).strip()
+        carpeta = carpetas[i] if i < len(carpetas) else ""
+        if not id_op or INDICE_EXPORTADOS.exportada(clave_fila(id_op, carpeta)):
+            continue
+        if fecha_inicio_dux and str(fechas[i] if i < len(fechas) else "")[:10] < fecha_inicio_dux:
+            continue
+        estado = estados[i] if i < len(estados) else ""
+        if not _exportable({"estado": estado}, modo_parcial):
+            diferidas += str(estado).strip().upper() != "RECHAZADO"
+            continue
+        filas.append(i + 2)
+
+    # 2. Filas completas: un batch_get por tanda de rangos contiguos
+    rendiciones = []
+    rangos = _rangos_contiguos(filas)
+    for inicio in range(0, len(rangos), MAX_FILAS_BATCH_GET):
+        tanda = rangos[inicio:inicio + MAX_FILAS_BATCH_GET]
+        valores = ws_log.batch_get([f"A{a}:AQ{b}" for a, b in tanda])
+        for (a, _), bloque in zip(tanda, valores):
+            for j, row in enumerate(bloque):
+                rend = _mapear_fila_log(row, a + j)
+                # Entre las dos lecturas la fila pudo cambiar de estado
+                if not INDICE_EXPORTADOS.exportada(rend["clave"]) and _exportable(rend, modo_parcial):
+                    rendiciones.append(rend)
+    logger.info(f"Dux export incremental: {n} filas revisadas por clave, {len(filas)} leídas completas "
+                f"→ {len(rendiciones)} exportables, {diferidas} diferidas por estado")
+    return {"rendiciones": rendiciones, "diferidas": diferidas}
+
+
+def _seleccionar_rendiciones_export(fecha_desde=None, fecha_hasta=None, modo_parcial=False,
+                                    fecha_inicio_dux="", solo_nuevas=False):
+    """Rendiciones a exportar + datos del lote. None si falla la lectura.
+
+    Con solo_nuevas=True ignora el rango de fechas y toma lo no exportado
+    en ningún lote anterior (ver _leer_rendiciones_nuevas).
+    """
+    if not solo_nuevas:
+        rendiciones = _leer_y_filtrar_rendiciones(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux)
+        if rendiciones is None:
+            return None
+        return {"rendiciones": rendiciones, "diferidas": 0}
+    try:
+        _, sh = _get_sheet_handle()
+        return _leer_rendiciones_nuevas(sh, modo_parcial, fecha_inicio_dux)
+    except Exception as e:
+        logger.error(f"Error reading new renditions for export: {e}")
+        return None
+
+
+def registrar_lote_export(seleccion, n_filas, modo, fecha_desde=None, fecha_hasta=None):
+    """Registra un export: una fila en EXPORT_DUX_LOTES y en EXPORT_DUX_ITEMS
+    las claves exportadas por primera vez (re-exportar un período no las repite).
+
+    Args:
+        seleccion: salida de _seleccionar_rendiciones_export.
+        n_filas: filas ENC/DET generadas.
+        modo: "periodo" o "nuevas".
+
+    Returns:
+        str: ID del lote ("" si no se pudo registrar; el export igual se hizo).
+    """
+    import uuid
+    try:
+        _, sh = _get_sheet_handle()
+        _asegurar_indice_exportados(sh)
+        ws_lotes, ws_items = crear_hojas_lotes_export(sh)
+        lote_id = f"DUX-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4].upper()}"
+        nuevas = {}
+        for r in seleccion["rendiciones"]:
+            if not INDICE_EXPORTADOS.exportada(r["clave"]):
+                nuevas.setdefault(r["clave"], r["fila_log"])
+        if nuevas:
+            ws_items.append_rows([[lote_id, c, f, INDICE_EXPORTADOS.EXPORTADA] for c, f in nuevas.items()],
+                                 value_input_option="RAW")
+        ws_lotes.append_row([
+            lote_id, datetime.now().isoformat(timespec="seconds"), modo, seleccion.get("diferidas", 0), n_filas,
+            len(seleccion["rendiciones"]),
+            fecha_desde.isoformat() if fecha_desde else "", fecha_hasta.isoformat() if fecha_hasta else "",
+        ], value_input_option="RAW")
+        INDICE_EXPORTADOS.registrar(nuevas)
+        logger.info(f"Lote Dux {lote_id}: {len(seleccion['rendiciones'])} rendiciones, "
+                    f"{len(nuevas)} exportadas por primera vez")
+        return lote_id
+    except Exception as e:
+        INDICE_EXPORTADOS.invalidar()
+        logger.error(f"Error registrando lote de export Dux: {e}")
+        return ""
+
+
+# ==========================================
+# 5c. SNAPSHOT VALIDACIÓN → EXPORT
+# ==========================================
+# "Validar" guarda lo que validó (rendiciones filtradas + tablas de códigos +
+# CUITs propios) bajo un token. El export con ese token reutiliza el snapshot
+# si los filtros son los mismos, no venció y RENDICIONES_LOG no cambió: una
+# sola lectura del log sirve a los dos pasos y lo exportado es exactamente lo
+# validado. El chequeo no lee la planilla: compara la marca de versión del log
+# (almacen_local) que renuevan log_rendicion_to_sheet, aprobar/rechazar y la
+# revalidación de proveedores. Una edición a mano en la hoja no la renueva:
+# para eso se vuelve a "Validar" (siempre relee) y el TTL acota la ventana.
+# Si algo cambió, el export relee.
+
+SNAPSHOT_TTL_SEGUNDOS = 600
+MAX_SNAPSHOTS_EXPORT = 8
+
+_snapshots_export = OrderedDict()
+_lock_snapshots = threading.Lock()
+
+
+def _clave_version_log(sh):
+    return f"version_rendiciones_log:{sh.id}"
+
+
+def _marcar_log_modificado(sh):
+    """Renueva la marca de versión del log (token nuevo: sin incrementos que se pisen)."""
+    import uuid
+    try:
+        almacen_local.guardar_valor(_clave_version_log(sh), uuid.uuid4().hex[:12])
+    except Exception as e:
+        logger.warning(f"No se pudo renovar la versión de RENDICIONES_LOG: {e}")
+
+
+def _version_log(sh):
+    return almacen_local.leer_valor(_clave_version_log(sh), "")
+
+
+def _huella_tablas(tabla_conceptos, tabla_empleados, cuits_propios):
+    datos = [sorted(tabla_conceptos.items()), sorted(tabla_empleados.items()), sorted(cuits_propios)]
+    return hashlib.sha1(json.dumps(datos, ensure_ascii=False).encode()).hexdigest()[:12]
+
+
+def _params_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas):
+    return (fecha_desde.isoformat() if fecha_desde else "", fecha_hasta.isoformat() if fecha_hasta else "",
+            bool(modo_parcial), fecha_inicio_dux, bool(solo_nuevas))
+
+
+def _leer_datos_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas):
+    """Selección + tablas de códigos + CUITs propios. None si falla la lectura del log."""
+    seleccion = _seleccionar_rendiciones_export(fecha_desde, fecha_hasta, modo_parcial,
+                                                fecha_inicio_dux, solo_nuevas)
+    if seleccion is None:
+        return None
+    tabla_conceptos, tabla_empleados = tablas_codigos_dux()
+    return {"seleccion": seleccion, "tabla_conceptos": tabla_conceptos,
+            "tabla_empleados": tabla_empleados, "cuits_propios": get_cuits_propios()}
+
+
+def _guardar_snapshot_export(params, version_log, datos):
+    import uuid
+    token = uuid.uuid4().hex[:12]
+    snapshot = dict(datos, params=params, version_log=version_log, creado=time.monotonic(),
+                    version_lotes=INDICE_EXPORTADOS.version,
+                    version_tablas=_huella_tablas(datos["tabla_conceptos"], datos["tabla_empleados"],
+                                                  datos["cuits_propios"]))
+    with _lock_snapshots:
+        _snapshots_export[token] = snapshot
+        while len(_snapshots_export) > MAX_SNAPSHOTS_EXPORT:
+            _snapshots_export.popitem(last=False)
+    logger.info(f"Snapshot export Dux {token}: {len(datos['seleccion']['rendiciones'])} rendiciones, "
+                f"tablas {snapshot['version_tablas']}")
+    return token
+
+
+def descartar_snapshot_export(token):
+    with _lock_snapshots:
+        _snapshots_export.pop(token, None)
+
+
+def _snapshot_export_vigente(token, params):
+    """El snapshot del token si todavía describe la planilla; None si hay que releer."""
+    with _lock_snapshots:
+        snapshot = _snapshots_export.get(token)
+    if snapshot is None:
+        return None
+    motivo = ""
+    if snapshot["params"] != params:
+        motivo = "cambiaron los filtros"
+    elif time.monotonic() - snapshot["creado"] > SNAPSHOT_TTL_SEGUNDOS:
+        motivo = "venció"
+    elif params[-1] and snapshot["version_lotes"] != INDICE_EXPORTADOS.version:
+        motivo = "se registró otro lote"
+    else:
+        try:
+            _, sh = _get_sheet_handle()
+            if _version_log(sh) != snapshot["version_log"]:
+                motivo = "RENDICIONES_LOG cambió"
+        except Exception as e:
+            motivo = f"no se pudo verificar la versión del log ({e})"
+    if motivo:
+        logger.info(f"Snapshot export Dux {token} descartado: {motivo} — se relee")
+        descartar_snapshot_export(token)
+        return None
+    return snapshot
+
+
+def _datos_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas, snapshot=None):
+    """Datos del export: los del snapshot validado si sigue vigente, o una lectura nueva."""
+    if snapshot:
+        params = _params_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas)
+        vigente = _snapshot_export_vigente(snapshot, params)
+        if vigente is not None:
+            logger.info(f"Dux export: reutilizando snapshot validado {snapshot}")
+            return vigente
+    return _leer_datos_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas)
 
 
 def validar_rendiciones_pre_export(fecha_desde=None, fecha_hasta=None,
-                                    modo_parcial=False, fecha_inicio_dux=""):
-    """Pre-export validation.
+                                    modo_parcial=False, fecha_inicio_dux="", solo_nuevas=False):
+    """Pre-export validation (solo_nuevas: lo no exportado desde el último lote).
 
     Returns:
         None: on read failure.
         str: early-exit message (no data, missing config).
-        (list, list): (errores, warnings) — errores block export, warnings don't.
+        (list, list, str): (errores, warnings, snapshot) — errores block export,
+            warnings don't. snapshot es el token para pasarle al export ("" si
+            hay errores).
     """
     if not fecha_inicio_dux:
         return "Configurar FECHA_INICIO_EXPORT_DUX en CONFIG_EMPRESA antes del primer export."
 
-    rendiciones = _leer_y_filtrar_rendiciones(fecha_desde, fecha_hasta,
-                                               modo_parcial, fecha_inicio_dux)
-    if rendiciones is None:
+    params = _params_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas)
+    try:
+        # Versión antes de leer: una escritura en el medio invalida el snapshot
+        _, sh = _get_sheet_handle()
+        version_log = _version_log(sh)
+    except Exception as e:
+        logger.warning(f"Sin versión de RENDICIONES_LOG, el export va a releer: {e}")
+        version_log = None
+
+    datos = _leer_datos_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas)
+    if datos is None:
         return None
+    rendiciones = datos["seleccion"]["rendiciones"]
     if not rendiciones:
         return "No hay rendiciones que coincidan con los filtros."
 
-    cuits_propios = get_cuits_propios()
-    return validar_rendiciones_para_export(
+    errores, warnings = validar_rendiciones_para_export(
         rendiciones,
-        codigo_concepto_fn=get_codigo_concepto_dux,
-        codigo_empleado_fn=get_codigo_empleado_dux,
-        cuits_propios=cuits_propios,
+        cuits_propios=datos["cuits_propios"],
+        tabla_conceptos=datos["tabla_conceptos"],
+        tabla_empleados=datos["tabla_empleados"],
     )
+    token = ""
+    if not errores and version_log is not None:
+        token = _guardar_snapshot_export(params, version_log, datos)
+    return errores, warnings, token
+
+
+# Procesos para generar ENC/DET. Por defecto 1 (en serie): el contenedor
+# comparte CPU con la app. DUX_EXPORT_PROCESOS=N activa el pool, 0 = los
+# núcleos asignados con tope (dux_export.procesos_disponibles). Solo se usa
+# en períodos grandes (dux_export.MIN_GRUPOS_PARALELO comprobantes o más).
+PROCESOS_EXPORT_DUX = int(os.getenv("DUX_EXPORT_PROCESOS", "1") or 1) or None
+
+FORMATOS_EXPORT_DUX = {
+    "xlsx": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("csv", "text/csv"),
+}
+
+
+def generar_archivo_export_dux(formato="xlsx", fecha_desde=None, fecha_hasta=None,
+                               modo_parcial=False, fecha_inicio_dux="", solo_nuevas=False,
+                               snapshot=None):
+    """
+    Genera el export Dux como archivo en memoria (para st.download_button),
+    sin escribir la hoja EXPORT_DUX.
+
+    Las filas ENC/DET se generan con iterar_filas_dux y se escriben en
+    streaming al BytesIO.
+
+    Args:
+        formato: "xlsx" o "csv".
+        solo_nuevas: solo lo no exportado desde el último lote (ignora las fechas).
+        snapshot: token de validar_rendiciones_pre_export (reutiliza lo validado).
+
+    Returns:
+        (bool, str, bytes|None, str): (éxito, mensaje, contenido, nombre de archivo)
+    """
+    import io
+
+    if formato not in FORMATOS_EXPORT_DUX:
+        return False, f"Formato no soportado: {formato}", None, ""
+
+    datos = _datos_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas, snapshot)
+    if datos is None:
+        return False, "Error leyendo RENDICIONES_LOG", None, ""
+    seleccion = datos["seleccion"]
+    rendiciones = seleccion["rendiciones"]
+    if not rendiciones:
+        return False, "No hay rendiciones que coincidan con los filtros.", None, ""
+
+    try:
+        grupos = agrupar_por_comprobante(rendiciones)
+        filas = iterar_filas_dux(
+            grupos,
+            cuits_propios=datos["cuits_propios"],
+            tabla_conceptos=datos["tabla_conceptos"],
+            tabla_empleados=datos["tabla_empleados"],
+            procesos=PROCESOS_EXPORT_DUX,
+        )
+        buffer = io.BytesIO()
+        if formato == "csv":
+            n_filas = exportar_csv_dux(filas, buffer)
+        else:
+            n_filas = exportar_excel_dux(filas, buffer)
+        if not n_filas:
+            return False, "No se generaron filas ENC/DET (sin comprobantes válidos).", None, ""
+
+        lote_id = registrar_lote_export(seleccion, n_filas, "nuevas" if solo_nuevas else "periodo",
+                                        fecha_desde, fecha_hasta)
+        if solo_nuevas:
+            periodo = lote_id or datetime.now().strftime("%Y%m%d")
+        else:
+            periodo = "_".join(f.isoformat() for f in (fecha_desde, fecha_hasta) if f) or datetime.now().strftime("%Y%m%d")
+        nombre = f"export_dux_{periodo}.{FORMATOS_EXPORT_DUX[formato][0]}"
+        msg = f"Archivo generado: {n_filas} filas ENC/DET ({len(grupos)} comprobantes)"
+        msg += f" — lote {lote_id}" if lote_id else " — ⚠️ no se pudo registrar el lote"
+        descartar_snapshot_export(snapshot)
+        logger.info(f"Dux export: {msg} → {nombre}")
+        return True, msg, buffer.getvalue(), nombre
+
+    except Exception as e:
+        import traceback
+        err_detail = traceback.format_exc()
+        logger.error(f"Dux export error: {err_detail}")
+        return False, f"Error: {str(e)}\n\nDetalle:\n{err_detail}", None, ""
+
+
+EXPORT_DUX_SHEET = "EXPORT_DUX"
+EXPORT_DUX_STAGING_SHEET = "EXPORT_DUX_STAGING"
+BLOQUE_FILAS_EXPORT_DUX = 1000   # 31 cols → ~31k celdas por update
+ESPERAS_REINTENTO_BLOQUE = [2, 5, 15]  # segundos entre reintentos de un bloque
+
+
+def _escribir_bloque(ws, rango, valores):
+    """ws.update con reintentos y backoff; la última falla se propaga."""
+    for intento, espera in enumerate(ESPERAS_REINTENTO_BLOQUE + [None], 1):
+        try:
+            # Usar kwargs para compatibilidad gspread v5/v6 (v6 invirtió el orden de args)
+            ws.update(range_name=rango, values=valores)
+            return
+        except Exception as e:
+            if espera is None:
+                raise
+            logger.warning(f"Bloque {rango} falló (intento {intento}): {e} — reintento en {espera}s")
+            time.sleep(espera)
+
+
+def _escribir_hoja_por_bloques(sh, nombre, headers, filas, progreso=None,
+                               tamano_bloque=BLOQUE_FILAS_EXPORT_DUX):
+    """Escribe headers + filas en una hoja de staging y las vuelca en `nombre`.
+
+    La hoja viva no se toca hasta que todos los bloques están escritos. El
+    vuelco va en un único batch_update, que Sheets aplica de forma atómica:
+    agrandar la viva si hace falta, borrar sus valores, copyPaste de valores
+    desde el staging y borrar el staging. La viva conserva su sheetId, así que
+    fórmulas, rangos con nombre, protecciones y links #gid siguen apuntando a
+    ella. Si un bloque agota sus reintentos la excepción se propaga y `nombre`
+    queda como estaba; el staging a medio escribir se descarta en la próxima
+    corrida. Si `nombre` no existe, el staging se renombra.
+
+    Args:
+        progreso: callback opcional progreso(filas_escritas, total).
+    """
+    from gspread.utils import rowcol_to_a1
+
+    staging_nombre = EXPORT_DUX_STAGING_SHEET if nombre == EXPORT_DUX_SHEET else f"{nombre}_STAGING"
+    total = len(filas)
+    n_cols = len(headers)
+    ultima_col = re.sub(r"\d", "", rowcol_to_a1(1, n_cols))
+
+    try:
+        sh.del_worksheet(sh.worksheet(staging_nombre))
+        logger.info(f"{staging_nombre}: staging anterior descartado")
+    except gspread.exceptions.WorksheetNotFound:
+        pass
+    ws_staging = sh.add_worksheet(title=staging_nombre, rows=total + 1, cols=n_cols)
+
+    _escribir_bloque(ws_staging, f"A1:{ultima_col}1", [list(headers)])
+    for inicio in range(0, total, tamano_bloque):
+        bloque = [[v if v is not None else "" for v in fila]  # gspread no acepta None
+                  for fila in filas[inicio:inicio + tamano_bloque]]
+        fila_desde = inicio + 2
+        _escribir_bloque(ws_staging, f"A{fila_desde}:{ultima_col}{fila_desde + len(bloque) - 1}", bloque)
+        escritas = inicio + len(bloque)
+        logger.info(f"{staging_nombre}: {escritas}/{total} filas escritas")
+        if progreso:
+            progreso(escritas, total)
+
+    try:
+        ws_viva = sh.worksheet(nombre)
+    except gspread.exceptions.WorksheetNotFound:
+        sh.batch_update({"requests": [{"updateSheetProperties": {
+            "properties": {"sheetId": ws_staging.id, "title": nombre}, "fields": "title"}}]})
+        logger.info(f"{nombre}: creada desde {staging_nombre} ({total} filas)")
+        return
+
+    requests = []
+    filas_viva, cols_viva = max(ws_viva.row_count, total + 1), max(ws_viva.col_count, n_cols)
+    if (filas_viva, cols_viva) != (ws_viva.row_count, ws_viva.col_count):
+        requests.append({"updateSheetProperties": {
+            "properties": {"sheetId": ws_viva.id,
+                           "gridProperties": {"rowCount": filas_viva, "columnCount": cols_viva}},
+            "fields": "gridProperties.rowCount,gridProperties.columnCount"}})
+    requests += [
+        # Sin "rows": borra los valores de toda la hoja (el formato queda)
+        {"updateCells": {"range": {"sheetId": ws_viva.id}, "fields": "userEnteredValue"}},
+        {"copyPaste": {
+            "source": {"sheetId": ws_staging.id, "startRowIndex": 0, "endRowIndex": total + 1,
+                       "startColumnIndex": 0, "endColumnIndex": n_cols},
+            "destination": {"sheetId": ws_viva.id, "startRowIndex": 0, "endRowIndex": total + 1,
+                            "startColumnIndex": 0, "endColumnIndex": n_cols},
+            "pasteType": "PASTE_VALUES"}},
+        {"deleteSheet": {"sheetId": ws_staging.id}},
+    ]
+    sh.batch_update({"requests": requests})
+    logger.info(f"{nombre}: {total} filas copiadas desde {staging_nombre}")
 
 
 def escribir_export_dux_en_sheet(fecha_desde=None, fecha_hasta=None,
-                                  modo_parcial=False, fecha_inicio_dux=""):
+                                  modo_parcial=False, fecha_inicio_dux="", solo_nuevas=False,
+                                  progreso=None, snapshot=None):
     """
     Lee RENDICIONES_LOG, filtra, genera filas ENC/DET y las escribe
-    en la hoja EXPORT_DUX del mismo spreadsheet.
+    en la hoja EXPORT_DUX del mismo spreadsheet. Registra el lote
+    (ver registrar_lote_export).
+
+    La escritura va por bloques a EXPORT_DUX_STAGING, que se copia sobre
+    EXPORT_DUX solo al final (misma hoja, mismo sheetId): un export que falla
+    deja la hoja anterior intacta.
+
+    Args:
+        solo_nuevas: solo lo no exportado desde el último lote (ignora las fechas).
+        progreso: callback opcional progreso(filas_escritas, total).
+        snapshot: token de validar_rendiciones_pre_export (reutiliza lo validado).
 
     Returns:
         (bool, str, int): (éxito, mensaje, cantidad de filas escritas).
     """
     # 1. Read and filter using shared helper
-    rendiciones = _leer_y_filtrar_rendiciones(fecha_desde, fecha_hasta,
-                                               modo_parcial, fecha_inicio_dux)
-    if rendiciones is None:
+    datos = _datos_export(fecha_desde, fecha_hasta, modo_parcial, fecha_inicio_dux, solo_nuevas, snapshot)
+    if datos is None:
         return False, "Error leyendo RENDICIONES_LOG", 0
+    seleccion = datos["seleccion"]
+    rendiciones = seleccion["rendiciones"]
     if not rendiciones:
         return False, "No hay rendiciones que coincidan con los filtros.", 0
 
@@ -1795,13 +2731,13 @@ def escribir_export_dux_en_sheet(fecha_desde=None, fecha_hasta=None,
         _, sh = _get_sheet_handle()
 
         # 2. Generate ENC/DET rows
-        cuits_propios = get_cuits_propios()
         grupos = agrupar_por_comprobante(rendiciones)
         filas_dux = generar_filas_dux(
             grupos,
-            cuits_propios=cuits_propios,
-            codigo_concepto_fn=get_codigo_concepto_dux,
-            codigo_empleado_fn=get_codigo_empleado_dux,
+            cuits_propios=datos["cuits_propios"],
+            tabla_conceptos=datos["tabla_conceptos"],
+            tabla_empleados=datos["tabla_empleados"],
+            procesos=PROCESOS_EXPORT_DUX,
         )
 
         if not filas_dux:
@@ -1809,43 +2745,14 @@ def escribir_export_dux_en_sheet(fecha_desde=None, fecha_hasta=None,
 
         logger.info(f"Dux export: {len(filas_dux)} filas ENC/DET generadas ({len(grupos)} comprobantes)")
 
-        # 5. Crear o limpiar hoja EXPORT_DUX
-        hoja_nombres = [ws.title for ws in sh.worksheets()]
-        logger.info(f"Dux export: Hojas existentes: {hoja_nombres}")
-
-        if "EXPORT_DUX" in hoja_nombres:
-            ws_export = sh.worksheet("EXPORT_DUX")
-            ws_export.clear()
-            logger.info("Dux export: Hoja EXPORT_DUX encontrada y limpiada")
-        else:
-            ws_export = sh.add_worksheet(title="EXPORT_DUX", rows=1000, cols=31)
-            logger.info("Dux export: Hoja EXPORT_DUX creada (1000 filas x 28 cols)")
-
-        # 6. Asegurar que la hoja tenga suficientes filas
-        total_rows = 1 + len(filas_dux)  # 1 header + N data rows
-        if ws_export.row_count < total_rows:
-            ws_export.resize(rows=total_rows, cols=28)
-            logger.info(f"Dux export: Hoja redimensionada a {total_rows} filas")
-
-        # 7. Sanitizar None → "" (gspread no acepta None en update)
-        all_data = [DUX_HEADERS] + filas_dux
-        sanitized = []
-        for row in all_data:
-            sanitized.append([v if v is not None else "" for v in row])
-        all_data = sanitized
-
-        cell_range = f"A1:AB{total_rows}"
-
-        logger.info(f"Dux export: Escribiendo {len(all_data)} filas en rango {cell_range}")
-        logger.info(f"Dux export: Header (fila 1) = {all_data[0][:5]}... ({len(all_data[0])} cols)")
-        logger.info(f"Dux export: Primera fila datos = {all_data[1][:5]}...")
-
-        # Usar kwargs para compatibilidad gspread v5/v6 (v6 invirtió el orden de args)
-        ws_export.update(range_name=cell_range, values=all_data)
-
-        logger.info(f"Dux export: update() completado OK")
+        # 3. Escribir en la hoja de staging por bloques y volcarla en EXPORT_DUX al final
+        _escribir_hoja_por_bloques(sh, EXPORT_DUX_SHEET, DUX_HEADERS, filas_dux, progreso=progreso)
 
+        lote_id = registrar_lote_export(seleccion, len(filas_dux), "nuevas" if solo_nuevas else "periodo",
+                                        fecha_desde, fecha_hasta)
         msg = f"Exportación completada: {len(filas_dux)} filas ENC/DET en EXPORT_DUX"
+        msg += f" — lote {lote_id}" if lote_id else " — ⚠️ no se pudo registrar el lote"
+        descartar_snapshot_export(snapshot)
         logger.info(msg)
         return True, msg, len(filas_dux)
 
@@ -1853,7 +2760,7 @@ def escribir_export_dux_en_sheet(fecha_desde=None, fecha_hasta=None,
         import traceback
         err_detail = traceback.format_exc()
         logger.error(f"Dux export error: {err_detail}")
-        return False, f"Error: {str(e)}\n\nDetalle:\n{err_detail}", 0
+        return False, f"Error: {str(e)} (EXPORT_DUX no se modificó)\n\nDetalle:\n{err_detail}", 0
 
 
 
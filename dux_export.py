@@ -8,8 +8,10 @@ Uso standalone:  python dux_export.py
 Uso importado:   from dux_export import exportar_dux_desde_sheets
 """
 
+import os
 import logging
 from datetime import datetime
+from types import MappingProxyType
 from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
@@ -217,6 +219,37 @@ def es_propia(cuit_cliente, cuits_propios=None):
     return clean in cuits_propios
 
 
+def tabla_codigos(mapping):
+    """Tabla inmutable {nombre normalizado: código Dux} para el export.
+
+    Se arma una vez por export (desde MAESTRO_CONCEPTOS_DUX o USUARIOS) y se
+    pasa a generar_filas_dux / validar_rendiciones_para_export en lugar de
+    los callables. Las claves se normalizan con strip().upper().
+    """
+    return MappingProxyType({str(k).strip().upper(): v for k, v in (mapping or {}).items()})
+
+
+def _lookup_codigos(tabla=None, fn=None):
+    """callable(nombre) -> código|None a partir de una tabla o de un callable.
+
+    Con tabla es un dict lookup. El callable queda como camino lento: se
+    memoiza por nombre durante el export para no llamarlo una vez por fila.
+    """
+    if tabla is not None:
+        get = tabla.get
+        return lambda nombre: get(str(nombre).strip().upper())
+    if fn is None:
+        return None
+    cache = {}
+
+    def _memo(nombre):
+        k = str(nombre).strip().upper()
+        if k not in cache:
+            cache[k] = fn(nombre)
+        return cache[k]
+    return _memo
+
+
 def fila_a_dict(row):
     """Convierte una fila (lista) de RENDICIONES_LOG a dict con claves internas."""
     d = {}
@@ -518,8 +551,262 @@ def _sumar_desglose(grupo):
     return totales
 
 
+# Columnas que _sumar_desglose acumula tal cual, y los tres slots de IIBB
+CAMPOS_DESGLOSE = ["neto_gravado", "no_gravado", "iva_21", "iva_105", "iva_27",
+                   "perc_iva", "perc_ganancias"]
+SLOTS_IIBB = [("perc_iibb", "jurisdiccion"), ("perc_iibb_2", "jurisdiccion_iibb_2"),
+              ("perc_iibb_3", "jurisdiccion_iibb_3")]
+
+
+def sumar_desgloses(grupos):
+    """desglose_sumado de todos los grupos en una sola pasada.
+
+    Mismo resultado que _sumar_desglose(grupo) para cada grupo, pero
+    columnar: un groupby de pandas sobre los campos numéricos y una tabla
+    "larga" de IIBB (los tres slots apilados) agrupada por (comprobante,
+    jurisdicción DUX), con la reclasificación de jurisdicciones no inscriptas
+    como máscara. Sin pandas, cae al cálculo grupo por grupo.
+
+    Args:
+        grupos: {clave: [rendiciones]}, salida de agrupar_por_comprobante.
+
+    Returns:
+        dict: {clave: desglose_sumado}.
+    """
+    if not grupos:
+        return {}
+    try:
+        import pandas as pd
+    except ImportError:
+        logger.info("pandas no instalado — desglose fiscal grupo por grupo")
+        return {clave: _sumar_desglose(grupo) for clave, grupo in grupos.items()}
+
+    claves = list(grupos)
+    filas = [rend for grupo in grupos.values() for rend in grupo]
+    columnas = CAMPOS_DESGLOSE + ["perc_municipal"] + [c for slot in SLOTS_IIBB for c in slot]
+    df = pd.DataFrame.from_records(filas, columns=columnas)
+    gid = pd.Series([i for i, grupo in enumerate(grupos.values()) for _ in grupo])
+
+    # 1. Campos numéricos: un groupby por comprobante
+    numericos = pd.DataFrame({campo: _columna_float(pd, df[campo]) for campo in CAMPOS_DESGLOSE})
+    numericos["gid"] = gid
+    # Percepción municipal → No Gravado en DUX (solo importes positivos)
+    numericos["no_gravado"] += _columna_float(pd, df["perc_municipal"]).clip(lower=0)
+
+    # 2. IIBB: slots apilados, filtrados y reclasificados con máscaras
+    # (la mayoría de las filas no tiene IIBB: se filtra por importe antes de tocar strings)
+    slots = []
+    for importe_key, juris_key in SLOTS_IIBB:
+        importe = _columna_float(pd, df[importe_key])
+        con_importe = importe > 0
+        slots.append(pd.DataFrame({
+            "gid": gid[con_importe],
+            "importe": importe[con_importe],
+            "juris": df[juris_key][con_importe].fillna("").astype(str).str.strip(),
+        }))
+    iibb = pd.concat(slots, ignore_index=True)
+    iibb = iibb[iibb["juris"] != ""]
+    juris_norm = iibb["juris"].str.upper()
+    inscripta = juris_norm.isin(JURISDICCIONES_INSCRIPTAS)
+
+    no_inscriptas = iibb[~inscripta]
+    if not no_inscriptas.empty:
+        numericos = pd.concat([numericos, pd.DataFrame({"gid": no_inscriptas["gid"],
+                                                        "no_gravado": no_inscriptas["importe"]})],
+                              ignore_index=True).fillna(0.0)
+        logger.info(
+            f"IIBB no inscripta -> reclasificada a No Gravado: {len(no_inscriptas)} percepciones "
+            f"(${no_inscriptas['importe'].sum():.2f}; {', '.join(sorted(set(no_inscriptas['juris'])))})"
+        )
+
+    sumas = numericos.groupby("gid")[CAMPOS_DESGLOSE].sum()
+    inscriptas = iibb[inscripta].assign(provincia=juris_norm[inscripta].map(resolver_jurisdiccion_dux))
+    iibb_sumado = inscriptas.groupby(["gid", "provincia"])["importe"].sum()
+
+    # 3. Armar los dicts en el formato de _sumar_desglose
+    iibb_por_grupo = {}
+    for (g, provincia), importe in iibb_sumado.items():
+        iibb_por_grupo.setdefault(g, []).append({"provincia": provincia, "importe": float(importe)})
+
+    resultado = {}
+    for g, valores in zip(sumas.index.tolist(), sumas.to_numpy().tolist()):
+        totales = dict(zip(CAMPOS_DESGLOSE, valores))
+        totales["exento"] = 0.0
+        juris = iibb_por_grupo.get(g, [])  # groupby ya las deja ordenadas por provincia
+        if len(juris) > 3:
+            logger.warning(
+                f"Grupo tiene {len(juris)} jurisdicciones IIBB. "
+                f"DUX solo soporta 3. No se exportan: {[j['provincia'] for j in juris[3:]]}"
+            )
+        totales["iibb"] = juris
+        resultado[claves[g]] = totales
+    return resultado
+
+
+def _columna_float(pd, serie):
+    """safe_float vectorizado: números tal cual; strings sin $ ni comas; el resto 0."""
+    serie = serie.astype(object)
+    numeros = pd.to_numeric(serie, errors="coerce")
+    texto = numeros.isna() & serie.notna()
+    if texto.any():
+        limpio = serie[texto].astype(str).str.replace("$", "", regex=False).str.replace(",", "", regex=False)
+        numeros[texto] = pd.to_numeric(limpio.str.strip(), errors="coerce")
+    return numeros.fillna(0.0).astype(float)
+
+
+def _filas_grupo(grupo, cuits_propios, codigo_concepto_fn, codigo_empleado_fn, desglose_sumado=None):
+    """ENC + DETs de un comprobante, con Sum(DET) vs ENC validado y redondeo ajustado.
+
+    desglose_sumado: precalculado con sumar_desgloses (None = calcularlo acá).
+
+    Raises:
+        ValueError: if sum(DET) differs from ENC by more than $1.
+    """
+    first = grupo[0]
+    cuit_cliente = str(first.get("cuit_cliente", "")).replace("-", "").replace(" ", "").strip()
+    is_propia_flag = es_propia(cuit_cliente, cuits_propios)
+    tipo_factura_dux = "PROPIA" if is_propia_flag else "TERCEROS"
+
+    # Total ENC = suma de montos a imputar de todas las filas del grupo
+    total_importe = sum(safe_float(r.get("monto_a_imputar")) for r in grupo)
+
+    # Desglose sumado (solo relevante para PROPIA, pero lo calculamos siempre)
+    if desglose_sumado is None:
+        desglose_sumado = _sumar_desglose(grupo)
+
+    # Fila ENC
+    enc = _construir_enc(grupo, tipo_factura_dux, total_importe, desglose_sumado)
+
+    # Filas DET (una por rendición/carpeta)
+    dets = [_construir_det(rend, tipo_factura_dux, codigo_concepto_fn, codigo_empleado_fn)
+            for rend in grupo]
+
+    # Validate sum(DET) == ENC
+    sum_det = sum(safe_float(det[11]) for det in dets)
+    diff = abs(total_importe - sum_det)
+    if diff > 1.0:
+        cuit_prov = str(first.get("cuit_proveedor", "")).strip()
+        raise ValueError(
+            f"Sum(DET)={sum_det:.2f} != ENC={total_importe:.2f} "
+            f"(diff=${diff:.2f}) for {cuit_prov} — aborting"
+        )
+    elif diff > 0.005:
+        # Adjust last DET for rounding
+        dets[-1][11] = round(dets[-1][11] + (total_importe - sum_det), 2)
+
+    return [enc] + dets
+
+
+# ── Generación en paralelo ───────────────────────────────────────────
+# Los grupos son independientes: se reparten en bloques entre procesos y
+# executor.map los devuelve en el orden original. Las tablas de códigos
+# viajan como dict (MappingProxyType no se puede picklear) y cada worker
+# las reconstruye una vez en el initializer.
+
+MIN_GRUPOS_PARALELO = 2000   # por debajo, el arranque del pool cuesta más que lo que ahorra
+GRUPOS_POR_TAREA = 500
+MAX_PROCESOS_AUTO = 4        # tope para procesos=None: no acaparar el host que comparte la app
+
+_contexto_worker = {}
+
+
+def _inicializar_worker(cuits_propios, conceptos, empleados):
+    _contexto_worker["cuits_propios"] = cuits_propios
+    _contexto_worker["concepto_fn"] = _lookup_codigos(tabla_codigos(conceptos) if conceptos is not None else None)
+    _contexto_worker["empleado_fn"] = _lookup_codigos(tabla_codigos(empleados) if empleados is not None else None)
+
+
+def _filas_bloque(bloque):
+    ctx = _contexto_worker
+    desgloses = sumar_desgloses(bloque)
+    filas = []
+    for clave, grupo in bloque.items():
+        filas.extend(_filas_grupo(grupo, ctx["cuits_propios"], ctx["concepto_fn"], ctx["empleado_fn"],
+                                  desgloses[clave]))
+    return filas
+
+
+def _bloques(grupos, tamano):
+    bloque = {}
+    for clave, grupo in grupos.items():
+        bloque[clave] = grupo
+        if len(bloque) == tamano:
+            yield bloque
+            bloque = {}
+    if bloque:
+        yield bloque
+
+
+def procesos_disponibles():
+    """Núcleos que el proceso puede usar de verdad, con tope MAX_PROCESOS_AUTO.
+
+    os.cpu_count() cuenta los del host; sched_getaffinity respeta el cpuset
+    del contenedor (no la cuota CFS, de ahí el tope).
+    """
+    try:
+        nucleos = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        nucleos = os.cpu_count() or 1
+    return max(1, min(nucleos, MAX_PROCESOS_AUTO))
+
+
+def _iterar_filas_paralelo(grupos, cuits_propios, tabla_conceptos, tabla_empleados, procesos):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Sin fork: el proceso de Streamlit tiene hilos (workers de trabajos, outbox)
+    metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    conceptos = dict(tabla_conceptos) if tabla_conceptos is not None else None
+    empleados = dict(tabla_empleados) if tabla_empleados is not None else None
+    logger.info(f"Generando filas Dux en paralelo: {len(grupos)} comprobantes, {procesos} procesos")
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context(metodo),
+                             initializer=_inicializar_worker,
+                             initargs=(list(cuits_propios or []), conceptos, empleados)) as executor:
+        for filas in executor.map(_filas_bloque, _bloques(grupos, GRUPOS_POR_TAREA)):
+            yield from filas
+
+
+def iterar_filas_dux(grupos, cuits_propios=None, codigo_concepto_fn=None,
+                     codigo_empleado_fn=None, tabla_conceptos=None, tabla_empleados=None,
+                     procesos=1):
+    """
+    Generador de filas ENC/DET, comprobante por comprobante.
+
+    Mismos argumentos que generar_filas_dux. Cada grupo (ENC + sus DET) se
+    arma y valida entero antes de emitirse, así que un consumidor en
+    streaming (exportar_excel_dux) nunca recibe un comprobante a medias.
+
+    Con procesos > 1 (None = procesos_disponibles()) y al menos
+    MIN_GRUPOS_PARALELO comprobantes, los grupos se generan en un pool de
+    procesos; el orden y las filas son los mismos que en serie. Requiere
+    los códigos como tablas: con callables sin tabla se genera en serie.
+
+    Raises:
+        ValueError: if sum(DET) differs from ENC by more than $1 for any group.
+    """
+    if procesos is None:
+        procesos = procesos_disponibles()
+    sin_tablas = ((codigo_concepto_fn and tabla_conceptos is None)
+                  or (codigo_empleado_fn and tabla_empleados is None))
+    if procesos > 1 and len(grupos) >= MIN_GRUPOS_PARALELO:
+        if not sin_tablas:
+            yield from _iterar_filas_paralelo(grupos, cuits_propios, tabla_conceptos, tabla_empleados,
+                                              procesos)
+            return
+        logger.warning("Generación en paralelo requiere tablas de códigos: se genera en serie")
+
+    codigo_concepto_fn = _lookup_codigos(tabla_conceptos, codigo_concepto_fn)
+    codigo_empleado_fn = _lookup_codigos(tabla_empleados, codigo_empleado_fn)
+
+    desgloses = sumar_desgloses(grupos)
+    for clave, grupo in grupos.items():
+        yield from _filas_grupo(grupo, cuits_propios, codigo_concepto_fn, codigo_empleado_fn,
+                                desgloses[clave])
+
+
 def generar_filas_dux(grupos, cuits_propios=None, codigo_concepto_fn=None,
-                      codigo_empleado_fn=None):
+                      codigo_empleado_fn=None, tabla_conceptos=None, tabla_empleados=None,
+                      procesos=1):
     """
     Genera la lista completa de filas ENC/DET para el Excel Dux.
 
@@ -529,6 +816,9 @@ def generar_filas_dux(grupos, cuits_propios=None, codigo_concepto_fn=None,
         cuits_propios: list of Expoconsult CUITs for PROPIA detection.
         codigo_concepto_fn: callable(concepto) -> int|None.
         codigo_empleado_fn: callable(usuario) -> int|None.
+        tabla_conceptos / tabla_empleados: tablas de tabla_codigos(); si se
+            pasan, tienen prioridad sobre los callables.
+        procesos: > 1 para generar en paralelo (ver iterar_filas_dux).
 
     Returns:
         Lista de listas (cada sublista = 28 celdas, una fila del Excel).
@@ -536,182 +826,291 @@ def generar_filas_dux(grupos, cuits_propios=None, codigo_concepto_fn=None,
     Raises:
         ValueError: if sum(DET) differs from ENC by more than $1 for any group.
     """
-    filas = []
+    return list(iterar_filas_dux(grupos, cuits_propios, codigo_concepto_fn, codigo_empleado_fn,
+                                 tabla_conceptos, tabla_empleados, procesos))
 
-    for clave, grupo in grupos.items():
-        first = grupo[0]
-        cuit_cliente = str(first.get("cuit_cliente", "")).replace("-", "").replace(" ", "").strip()
-        is_propia_flag = es_propia(cuit_cliente, cuits_propios)
-        tipo_factura_dux = "PROPIA" if is_propia_flag else "TERCEROS"
 
-        # Total ENC = suma de montos a imputar de todas las filas del grupo
-        total_importe = sum(safe_float(r.get("monto_a_imputar")) for r in grupo)
+# ==========================================
+# VALIDACIÓN PRE-EXPORT
+# ==========================================
 
-        # Desglose sumado (solo relevante para PROPIA, pero lo calculamos siempre)
-        desglose_sumado = _sumar_desglose(grupo)
 
-        # Fila ENC
-        enc = _construir_enc(grupo, tipo_factura_dux, total_importe, desglose_sumado)
-        filas.append(enc)
-
-        # Filas DET (una por rendición/carpeta)
-        det_importes = []
-        for rend in grupo:
-            det = _construir_det(rend, tipo_factura_dux, codigo_concepto_fn, codigo_empleado_fn)
-            filas.append(det)
-            det_importes.append(safe_float(det[11]))
-
-        # Validate sum(DET) == ENC
-        sum_det = sum(det_importes)
-        diff = abs(total_importe - sum_det)
-        if diff > 1.0:
-            cuit_prov = str(first.get("cuit_proveedor", "")).strip()
-            raise ValueError(
-                f"Sum(DET)={sum_det:.2f} != ENC={total_importe:.2f} "
-                f"(diff=${diff:.2f}) for {cuit_prov} — aborting"
-            )
-        elif diff > 0.005:
-            # Adjust last DET for rounding
-            last_det_idx = len(filas) - 1
-            filas[last_det_idx][11] = round(filas[last_det_idx][11] + (total_importe - sum_det), 2)
+# Cada regla declara los campos que lee y su alcance:
+#   "fila":  evaluar(valores, rend, ctx) → None, un hallazgo o lista de hallazgos.
+#   "grupo": evaluar(clave, filas, ctx)  → idem, una vez por comprobante
+#            (filas = [(row_ref, rend)] en orden de aparición).
+# El motor recorre las rendiciones una sola vez: normaliza la unión de campos
+# declarados (str().strip()) y corre todas las reglas de fila; los grupos se
+# arman en la misma pasada y las reglas de grupo corren sobre ellos al final.
+# reportar(hallazgos) arma el dict {tipo, mensaje, filas_afectadas, accion}.
 
-    return filas
+class ReglaValidacion:
+    """Regla del motor de validación pre-export (ver REGLAS_VALIDACION)."""
 
+    def __init__(self, nombre, severidad, campos, evaluar, reportar, alcance="fila"):
+        self.nombre = nombre
+        self.severidad = severidad  # "error" (bloquea) | "warning"
+        self.campos = tuple(campos)
+        self.evaluar = evaluar
+        self.reportar = reportar
+        self.alcance = alcance
 
-# ==========================================
-# VALIDACIÓN PRE-EXPORT
-# ==========================================
+    def __repr__(self):
+        return f"ReglaValidacion({self.nombre!r}, {self.severidad}, {self.alcance})"
+
+
+def _sin_guiones(valor):
+    return valor.replace("-", "").replace(" ", "")
+
+
+def _reporte_por_valor(tipo, mensaje, accion):
+    """reportar() para hallazgos (valor, row_ref): una línea por valor distinto."""
+    def reportar(hallazgos):
+        por_valor = {}
+        for valor, row_ref in hallazgos:
+            por_valor.setdefault(valor, []).append(row_ref)
+        return {
+            "tipo": tipo,
+            "mensaje": mensaje.format(n=len(hallazgos)),
+            "filas_afectadas": [f'  "{v}" (rows: {", ".join(str(r) for r in rows[:5])})'
+                                for v, rows in por_valor.items()],
+            "accion": accion,
+        }
+    return reportar
+
+
+def _reporte_lista(tipo, mensaje, accion):
+    """reportar() para hallazgos que ya son la línea a mostrar."""
+    def reportar(hallazgos):
+        return {"tipo": tipo, "mensaje": mensaje.format(n=len(hallazgos)),
+                "filas_afectadas": hallazgos, "accion": accion}
+    return reportar
+
+
+def _regla_cuit(valores, rend, ctx):
+    cuit = _sin_guiones(valores["cuit_proveedor"])
+    if not cuit or len(cuit) != 11 or not cuit.isdigit():
+        return f"row {ctx['row_ref']}: CUIT='{cuit}'"
+
+
+def _regla_concepto(valores, rend, ctx):
+    concepto = valores["concepto"]
+    if concepto and ctx["codigo_concepto_fn"] and ctx["codigo_concepto_fn"](concepto) is None:
+        return concepto, ctx["row_ref"]
+
+
+def _regla_empleado(valores, rend, ctx):
+    usuario = valores["usuario"]
+    if usuario and ctx["codigo_empleado_fn"] and ctx["codigo_empleado_fn"](usuario) is None:
+        return usuario, ctx["row_ref"]
+
+
+def _regla_propia_sin_desglose(valores, rend, ctx):
+    if es_propia(_sin_guiones(valores["cuit_cliente"]), ctx["cuits_propios"]):
+        if safe_float(valores["neto_gravado"]) == 0 and safe_float(valores["no_gravado"]) == 0:
+            return f"row {ctx['row_ref']}"
+
+
+def _regla_carpeta(valores, rend, ctx):
+    if not valores["numero_carpeta"]:
+        return f"row {ctx['row_ref']}"
+
+
+def _regla_jurisdiccion(valores, rend, ctx):
+    hallazgos = []
+    for juris_key in ("jurisdiccion", "jurisdiccion_iibb_2", "jurisdiccion_municipal"):
+        juris_raw = valores[juris_key]
+        if not juris_raw:
+            continue
+        juris_dux = resolver_jurisdiccion_dux(juris_raw)
+        if juris_dux and juris_dux not in JURISDICCIONES_DUX_VALIDAS:
+            hallazgos.append(f"row {ctx['row_ref']}: {juris_key}='{juris_raw}' -> '{juris_dux}'")
+    return hallazgos
+
+
+def _regla_comprobante_repetido(clave, filas, ctx):
+    """Mismo comprobante en más de una rendición: sale como un único ENC."""
+    rendiciones = {str(rend.get("rendicion_id") or rend.get("id_operacion", "")).strip() for _, rend in filas}
+    rendiciones.discard("")
+    if len(rendiciones) > 1:
+        return f"{clave}: {len(rendiciones)} rendiciones ({', '.join(sorted(rendiciones)[:5])})"
+
+
+# Redondeos de carga (centavos repartidos entre carpetas) no cuentan como exceso
+TOLERANCIA_IMPUTADO_TICKET = 1.0
+
+
+def _regla_imputado_vs_ticket(clave, filas, ctx):
+    """Guardados del comprobante que imputan más que su Monto Ticket.
+
+    Col Z se guarda prorrateada entre las carpetas del guardado, así que el
+    ticket de un guardado es la suma de Z de sus filas (agrupadas por
+    rendicion_id, o id_operacion si falta). Imputar más que el ticket está
+    permitido ("Puede diferir del ticket"), pero suele ser una carga
+    duplicada o un monto mal tipeado: es un aviso, no bloquea.
+    """
+    guardados = {}
+    for row_ref, rend in filas:
+        clave_guardado = str(rend.get("rendicion_id") or rend.get("id_operacion", "")).strip()
+        g = guardados.setdefault(clave_guardado, {"ticket": 0.0, "imputado": 0.0, "rows": []})
+        g["ticket"] += safe_float(rend.get("monto_total", rend.get("monto_total_ticket")))
+        g["imputado"] += safe_float(rend.get("monto_a_imputar"))
+        g["rows"].append(str(row_ref))
+    hallazgos = []
+    for clave_guardado, g in guardados.items():
+        if g["ticket"] > 0 and g["imputado"] - g["ticket"] > TOLERANCIA_IMPUTADO_TICKET:
+            hallazgos.append(f"{clave} ({clave_guardado or 's/ID'}): imputado={g['imputado']:.2f} > "
+                             f"Monto Ticket={g['ticket']:.2f} (rows: {', '.join(g['rows'][:5])})")
+    return hallazgos
+
+
+REGLAS_VALIDACION = [
+    ReglaValidacion(
+        "cuit_proveedor", "error", ["cuit_proveedor"], _regla_cuit,
+        _reporte_lista("CUIT proveedor inválido",
+                       "{n} rendiciones con CUIT vacío o inválido (debe ser 11 dígitos)",
+                       "Editá la rendición y completá el CUIT manualmente")),
+    ReglaValidacion(
+        "concepto_dux", "error", ["concepto"], _regla_concepto,
+        _reporte_por_valor("Concepto sin código DUX", "{n} rendiciones con concepto sin mapear",
+                           "Completá la columna 'concepto_interno' en MAESTRO_CONCEPTOS_DUX")),
+    ReglaValidacion(
+        "empleado_dux", "error", ["usuario"], _regla_empleado,
+        _reporte_por_valor("Usuario sin idEmpleado DUX", "{n} rendiciones con usuario sin código de tesorería",
+                           "Completá 'codigo_dux' en la hoja USUARIOS")),
+    ReglaValidacion(
+        "propia_sin_desglose", "error", ["cuit_cliente", "neto_gravado", "no_gravado"],
+        _regla_propia_sin_desglose,
+        _reporte_lista("Factura PROPIA sin desglose impositivo",
+                       "{n} facturas PROPIA sin netoGravado ni noGravado",
+                       "Editá la rendición y completá los importes de desglose")),
+    ReglaValidacion(
+        "carpeta", "error", ["numero_carpeta"], _regla_carpeta,
+        _reporte_lista("Rendición sin número de carpeta",
+                       "{n} rendiciones sin carpeta (col J del DET quedará vacía)",
+                       "Editá la rendición y completá el número de carpeta")),
+    ReglaValidacion(
+        "jurisdiccion_iibb", "warning", ["jurisdiccion", "jurisdiccion_iibb_2", "jurisdiccion_municipal"],
+        _regla_jurisdiccion,
+        _reporte_lista("Jurisdicción IIBB no estándar para DUX",
+                       "{n} percepciones con jurisdicción que DUX puede no aceptar. "
+                       "DUX v4 solo acepta 'CABA' y 'BS AS'.",
+                       "Verificá con el equipo de DUX si la jurisdicción es válida o ajustá manualmente.")),
+    ReglaValidacion(
+        "imputado_vs_ticket", "warning", ["monto_a_imputar", "monto_total"], _regla_imputado_vs_ticket,
+        _reporte_lista("Imputado mayor que el Monto Ticket",
+                       "{n} guardados con más monto a imputar que el total de su ticket",
+                       "Verificá que no sea una carga duplicada o un monto mal tipeado"),
+        alcance="grupo"),
+    ReglaValidacion(
+        "comprobante_repetido", "warning", ["rendicion_id", "id_operacion"], _regla_comprobante_repetido,
+        _reporte_lista("Comprobante en más de una rendición",
+                       "{n} comprobantes cargados en más de una rendición (se exportan como un único ENC)",
+                       "Verificá que no sea una carga duplicada del mismo comprobante"),
+        alcance="grupo"),
+]
+
+
+# Tomar tiempos de cada regla de fila en todas las filas duplicaría el costo
+# de la validación: se miden 1 de cada N filas y se extrapola.
+MUESTREO_TIEMPOS = 16
 
 
 def validar_rendiciones_para_export(rendiciones, codigo_concepto_fn=None,
-                                    codigo_empleado_fn=None, cuits_propios=None):
+                                    codigo_empleado_fn=None, cuits_propios=None,
+                                    tabla_conceptos=None, tabla_empleados=None,
+                                    reglas=None, tiempos=None):
     """Validates renditions before DUX export.
 
+    Code lookups use tabla_conceptos / tabla_empleados (see tabla_codigos)
+    when given, else the callables.
+
+    Todas las reglas (REGLAS_VALIDACION por defecto) corren en una sola pasada
+    sobre las filas; las de grupo, sobre los comprobantes armados en esa pasada.
+
+    Args:
+        reglas: lista de ReglaValidacion (default REGLAS_VALIDACION).
+        tiempos: dict opcional; se completa con {nombre de regla: segundos}
+            (estimados por muestreo en las reglas de fila). El resumen también
+            va al log.
+
     Returns:
         (list[dict], list[dict]): (errores, warnings).
         errores are blocking — abort export.
         warnings are informational — show but don't block.
         Each dict has keys: tipo, mensaje, filas_afectadas, accion.
     """
-    errors = []
-    warnings = []
-
-    # Group errors by type
-    sin_cuit = []
-    sin_concepto_dux = {}  # concepto -> [row indices/ids]
-    sin_empleado_dux = {}  # usuario -> [row indices/ids]
-    propia_sin_desglose = []
-    sin_carpeta = []
+    from time import perf_counter
+
+    reglas = REGLAS_VALIDACION if reglas is None else reglas
+    reglas_fila = [r for r in reglas if r.alcance == "fila"]
+    reglas_grupo = [r for r in reglas if r.alcance == "grupo"]
+    campos = sorted({c for r in reglas_fila for c in r.campos})
+    ctx = {
+        "codigo_concepto_fn": _lookup_codigos(tabla_conceptos, codigo_concepto_fn),
+        "codigo_empleado_fn": _lookup_codigos(tabla_empleados, codigo_empleado_fn),
+        "cuits_propios": cuits_propios,
+        "row_ref": None,
+    }
+    hallazgos = {r.nombre: [] for r in reglas}
+    duracion = {r.nombre: 0.0 for r in reglas}
+    grupos = OrderedDict()
 
+    # Pasada única sobre las filas
     for i, rend in enumerate(rendiciones):
-        row_ref = rend.get("id_operacion", f"fila {i+1}")
-
-        # 1. CUIT proveedor (11 digits)
-        cuit = str(rend.get("cuit_proveedor", "")).replace("-", "").replace(" ", "").strip()
-        if not cuit or len(cuit) != 11 or not cuit.isdigit():
-            sin_cuit.append(f"row {row_ref}: CUIT='{cuit}'")
-
-        # 2. Concepto → codigo DUX
-        concepto = str(rend.get("concepto", "")).strip()
-        if concepto and codigo_concepto_fn:
-            code = codigo_concepto_fn(concepto)
-            if code is None:
-                sin_concepto_dux.setdefault(concepto, []).append(row_ref)
-
-        # 3. Usuario → idEmpleado DUX
-        usuario = str(rend.get("usuario", "")).strip()
-        if usuario and codigo_empleado_fn:
-            code = codigo_empleado_fn(usuario)
-            if code is None:
-                sin_empleado_dux.setdefault(usuario, []).append(row_ref)
-
-        # 4. PROPIA sin desglose
-        cuit_cliente = str(rend.get("cuit_cliente", "")).replace("-", "").replace(" ", "").strip()
-        if es_propia(cuit_cliente, cuits_propios):
-            neto = safe_float(rend.get("neto_gravado"))
-            no_grav = safe_float(rend.get("no_gravado"))
-            if neto == 0 and no_grav == 0:
-                propia_sin_desglose.append(f"row {row_ref}")
-
-        # 5. Carpeta
-        carpeta = str(rend.get("numero_carpeta", "")).strip()
-        if not carpeta:
-            sin_carpeta.append(f"row {row_ref}")
-
-    # Build error list
-    if sin_cuit:
-        errors.append({
-            "tipo": "CUIT proveedor inválido",
-            "mensaje": f"{len(sin_cuit)} rendiciones con CUIT vacío o inválido (debe ser 11 dígitos)",
-            "filas_afectadas": sin_cuit,
-            "accion": "Editá la rendición y completá el CUIT manualmente",
-        })
-
-    if sin_concepto_dux:
-        total = sum(len(v) for v in sin_concepto_dux.values())
-        detalles = []
-        for conc, rows in sin_concepto_dux.items():
-            detalles.append(f'  "{conc}" (rows: {", ".join(str(r) for r in rows[:5])})')
-        errors.append({
-            "tipo": "Concepto sin código DUX",
-            "mensaje": f"{total} rendiciones con concepto sin mapear",
-            "filas_afectadas": detalles,
-            "accion": "Completá la columna 'concepto_interno' en MAESTRO_CONCEPTOS_DUX",
-        })
-
-    if sin_empleado_dux:
-        total = sum(len(v) for v in sin_empleado_dux.values())
-        detalles = []
-        for usr, rows in sin_empleado_dux.items():
-            detalles.append(f'  "{usr}" (rows: {", ".join(str(r) for r in rows[:5])})')
-        errors.append({
-            "tipo": "Usuario sin idEmpleado DUX",
-            "mensaje": f"{total} rendiciones con usuario sin código de tesorería",
-            "filas_afectadas": detalles,
-            "accion": "Completá 'codigo_dux' en la hoja USUARIOS",
-        })
-
-    if propia_sin_desglose:
-        errors.append({
-            "tipo": "Factura PROPIA sin desglose impositivo",
-            "mensaje": f"{len(propia_sin_desglose)} facturas PROPIA sin netoGravado ni noGravado",
-            "filas_afectadas": propia_sin_desglose,
-            "accion": "Editá la rendición y completá los importes de desglose",
-        })
-
-    if sin_carpeta:
-        errors.append({
-            "tipo": "Rendición sin número de carpeta",
-            "mensaje": f"{len(sin_carpeta)} rendiciones sin carpeta (col J del DET quedará vacía)",
-            "filas_afectadas": sin_carpeta,
-            "accion": "Editá la rendición y completá el número de carpeta",
-        })
-
-    # WARNING (not blocking): jurisdicciones IIBB que DUX puede no aceptar
-    juris_no_estandar = []
-    for i, rend in enumerate(rendiciones):
-        row_ref = rend.get("id_operacion", f"fila {i+1}")
-        for juris_key in ("jurisdiccion", "jurisdiccion_iibb_2", "jurisdiccion_municipal"):
-            juris_raw = str(rend.get(juris_key, "")).strip()
-            if not juris_raw:
-                continue
-            juris_dux = resolver_jurisdiccion_dux(juris_raw)
-            if juris_dux and juris_dux not in JURISDICCIONES_DUX_VALIDAS:
-                juris_no_estandar.append(
-                    f"row {row_ref}: {juris_key}='{juris_raw}' -> '{juris_dux}'"
-                )
-
-    if juris_no_estandar:
-        warnings.append({
-            "tipo": "Jurisdicción IIBB no estándar para DUX",
-            "mensaje": (
-                f"{len(juris_no_estandar)} percepciones con jurisdicción que DUX puede no aceptar. "
-                f"DUX v4 solo acepta 'CABA' y 'BS AS'."
-            ),
-            "filas_afectadas": juris_no_estandar,
-            "accion": "Verificá con el equipo de DUX si la jurisdicción es válida o ajustá manualmente.",
-        })
+        get = rend.get
+        row_ref = get("id_operacion", f"fila {i+1}")
+        ctx["row_ref"] = row_ref
+        valores = {c: str(get(c, "")).strip() for c in campos}
+        medir = i % MUESTREO_TIEMPOS == 0
+        for regla in reglas_fila:
+            if medir:
+                t0 = perf_counter()
+                resultado = regla.evaluar(valores, rend, ctx)
+                duracion[regla.nombre] += perf_counter() - t0
+            else:
+                resultado = regla.evaluar(valores, rend, ctx)
+            if resultado:
+                if type(resultado) is list:
+                    hallazgos[regla.nombre].extend(resultado)
+                else:
+                    hallazgos[regla.nombre].append(resultado)
+        if reglas_grupo:
+            clave = _clave_comprobante(rend)
+            if clave and clave != "|||":
+                grupos.setdefault(clave, []).append((row_ref, rend))
+
+    # Las reglas de fila se midieron en 1 de cada MUESTREO_TIEMPOS filas
+    medidas = (len(rendiciones) + MUESTREO_TIEMPOS - 1) // MUESTREO_TIEMPOS
+    for regla in reglas_fila:
+        duracion[regla.nombre] *= len(rendiciones) / medidas if medidas else 0
+
+    # Reglas entre filas, por comprobante
+    for regla in reglas_grupo:
+        t0 = perf_counter()
+        for clave, filas in grupos.items():
+            resultado = regla.evaluar(clave, filas, ctx)
+            if resultado:
+                if type(resultado) is list:
+                    hallazgos[regla.nombre].extend(resultado)
+                else:
+                    hallazgos[regla.nombre].append(resultado)
+        duracion[regla.nombre] += perf_counter() - t0
 
+    errors = []
+    warnings = []
+    for regla in reglas:
+        if hallazgos[regla.nombre]:
+            destino = errors if regla.severidad == "error" else warnings
+            destino.append(regla.reportar(hallazgos[regla.nombre]))
+
+    if tiempos is not None:
+        tiempos.update(duracion)
+    logger.info(
+        f"Validación pre-export: {len(rendiciones)} filas"
+        + (f", {len(grupos)} comprobantes" if reglas_grupo else "") + " — "
+        + ", ".join(f"{nombre} {seg * 1000:.1f}ms" for nombre, seg in duracion.items())
+    )
     return errors, warnings
 
 
@@ -719,98 +1118,158 @@ def validar_rendiciones_para_export(rendiciones, codigo_concepto_fn=None,
 # EXPORTACIÓN A EXCEL
 # ==========================================
 
+# Anchos de columna del Excel Dux (1-based)
+ANCHOS_COLUMNAS_DUX = {
+    1: 14,   # Tipo Renglón
+    2: 14,   # Tipo Factura
+    3: 12,   # Fecha
+    4: 8,    # Tipo FP
+    5: 8,    # Letra FP
+    6: 8,    # Suc.
+    7: 12,   # Nro.
+    8: 30,   # Concepto
+    9: 14,   # CUIT
+    10: 18,  # Op. (carpeta)
+    11: 6,   # Mon.
+    12: 14,  # Importe
+    13: 20,  # Detalle
+    14: 12,  # idEmpleado
+}
+
+
+def _estilos_dux(wb):
+    """Registra los estilos con nombre del Excel Dux en el workbook (una vez).
+
+    Cada celda referencia un estilo compartido en lugar de crear sus propios
+    Font/Fill/Alignment.
+
+    Returns:
+        dict: {(tipo_fila, clase_celda): nombre_de_estilo}
+    """
+    from openpyxl.styles import NamedStyle, Font, PatternFill, Alignment, Border, Side
+
+    borde = Side(style="thin", color="B4C6E7")
+    thin_border = Border(left=borde, right=borde, top=borde, bottom=borde)
+    fills = {
+        "ENC": PatternFill(start_color="D6E4F0", end_color="D6E4F0", fill_type="solid"),
+        "DET": PatternFill(start_color="FFFFFF", end_color="FFFFFF", fill_type="solid"),
+    }
+
+    header = NamedStyle(name="dux_header")
+    header.font = Font(name="Calibri", bold=True, size=11, color="FFFFFF")
+    header.fill = PatternFill(start_color="2F5496", end_color="2F5496", fill_type="solid")
+    header.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    header.border = thin_border
+    wb.add_named_style(header)
+
+    nombres = {("HEADER", "texto"): "dux_header"}
+    for tipo, fill in fills.items():
+        for clase in ("texto", "numero", "renglon"):
+            estilo = NamedStyle(name=f"dux_{tipo.lower()}_{clase}")
+            estilo.fill = fill
+            estilo.border = thin_border
+            if clase == "numero":
+                # Formato numérico para columnas de importes
+                estilo.number_format = '#,##0.00'
+                estilo.alignment = Alignment(horizontal="right")
+            elif clase == "renglon":
+                estilo.font = Font(bold=True)
+                estilo.alignment = Alignment(horizontal="center")
+            wb.add_named_style(estilo)
+            nombres[(tipo, clase)] = estilo.name
+    return nombres
+
+
 def exportar_excel_dux(filas, output_path):
     """
     Escribe las filas ENC/DET en un Excel formateado para Dux.
 
+    Usa el modo write-only de openpyxl: las filas se consumen de a una (puede
+    ser el generador iterar_filas_dux) y se escriben directo al archivo, con
+    memoria constante sin importar el período exportado.
+
     Args:
-        filas: lista de listas (salida de generar_filas_dux).
-        output_path: ruta del archivo .xlsx de salida.
+        filas: iterable de listas (generar_filas_dux o iterar_filas_dux).
+        output_path: ruta (o file-like) del .xlsx de salida.
+
+    Returns:
+        int — cantidad de filas escritas (sin contar header).
     """
     from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.utils import get_column_letter
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Dux Import"
-
-    # — Estilos —
-    header_font = Font(name="Calibri", bold=True, size=11, color="FFFFFF")
-    header_fill = PatternFill(start_color="2F5496", end_color="2F5496", fill_type="solid")
-    header_align = Alignment(horizontal="center", vertical="center", wrap_text=True)
-
-    enc_fill = PatternFill(start_color="D6E4F0", end_color="D6E4F0", fill_type="solid")
-    det_fill = PatternFill(start_color="FFFFFF", end_color="FFFFFF", fill_type="solid")
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="Dux Import")
+    estilos = _estilos_dux(wb)
 
-    thin_border = Border(
-        left=Side(style="thin", color="B4C6E7"),
-        right=Side(style="thin", color="B4C6E7"),
-        top=Side(style="thin", color="B4C6E7"),
-        bottom=Side(style="thin", color="B4C6E7"),
-    )
+    # — Anchos de columna y freeze panes: en write-only van antes de la primera fila —
+    for col_idx in range(1, len(DUX_HEADERS) + 1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = ANCHOS_COLUMNAS_DUX.get(col_idx, 14)
+    ws.freeze_panes = "A2"
 
-    number_fmt = '#,##0.00'
+    def _celda(valor, estilo):
+        cell = WriteOnlyCell(ws, value=valor)
+        cell.style = estilo
+        return cell
 
     # — Header (fila 1) —
-    for col_idx, header in enumerate(DUX_HEADERS, start=1):
-        cell = ws.cell(row=1, column=col_idx, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_align
-        cell.border = thin_border
+    ws.append([_celda(h, estilos[("HEADER", "texto")]) for h in DUX_HEADERS])
 
     # — Datos (fila 2+) —
-    for row_idx, fila in enumerate(filas, start=2):
-        is_enc = (fila[0] == "ENC") if fila else False
-        row_fill = enc_fill if is_enc else det_fill
-
+    n_filas = 0
+    for fila in filas:
+        tipo = "ENC" if fila and fila[0] == "ENC" else "DET"
+        est_texto, est_numero, est_renglon = (estilos[(tipo, "texto")], estilos[(tipo, "numero")],
+                                              estilos[(tipo, "renglon")])
+        celdas = []
         for col_idx, valor in enumerate(fila, start=1):
-            cell = ws.cell(row=row_idx, column=col_idx, value=valor)
-            cell.border = thin_border
-            cell.fill = row_fill
-
-            # Formato numérico para columnas de importes
             if isinstance(valor, (int, float)) and valor != 0:
-                cell.number_format = number_fmt
-                cell.alignment = Alignment(horizontal="right")
+                estilo = est_numero
             elif col_idx == 1:
-                cell.font = Font(bold=True)
-                cell.alignment = Alignment(horizontal="center")
-
-    # — Anchos de columna —
-    col_widths = {
-        1: 14,   # Tipo Renglón
-        2: 14,   # Tipo Factura
-        3: 12,   # Fecha
-        4: 8,    # Tipo FP
-        5: 8,    # Letra FP
-        6: 8,    # Suc.
-        7: 12,   # Nro.
-        8: 30,   # Concepto
-        9: 14,   # CUIT
-        10: 18,  # Op. (carpeta)
-        11: 6,   # Mon.
-        12: 14,  # Importe
-        13: 20,  # Detalle
-        14: 12,  # idEmpleado
-    }
-    for col_idx in range(15, 29):
-        col_widths[col_idx] = 14
-
-    for col_idx, width in col_widths.items():
-        ws.column_dimensions[get_column_letter(col_idx)].width = width
-
-    # — Freeze panes (fijar header) —
-    ws.freeze_panes = "A2"
+                estilo = est_renglon
+            else:
+                estilo = est_texto
+            celdas.append(_celda(valor, estilo))
+        ws.append(celdas)
+        n_filas += 1
 
-    # — Autofiltro —
+    # — Autofiltro (se escribe al cerrar la hoja) —
     last_col_letter = get_column_letter(len(DUX_HEADERS))
-    last_row = len(filas) + 1
-    ws.auto_filter.ref = f"A1:{last_col_letter}{last_row}"
+    ws.auto_filter.ref = f"A1:{last_col_letter}{n_filas + 1}"
 
     wb.save(output_path)
-    logger.info(f"Excel Dux exportado: {output_path} ({len(filas)} filas)")
+    logger.info(f"Excel Dux exportado: {output_path} ({n_filas} filas)")
+    return n_filas
+
+
+def exportar_csv_dux(filas, output, separador=","):
+    """
+    Escribe las filas ENC/DET como CSV (header + filas), en streaming.
+
+    Args:
+        filas: iterable de listas (generar_filas_dux o iterar_filas_dux).
+        output: file-like binario (ej. BytesIO). Se escribe en UTF-8 con BOM
+            para que Excel respete los acentos.
+        separador: delimitador de columnas.
+
+    Returns:
+        int — cantidad de filas escritas (sin contar header).
+    """
+    import io
+    import csv
+
+    texto = io.TextIOWrapper(output, encoding="utf-8-sig", newline="")
+    writer = csv.writer(texto, delimiter=separador)
+    writer.writerow(DUX_HEADERS)
+    n_filas = 0
+    for fila in filas:
+        writer.writerow(["" if v is None else v for v in fila])
+        n_filas += 1
+    texto.flush()
+    texto.detach()  # no cerrar el output del llamador
+    logger.info(f"CSV Dux exportado ({n_filas} filas)")
+    return n_filas
 
 
 # ==========================================
@@ -834,9 +1293,8 @@ def exportar_dux_desde_sheets(rendiciones_raw, output_path, cuits_propios=None,
         int — cantidad de filas generadas (sin contar header).
     """
     grupos = agrupar_por_comprobante(rendiciones_raw)
-    filas = generar_filas_dux(grupos, cuits_propios, codigo_concepto_fn, codigo_empleado_fn)
-    exportar_excel_dux(filas, output_path)
-    return len(filas)
+    filas = iterar_filas_dux(grupos, cuits_propios, codigo_concepto_fn, codigo_empleado_fn)
+    return exportar_excel_dux(filas, output_path)
 
 
 # ==========================================
@@ -1086,6 +1544,83 @@ if __name__ == "__main__":
     check("1 blocking error", len(errs9) == 1, f"errors={len(errs9)}")
     check("No jurisdiction warning (CORDOBA valid)", len(warns9) == 0, f"warnings={len(warns9)}")
 
+    # ── Test 10: tablas pre-resueltas = mismos resultados que callables ─
+    print("\n=== Test 10: tablas de códigos vs callables ===")
+    tabla_conc = tabla_codigos(MOCK_CONCEPTOS)
+    tabla_emp = tabla_codigos(MOCK_EMPLEADOS)
+    todas = t1 + t2 + t3 + t4
+    f_fn = generar_filas_dux(agrupar_por_comprobante(todas), CUITS_PROPIOS, mock_concepto_fn, mock_empleado_fn)
+    f_tab = generar_filas_dux(agrupar_por_comprobante(todas), CUITS_PROPIOS,
+                              tabla_conceptos=tabla_conc, tabla_empleados=tabla_emp)
+    check("Mismas filas ENC/DET", f_fn == f_tab, f"{len(f_tab)} filas")
+    check("DET con código de concepto", [r for r in f_tab if r[0] == "DET"][0][7] == 911)
+    errs10, _ = validar_rendiciones_para_export(t8, tabla_conceptos=tabla_conc, tabla_empleados=tabla_emp,
+                                                cuits_propios=CUITS_PROPIOS)
+    check("Concepto sin mapear detectado con tabla", len(errs10) == 1, f"errors={len(errs10)}")
+    try:
+        tabla_conc["NUEVO"] = 1
+        check("Tabla inmutable", False)
+    except TypeError:
+        check("Tabla inmutable", True)
+
+    # ── Test 11: generación en paralelo = serie ──────────────────────
+    print("\n=== Test 11: generación en paralelo ===")
+    import dux_export as _modulo  # los workers importan el módulo, no __main__
+    _modulo.MIN_GRUPOS_PARALELO, _modulo.GRUPOS_POR_TAREA = 0, 2
+    muchas = [dict(r, numero_factura=f"{n:08d}") for n in range(6) for r in todas]
+    grupos11 = agrupar_por_comprobante(muchas)
+    f_serie = generar_filas_dux(grupos11, CUITS_PROPIOS, tabla_conceptos=tabla_conc, tabla_empleados=tabla_emp)
+    f_par = _modulo.generar_filas_dux(grupos11, CUITS_PROPIOS, tabla_conceptos=tabla_conc,
+                                      tabla_empleados=tabla_emp, procesos=2)
+    check("Mismas filas y orden en paralelo", f_serie == f_par, f"{len(grupos11)} comprobantes, {len(f_par)} filas")
+    f_fn11 = _modulo.generar_filas_dux(grupos11, CUITS_PROPIOS, mock_concepto_fn, mock_empleado_fn, procesos=2)
+    check("Con callables sin tabla cae a serie", f_fn11 == f_serie)
+
+    # ── Test 12: desglose columnar = desglose por grupo ──────────────
+    print("\n=== Test 12: sumar_desgloses vs _sumar_desglose ===")
+    t12 = [dict(r) for r in t1 + t2 + t3 + t4 + t7]
+    t12[0].update(perc_iibb="$1,250.50", jurisdiccion="Tucuman")  # no inscripta → No Gravado
+    t12[-1].update(neto_gravado="1.000", perc_municipal=-5)
+    grupos12 = agrupar_por_comprobante(t12)
+    columnar = sumar_desgloses(grupos12)
+
+    def _mismo_desglose(a, b):
+        return (all(abs(a[k] - b[k]) < 1e-6 for k in a if k != "iibb")
+                and [j["provincia"] for j in a["iibb"]] == [j["provincia"] for j in b["iibb"]]
+                and all(abs(x["importe"] - y["importe"]) < 1e-6 for x, y in zip(a["iibb"], b["iibb"])))
+    check("Mismo desglose por comprobante",
+          all(_mismo_desglose(_sumar_desglose(g), columnar[k]) for k, g in grupos12.items()),
+          f"{len(grupos12)} comprobantes")
+
+    # ── Test 13: motor de reglas — reglas entre filas y tiempos ──────
+    print("\n=== Test 13: motor de reglas ===")
+    dup = [dict(t1[0], rendicion_id="R-1"), dict(t1[0], id_operacion="T1b", rendicion_id="R-2")]
+    tiempos13 = {}
+    errs13, warns13 = validar_rendiciones_para_export(dup, mock_concepto_fn, mock_empleado_fn, CUITS_PROPIOS,
+                                                      tiempos=tiempos13)
+    check("Comprobante en dos rendiciones = warning",
+          [w["tipo"] for w in warns13] == ["Comprobante en más de una rendición"] and not errs13,
+          f"warnings={[w['tipo'] for w in warns13]}")
+    check("Tiempo reportado por regla", set(tiempos13) == {r.nombre for r in REGLAS_VALIDACION})
+    solo_carpeta = [r for r in REGLAS_VALIDACION if r.nombre == "carpeta"]
+    errs13b, _ = validar_rendiciones_para_export([dict(t1[0], numero_carpeta="", cuit_proveedor="x")],
+                                                 reglas=solo_carpeta)
+    check("Subconjunto de reglas", [e["tipo"] for e in errs13b] == ["Rendición sin número de carpeta"])
+    # Guardado en 2 carpetas: col Z prorrateada (25000 + 25000 = ticket de 50000)
+    partido = [dict(t1[0], rendicion_id="R-1", numero_carpeta=c, monto_total_ticket=25000.0,
+                    monto_a_imputar=25000.0) for c in ("IMP-001", "IMP-002")]
+    errs13c, warns13c = validar_rendiciones_para_export(partido, mock_concepto_fn, mock_empleado_fn, CUITS_PROPIOS)
+    check("Comprobante partido entre carpetas no avisa", not errs13c and not warns13c,
+          f"errores={[e['tipo'] for e in errs13c]} warnings={[w['tipo'] for w in warns13c]}")
+    de_mas = [dict(p, monto_a_imputar=30000.0) for p in partido]
+    errs13d, warns13d = validar_rendiciones_para_export(de_mas, mock_concepto_fn, mock_empleado_fn, CUITS_PROPIOS)
+    check("Imputado > Monto Ticket = warning",
+          not errs13d and [w["tipo"] for w in warns13d] == ["Imputado mayor que el Monto Ticket"],
+          f"warnings={[w['tipo'] for w in warns13d]}")
+    _, warns13e = validar_rendiciones_para_export([dict(t1[0], monto_a_imputar=50000.9)],
+                                                  mock_concepto_fn, mock_empleado_fn, CUITS_PROPIOS)
+    check("Exceso dentro de la tolerancia no avisa", not warns13e)
+
     # ── Summary ──────────────────────────────────────────────────────
     print(f"\n{'='*50}")
     print(f"  {counts['passed']} PASSED, {counts['failed']} FAILED")
@@ -0,0 +1,391 @@
+"""
+extraccion_pdf.py — Extracción local de comprobantes PDF con capa de texto.
+
+Muchas facturas electrónicas llegan como PDF generado por el sistema del
+proveedor, con el texto ya embebido. En vez de mandarlas a Gemini como bytes
+opacos, se lee la capa de texto y se parsean el encabezado y las líneas de
+percepciones (PERC IIBB, PER IVA, RG 2408, Per Mun) con la misma tabla de
+jurisdicciones que usa el prompt de scan_receipt.
+
+Si el parseo queda completo devuelve un dict con el MISMO formato que
+scan_receipt; si no, devuelve None y el llamador cae al LLM.
+
+Uso:  from extraccion_pdf import extraer_comprobante_pdf
+"""
+
+import io
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# TABLA DE JURISDICCIONES (compartida con el prompt)
+# ==========================================
+
+# Código/alias impreso en la línea de percepción → jurisdicción normalizada.
+# app.py arma la tabla del prompt de Gemini desde este mismo dict, así la
+# extracción local y el LLM clasifican igual.
+JURISDICCION_ALIAS = {
+    "CBAD": "CORDOBA", "CBA": "CORDOBA", "CORDOBA": "CORDOBA",
+    "CABA": "CABA", "CAPFED": "CABA", "CFED": "CABA",
+    "BSAS": "BUENOS AIRES", "BSA": "BUENOS AIRES", "BUENOSAIRES": "BUENOS AIRES",
+    "MZA": "MENDOZA", "MENDOZA": "MENDOZA",
+    "SFE": "SANTA FE", "SANTAFE": "SANTA FE",
+    "NQN": "NEUQUEN", "NEUQUEN": "NEUQUEN",
+}
+
+# Código AFIP → letra del comprobante
+AFIP_A_LETRA = {
+    "001": "A", "002": "A", "003": "A",
+    "006": "B", "007": "B", "008": "B",
+    "011": "C", "012": "C", "013": "C",
+    "051": "M", "052": "M", "053": "M",
+}
+
+# Campos sin los cuales el parseo no se considera completo
+CAMPOS_OBLIGATORIOS = ("tipo_factura", "fecha", "cuit_proveedor", "sucursal",
+                       "numero_comprobante")
+
+# Menos caracteres que esto en la página 1 = PDF escaneado (imagen), no digital
+MIN_CARACTERES_TEXTO = 80
+
+
+def tabla_jurisdicciones_prompt(indent="            "):
+    """Renderiza JURISDICCION_ALIAS como la tabla de códigos del prompt.
+
+    Returns:
+        str: una línea por jurisdicción, ej: 'CBAD, CBA, CORDOBA → "CORDOBA"'.
+    """
+    por_destino = {}
+    for alias, destino in JURISDICCION_ALIAS.items():
+        por_destino.setdefault(destino, []).append(alias)
+    return "\n".join(
+        f'{indent}{", ".join(aliases)} → "{destino}"'
+        for destino, aliases in por_destino.items()
+    )
+
+
+# ==========================================
+# HELPERS
+# ==========================================
+
+_RE_CUIT = re.compile(r"\b(\d{2})-?(\d{8})-?(\d)\b")
+_RE_FECHA = re.compile(r"\b(\d{2})/(\d{2})/(\d{4})\b")
+
+# Líneas de percepción: "PER"/"PERC"/"PERCEPCION" + el impuesto. Sin el
+# prefijo, "Ingresos Brutos: 901-..." del encabezado AFIP o "Municipalidad de
+# ..." se tomaban como percepciones.
+_RE_PERCEPCION = re.compile(r"\bPERC?(?:EP(?:CI[OÓ]N(?:ES)?)?)?\b\.?", re.IGNORECASE)
+_RE_IIBB = re.compile(r"\b(?:IIBB|IB|ING(?:RESOS)?\.?\s*BRUTOS)\b", re.IGNORECASE)
+_RE_MUNICIPAL = re.compile(r"\bMUN(?:IC(?:IPAL)?)?\b\.?", re.IGNORECASE)
+# Importe con formato argentino (1.234,56) o anglosajón (1,234.56), con
+# decimales y que no sea una alícuota ("3,00%")
+_RE_MONTO_LINEA = re.compile(r"-?\d[\d.,]*[.,]\d{2}\b(?!\s*%)")
+
+
+def parse_importe(raw):
+    """Convierte '1.234,56', '1,234.56', '$ 1234,5' a float. None si no parsea."""
+    if raw is None:
+        return None
+    s = str(raw).replace("$", "").replace(" ", "").strip()
+    if not s:
+        return None
+    negativo = s.startswith("-")
+    s = s.lstrip("-")
+    if "," in s and "." in s:
+        # El separador que aparece último es el decimal
+        if s.rfind(",") > s.rfind("."):
+            s = s.replace(".", "").replace(",", ".")
+        else:
+            s = s.replace(",", "")
+    elif "," in s:
+        entero, _, dec = s.rpartition(",")
+        s = f"{entero.replace(',', '')}.{dec}" if len(dec) <= 2 else s.replace(",", "")
+    elif s.count(".") > 1 or (s.count(".") == 1 and len(s.rpartition(".")[2]) == 3):
+        s = s.replace(".", "")
+    try:
+        valor = float(s)
+    except ValueError:
+        return None
+    return -valor if negativo else valor
+
+
+def cuit_valido(cuit):
+    """Valida el dígito verificador de un CUIT de 11 dígitos."""
+    if not cuit or len(cuit) != 11 or not cuit.isdigit():
+        return False
+    pesos = [5, 4, 3, 2, 7, 6, 5, 4, 3, 2]
+    resto = sum(int(d) * p for d, p in zip(cuit[:10], pesos)) % 11
+    verificador = 0 if resto == 0 else (9 if resto == 1 else 11 - resto)
+    return verificador == int(cuit[10])
+
+
+def resolver_jurisdiccion(texto):
+    """Busca un alias conocido en el texto de la línea.
+
+    Returns:
+        str: jurisdicción normalizada, o "" si ningún alias coincide (el
+        parseo se considera incompleto y decide el LLM).
+    """
+    tokens = re.findall(r"[A-ZÁÉÍÓÚÑ]+", texto.upper())
+    # Probar también pares pegados ("BUENOS AIRES" → "BUENOSAIRES")
+    candidatos = tokens + [a + b for a, b in zip(tokens, tokens[1:])]
+    for tok in candidatos:
+        tok_norm = tok.translate(str.maketrans("ÁÉÍÓÚ", "AEIOU"))
+        if tok_norm in JURISDICCION_ALIAS:
+            return JURISDICCION_ALIAS[tok_norm]
+    return ""
+
+
+# ==========================================
+# LECTURA DE LA CAPA DE TEXTO
+# ==========================================
+
+def extraer_texto_pdf(pdf_bytes, max_paginas=1):
+    """Lee la capa de texto de las primeras páginas del PDF.
+
+    Solo la página 1 por defecto: las facturas AFIP repiten el comprobante
+    como ORIGINAL / DUPLICADO / TRIPLICADO y sumar páginas duplicaría importes.
+
+    Returns:
+        str: texto extraído ("" si el PDF no tiene capa de texto o pypdf falta).
+    """
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        logger.info("pypdf no instalado — extracción local de PDF deshabilitada")
+        return ""
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        partes = []
+        for page in reader.pages[:max_paginas]:
+            partes.append(page.extract_text() or "")
+        return "\n".join(partes)
+    except Exception as e:
+        logger.warning(f"No se pudo leer la capa de texto del PDF: {e}")
+        return ""
+
+
+# ==========================================
+# PARSEO
+# ==========================================
+
+def _buscar_importe(texto, patrones):
+    """Primer importe que sigue a alguna etiqueta de `patrones` (regex)."""
+    for patron in patrones:
+        m = re.search(patron + r"[^\d\n-]*(-?[\d.,]+)", texto, re.IGNORECASE | re.MULTILINE)
+        if m:
+            valor = parse_importe(m.group(1))
+            if valor is not None:
+                return valor
+    return None
+
+
+def _clasificar_percepciones(lineas):
+    """Clasifica cada línea de percepción con las mismas reglas que el prompt.
+
+    Returns:
+        dict con perc_iva, perc_ganancias, perc_iibb_lista, perc_municipal.
+    """
+    perc_iva = 0.0
+    perc_ganancias = 0.0
+    iibb = []
+    municipal = None
+
+    for linea in lineas:
+        up = linea.upper()
+        if "DESCUENTO" in up:
+            continue
+        es_iva = ("PERC IVA" in up or "PER IVA" in up or "RG 2408" in up
+                  or "R.G. 2408" in up or "PERCEPCION IVA" in up or "PERCEPCIÓN IVA" in up)
+        es_perc = bool(_RE_PERCEPCION.search(linea))
+        es_iibb = es_perc and bool(_RE_IIBB.search(linea))
+        es_muni = es_perc and bool(_RE_MUNICIPAL.search(linea))
+        es_gan = "PERC GCIAS" in up or "PER GAN" in up or "RG 830" in up
+        if not (es_iva or es_iibb or es_muni or es_gan):
+            continue
+
+        importes = _RE_MONTO_LINEA.findall(linea)
+        if not importes:
+            continue  # Sin importe: leyenda o encabezado, no una percepción
+        monto = parse_importe(importes[-1])
+        if monto is None or monto <= 0:
+            continue  # Valores negativos / vacíos se ignoran
+
+        if es_muni:
+            if municipal is None:
+                municipal = {"jurisdiccion": resolver_jurisdiccion(linea), "monto": monto}
+            else:
+                municipal["monto"] += monto
+        elif es_iibb:
+            iibb.append({"jurisdiccion": resolver_jurisdiccion(linea), "monto": monto})
+        elif es_iva:
+            perc_iva += monto
+        elif es_gan:
+            perc_ganancias += monto
+
+    return {
+        "perc_iva": round(perc_iva, 2),
+        "perc_ganancias": round(perc_ganancias, 2),
+        "perc_iibb_lista": iibb,
+        "perc_municipal": municipal,
+    }
+
+
+def parsear_texto_comprobante(texto):
+    """Parsea el texto de una factura electrónica al formato de scan_receipt.
+
+    Returns:
+        dict: campos en el formato de scan_receipt. Los que no se pudieron leer
+        quedan en None; usar es_parseo_completo() para decidir el fallback.
+    """
+    lineas = [l.strip() for l in texto.splitlines() if l.strip()]
+
+    # — Código AFIP y letra —
+    codigo_afip = None
+    m = re.search(r"C[OÓ]D(?:IGO)?\.?\s*N?[°º]?\s*:?\s*(\d{1,3})\b", texto, re.IGNORECASE)
+    if m:
+        codigo_afip = m.group(1).zfill(3)
+    tipo = AFIP_A_LETRA.get(codigo_afip) if codigo_afip else None
+    if not tipo:
+        m = re.search(r"\bFACTURA\s+([ABCM])\b", texto, re.IGNORECASE)
+        if m:
+            tipo = m.group(1).upper()
+    if not tipo and re.search(r"\bTIQUE|\bTICKET", texto, re.IGNORECASE):
+        tipo = "TICKET"
+
+    # — Punto de venta y número —
+    sucursal = numero = None
+    m = re.search(r"Punto\s+de\s+Venta\s*:?\s*(\d{1,5})", texto, re.IGNORECASE)
+    if m:
+        sucursal = m.group(1).zfill(5)
+    m = re.search(r"Comp(?:robante)?\.?\s*N(?:ro|°|º)\.?\s*:?\s*(\d{1,8})", texto, re.IGNORECASE)
+    if m:
+        numero = m.group(1).zfill(8)
+    if not (sucursal and numero):
+        m = re.search(r"\b(\d{4,5})\s*-\s*(\d{8})\b", texto)
+        if m:
+            sucursal = sucursal or m.group(1).zfill(5)
+            numero = numero or m.group(2)
+
+    # — Fecha —
+    fecha = None
+    m = re.search(r"Fecha\s+de\s+Emisi[oó]n\s*:?\s*(\d{2}/\d{2}/\d{4})", texto, re.IGNORECASE)
+    if m:
+        fecha = m.group(1)
+    else:
+        m = _RE_FECHA.search(texto)
+        if m:
+            fecha = m.group(0)
+
+    # — CUITs: el primero válido es el emisor, el siguiente distinto el receptor —
+    cuits = []
+    for m in _RE_CUIT.finditer(texto):
+        cuit = "".join(m.groups())
+        if cuit_valido(cuit) and cuit not in cuits:
+            cuits.append(cuit)
+    cuit_proveedor = cuits[0] if cuits else None
+    cuit_cliente = cuits[1] if len(cuits) > 1 else None
+
+    proveedor = None
+    m = re.search(r"Raz[oó]n\s+Social\s*:?\s*(.+)", texto, re.IGNORECASE)
+    if m:
+        proveedor = m.group(1).strip()
+        # Los PDFs AFIP suelen pegar "Fecha de Emisión" en la misma línea
+        proveedor = re.split(r"\s{2,}|Fecha\s+de|Domicilio", proveedor)[0].strip() or None
+
+    # — Importes de pie —
+    monto_total = _buscar_importe(texto, [r"Importe\s+Total", r"\bTOTAL\s+A\s+PAGAR", r"^\s*TOTAL\b"])
+    neto = _buscar_importe(texto, [r"Importe\s+Neto\s+Gravado", r"Neto\s+Gravado", r"Subtotal"]) or 0.0
+    no_gravado = _buscar_importe(texto, [r"No\s+Gravado"]) or 0.0
+    exento = _buscar_importe(texto, [r"Importe\s+Exento", r"\bExento"]) or 0.0
+    iva_21 = _buscar_importe(texto, [r"IVA\s*:?\s*21\s*%", r"IVA\s+21"]) or 0.0
+    iva_105 = _buscar_importe(texto, [r"IVA\s*:?\s*10[,.]5\s*%", r"IVA\s+10[,.]5"]) or 0.0
+    iva_27 = _buscar_importe(texto, [r"IVA\s*:?\s*27\s*%", r"IVA\s+27"]) or 0.0
+
+    percepciones = _clasificar_percepciones(lineas)
+
+    resultado = {
+        "tipo_factura": tipo,
+        "codigo_afip": codigo_afip,
+        "fecha": fecha,
+        "proveedor": proveedor,
+        "cuit_proveedor": cuit_proveedor,
+        "cuit_cliente": cuit_cliente,
+        "sucursal": sucursal,
+        "numero_comprobante": numero,
+        "neto_gravado": neto,
+        "no_gravado": no_gravado,
+        "exento": exento,
+        "iva_21": iva_21,
+        "iva_10_5": iva_105,
+        "iva_27": iva_27,
+        "monto_total": monto_total,
+        "warning_total_no_cuadra": False,
+        **percepciones,
+    }
+
+    # Factura B/C/Ticket: nunca se discriminan impuestos, todo a no_gravado
+    if tipo != "A" and monto_total is not None:
+        for campo in ("neto_gravado", "exento", "iva_21", "iva_10_5", "iva_27",
+                      "perc_iva", "perc_ganancias"):
+            resultado[campo] = 0.0
+        resultado["perc_iibb_lista"] = []
+        resultado["perc_municipal"] = None
+        resultado["no_gravado"] = monto_total
+
+    return resultado
+
+
+def _suma_componentes(r):
+    """Misma suma de control que la VALIDACIÓN INTERNA del prompt."""
+    muni = r.get("perc_municipal") or {}
+    return (r["neto_gravado"] + r["no_gravado"] + r["exento"] + r["iva_21"]
+            + r["iva_10_5"] + r["iva_27"] + r["perc_iva"] + r["perc_ganancias"]
+            + sum(p["monto"] for p in r["perc_iibb_lista"])
+            + float(muni.get("monto", 0) or 0))
+
+
+def es_parseo_completo(resultado):
+    """True si el parseo local alcanza para saltear el LLM.
+
+    Exige los campos de encabezado obligatorios, un total positivo, jurisdicción
+    conocida en cada IIBB y que la suma de componentes cuadre con el total
+    (tolerancia $1, igual que el prompt).
+    """
+    if not resultado:
+        return False
+    for campo in CAMPOS_OBLIGATORIOS:
+        if not resultado.get(campo):
+            return False
+    total = resultado.get("monto_total")
+    if not total or total <= 0:
+        return False
+    if any(not p.get("jurisdiccion") for p in resultado.get("perc_iibb_lista") or []):
+        return False
+    return abs(_suma_componentes(resultado) - total) <= 1
+
+
+def extraer_comprobante_pdf(pdf_bytes):
+    """Extrae un comprobante desde la capa de texto de un PDF digital.
+
+    Returns:
+        dict en el formato de scan_receipt si el parseo es completo,
+        None si el PDF no tiene texto o el parseo quedó incompleto.
+    """
+    texto = extraer_texto_pdf(pdf_bytes)
+    if len(texto.strip()) < MIN_CARACTERES_TEXTO:
+        return None
+
+    resultado = parsear_texto_comprobante(texto)
+    if not es_parseo_completo(resultado):
+        faltantes = [c for c in CAMPOS_OBLIGATORIOS if not resultado.get(c)]
+        logger.info(f"PDF con texto pero parseo incompleto (faltan: {faltantes or 'cuadre'}) — fallback a IA")
+        return None
+
+    logger.info(
+        f"PDF parseado localmente: {resultado['tipo_factura']} "
+        f"{resultado['sucursal']}-{resultado['numero_comprobante']} ${resultado['monto_total']:,.2f}"
+    )
+    return resultado
@@ -0,0 +1,187 @@
+"""
+guardado.py — Pipeline de "Guardar comprobante" como trabajo en segundo plano.
+
+app.py arma los payloads (uno por carpeta) y llama a encolar_guardado(); el
+operador recibe el ID del trabajo al instante y puede seguir con el próximo
+comprobante. El worker ejecuta los pasos en orden, cada uno registrado en el
+trabajo para que un reintento no repita lo que ya se hizo:
+
+  subida          → upload_receipt_to_drive (una vez, con reintentos propios;
+                    si Drive sigue fallando se guarda sin link y con aviso)
+  log_<i>         → log_rendicion_to_sheet por carpeta
+  eventos/ledger  → un único append de eventos IMPUTACION a IMPUTACIONES_LEDGER
+  saldos          → materializa esos eventos en CONTROL_SALDOS
+  alerta          → encolar_alerta_exceso en el outbox (si excede el sugerido)
+
+Los pasos que escriben en la planilla toleran repetirse: si un paso salió
+pero no llegó a registrarse, el reintento no duplica (log por clave_fila,
+ledger por ID_Evento). Los guardados que agotan los reintentos quedan en
+ERROR y se relanzan desde admin (guardados_con_error + trabajos.reintentar).
+"""
+
+import logging
+import threading
+import time
+
+import data
+import notificaciones
+import trabajos
+
+logger = logging.getLogger(__name__)
+
+TIPO_GUARDADO = "guardar_comprobante"
+
+# log_rendicion_to_sheet calcula la próxima fila libre leyendo la hoja: dos
+# workers escribiendo a la vez pisarían la misma fila. La subida a Drive sí
+# corre en paralelo.
+_lock_planilla = threading.Lock()
+
+# Esperas entre reintentos de la subida (solo ese paso: el resto no se repite)
+ESPERAS_REINTENTO_SUBIDA = [2, 5, 15]
+
+
+def encolar_guardado(payloads, archivo=None, nombre_archivo="", mime_type="", estado_override=None,
+                     excede_sugerido=False):
+    """Registra el guardado de un comprobante y devuelve el ID del trabajo.
+
+    Args:
+        payloads: lista de payloads de log_rendicion_to_sheet (uno por carpeta).
+        archivo: bytes del comprobante a subir a Drive (None = sin comprobante).
+        nombre_archivo: nombre en Drive.
+        mime_type: MIME del archivo.
+        estado_override: estado forzado del log (ej: "PENDIENTE REVISIÓN").
+        excede_sugerido: si True, se envía la alerta de exceso al terminar.
+    """
+    # Un ID Operación por guardado, compartido por sus carpetas (clave_fila
+    # = ID + carpeta); queda en el trabajo, así un reintento usa el mismo.
+    id_operacion = data.nuevo_id_operacion()
+    payloads = [dict(p, id_operacion=p.get("id_operacion") or id_operacion) for p in payloads]
+    datos = {
+        "payloads": payloads,
+        "nombre_archivo": nombre_archivo,
+        "mime_type": mime_type,
+        "estado_override": estado_override,
+        "excede_sugerido": excede_sugerido,
+    }
+    return trabajos.encolar(TIPO_GUARDADO, datos, archivo)
+
+
+def _subir(archivo, nombre_archivo, mime_type):
+    """Sube el comprobante, reintentando solo esta llamada.
+
+    Si Drive sigue fallando no hace fallar el guardado: la rendición se
+    loguea con el link vacío y el error queda en "error" para avisar.
+    """
+    error_msg = ""
+    for espera in [0] + ESPERAS_REINTENTO_SUBIDA:
+        if espera:
+            time.sleep(espera)
+        try:
+            link, file_id, error_msg = data.upload_receipt_to_drive(archivo, nombre_archivo, mime_type)
+        except Exception as e:
+            link, file_id, error_msg = None, None, str(e)
+        if link:
+            return {"ticket_link": link, "file_id": file_id}
+        logger.warning(f"Subida a Drive de {nombre_archivo} falló: {error_msg}")
+    return {"ticket_link": "", "file_id": None, "error": f"Error subiendo archivo a Drive: {error_msg}"}
+
+
+def _loguear(payload, ticket_link, estado_override):
+    if not data.log_rendicion_to_sheet(payload, ticket_link, estado_override=estado_override):
+        raise RuntimeError(f"Error guardando carpeta {payload.get('numero_carpeta')}")
+    return True
+
+
+def _exigir(resultado, contexto):
+    """(ok, msg) de data.* → msg, o excepción para que el trabajo reintente."""
+    ok, msg = resultado
+    if not ok:
+        raise RuntimeError(f"{contexto}: {msg}")
+    return msg
+
+
+def _alertar(payload, ticket_link):
+    """Encola la alerta (el envío real lo hace el outbox de notificaciones).
+
+    No hace fallar el guardado: el resultado queda en el trabajo.
+    """
+    try:
+        gsheets_client, _ = data.get_gsheets_client()
+        sheet_id = data._get_sheet_id()
+        if not (gsheets_client and sheet_id):
+            return {"ok": False, "mensaje": "Sin cliente de Sheets para leer destinatarios"}
+        mail_ok, mail_msg = notificaciones.encolar_alerta_exceso(payload, ticket_link, gsheets_client, sheet_id)
+        return {"ok": mail_ok, "mensaje": mail_msg}
+    except Exception as e:
+        logger.warning(f"No se pudo encolar la alerta de exceso: {e}")
+        return {"ok": False, "mensaje": str(e)}
+
+
+@trabajos.registrar(TIPO_GUARDADO)
+def ejecutar_guardado(datos, archivo, paso):
+    payloads = datos["payloads"]
+    estado_override = datos.get("estado_override")
+
+    ticket_link, subida_error = "", None
+    if archivo:
+        subida = paso("subida", lambda: _subir(archivo, datos["nombre_archivo"], datos["mime_type"]))
+        ticket_link, subida_error = subida["ticket_link"], subida.get("error")
+
+    for i, payload in enumerate(payloads):
+        with _lock_planilla:
+            paso(f"log_{i}", lambda: _loguear(payload, ticket_link, estado_override))
+
+    # Los eventos se generan una vez y quedan en el trabajo, con su ID_Evento.
+    # Si el append salió pero el paso no llegó a registrarse, el reintento los
+    # agrega de nuevo: el fold los cuenta una vez (dedupe por ID_Evento) y
+    # "saldos" escribe valores absolutos del fold, así que reintentar no duplica.
+    eventos = paso("eventos", lambda: data.eventos_imputacion(payloads))
+    paso("ledger", lambda: _exigir(data.registrar_eventos_ledger(eventos), "Error escribiendo ledger"))
+    paso("saldos", lambda: _exigir(data.materializar_saldos(eventos), "Error actualizando saldos"))
+
+    alerta = None
+    if datos.get("excede_sugerido") and payloads:
+        # Último payload como representativo del mail (igual que antes)
+        alerta = paso("alerta", lambda: _alertar(payloads[-1], ticket_link))
+
+    return {"ticket_link": ticket_link, "carpetas": len(payloads), "alerta": alerta,
+            "subida_error": subida_error}
+
+
+def guardados_con_error(limite=50):
+    """Guardados en ERROR (de cualquier sesión), para relanzarlos desde admin."""
+    resumen = []
+    for trabajo in trabajos.listar([trabajos.ERROR], limite=limite):
+        if trabajo["tipo"] != TIPO_GUARDADO:
+            continue
+        payloads = trabajo["datos"].get("payloads") or [{}]
+        primero = payloads[0]
+        resumen.append({
+            "id": trabajo["id"], "creado": trabajo["creado"], "error": trabajo["error"],
+            "usuario": primero.get("usuario", ""), "proveedor_cuit": primero.get("proveedor_cuit", ""),
+            "comprobante": f"{primero.get('sucursal_factura', '')}-{primero.get('numero_factura', '')}",
+            "carpetas": [str(p.get("numero_carpeta") or "") for p in payloads],
+            "pasos": len(trabajo["pasos"]),
+        })
+    return resumen
+
+
+def estado_guardado(trabajo_id):
+    """Resumen para la UI: (estado, detalle)."""
+    trabajo = trabajos.obtener(trabajo_id)
+    if not trabajo:
+        return "DESCONOCIDO", ""
+    if trabajo["estado"] == trabajos.OK:
+        resultado = trabajo["resultado"] or {}
+        avisos = []
+        if resultado.get("subida_error"):
+            avisos.append(f"Guardado sin comprobante en Drive ({resultado['subida_error']})")
+        alerta = resultado.get("alerta")
+        if alerta and not alerta.get("ok"):
+            avisos.append(f"Sin notificación automática: {alerta.get('mensaje')}")
+        return trabajo["estado"], " — ".join(avisos)
+    n_pasos = len(trabajo["pasos"])
+    detalle = f"{n_pasos} paso(s) completado(s)"
+    if trabajo["error"]:
+        detalle += f" — {trabajo['error']}"
+    return trabajo["estado"], detalle
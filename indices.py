@@ -0,0 +1,449 @@
+"""
+indices.py — Índices en memoria sobre hojas de Google Sheets.
+
+IndicePendientes guarda las filas de RENDICIONES_LOG en PENDIENTE REVISIÓN
+(con su número de fila) ordenadas por fecha, y responde consultas por rango
+de fechas, oficina y usuario con paginación sin volver a leer el log.
+
+IndiceFilasLog resuelve la clave estable de una fila del log (ID Operación +
+carpeta, ver clave_fila) o un Rendicion_ID a su número de fila actual. Tiene
+un número de versión que cambia en cada recarga; quien lo usa verifica la
+fila leída contra la clave y, si no coincide (filas insertadas u ordenadas a
+mano), recarga solo las columnas de IDs.
+
+IndiceExportados refleja EXPORT_DUX_ITEMS/LOTES: qué filas del log ya se
+exportaron a Dux, cuáles quedaron diferidas (todavía no exportables) y la
+marca de agua (última fila del log revisada por un export incremental).
+
+IndiceSaldos ubica la fila de CONTROL_SALDOS de cada (cuit, id_factura) con
+su respaldo e imputado actuales, para que actualizar/revertir un saldo sea un
+único batch_update sin leer la hoja entera. Se carga una vez (get_all_values)
+y lo mantienen al día las funciones de data.py que escriben la hoja. Si algo
+falla a mitad de una escritura, el escritor lo invalida y la próxima
+operación recarga. Vence cada TTL_SEGUNDOS por si alguien edita la hoja a mano.
+
+Además mantiene, por proveedor, las facturas con saldo abierto ordenadas por
+saldo restante (bisect), para que mejor_ajuste() devuelva la factura con el
+menor saldo suficiente en O(log n) y asignar() reparta un monto entre varias
+cuando ninguna alcanza sola.
+
+Uso:
+    with INDICE_SALDOS.bloqueo():
+        INDICE_SALDOS.asegurar(ws, sheet_id)
+        entrada = INDICE_SALDOS.buscar(cuit, id_factura)
+        ...
+        INDICE_SALDOS.actualizar(cuit, id_factura, imputado=nuevo)
+"""
+
+import time
+import bisect
+import logging
+import threading
+
+from dux_export import safe_float
+
+logger = logging.getLogger(__name__)
+
+TTL_SEGUNDOS = 600
+SALDO_MINIMO = 0.005  # por debajo, la factura se considera cerrada
+
+
+class IndiceSaldos:
+    """(cuit, id_factura) → {"fila", "respaldo", "imputado"} de CONTROL_SALDOS."""
+
+    def __init__(self, ttl=TTL_SEGUNDOS):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._mapa = {}
+        self._abiertas = {}  # cuit sin guiones → [(saldo, id_factura, cuit)] ordenado
+        self._ultima_fila = 1  # fila del header
+        self._clave = None
+        self._cargado_en = 0.0
+
+    @staticmethod
+    def _k(cuit, id_factura):
+        return str(cuit).strip(), str(id_factura).strip()
+
+    @staticmethod
+    def _cuit(cuit):
+        return str(cuit).replace("-", "").strip()
+
+    # --- facturas abiertas por proveedor ---
+
+    def _quitar_abierta(self, k, entrada):
+        lista = self._abiertas.get(self._cuit(k[0]))
+        if not lista:
+            return
+        item = (entrada["respaldo"] - entrada["imputado"], k[1], k[0])
+        i = bisect.bisect_left(lista, item)
+        if i < len(lista) and lista[i] == item:
+            del lista[i]
+
+    def _poner_abierta(self, k, entrada):
+        saldo = entrada["respaldo"] - entrada["imputado"]
+        if saldo >= SALDO_MINIMO:
+            bisect.insort(self._abiertas.setdefault(self._cuit(k[0]), []), (saldo, k[1], k[0]))
+
+    def bloqueo(self):
+        """Lock reentrante para secuencias buscar → escribir → actualizar."""
+        return self._lock
+
+    def vigente(self, clave=None):
+        with self._lock:
+            return (self._clave is not None and self._clave == clave
+                    and time.monotonic() - self._cargado_en < self.ttl)
+
+    def cargar_desde_valores(self, valores, clave=None):
+        """Construye el índice a partir de get_all_values() (con header)."""
+        with self._lock:
+            self._mapa = {}
+            self._abiertas = {}
+            for i, row in enumerate(valores):
+                if i == 0 or len(row) < 2:
+                    continue
+                k = self._k(row[0], row[1])
+                if not k[0] and not k[1]:
+                    continue
+                if k not in self._mapa:  # misma regla que el escaneo lineal: gana la primera
+                    self._mapa[k] = {
+                        "fila": i + 1,
+                        "respaldo": safe_float(row[2]) if len(row) > 2 else 0.0,
+                        "imputado": safe_float(row[3]) if len(row) > 3 else 0.0,
+                    }
+                    self._poner_abierta(k, self._mapa[k])
+            self._ultima_fila = max(1, len(valores))
+            self._clave = clave
+            self._cargado_en = time.monotonic()
+            logger.info(f"Índice CONTROL_SALDOS cargado: {len(self._mapa)} facturas")
+
+    def asegurar(self, ws, clave=None):
+        """Carga el índice desde la hoja si no está vigente."""
+        with self._lock:
+            if not self.vigente(clave):
+                self.cargar_desde_valores(ws.get_all_values(), clave)
+
+    def invalidar(self):
+        with self._lock:
+            self._clave = None
+
+    def buscar(self, cuit, id_factura):
+        with self._lock:
+            entrada = self._mapa.get(self._k(cuit, id_factura))
+            return dict(entrada) if entrada else None
+
+    def proxima_fila(self):
+        with self._lock:
+            return self._ultima_fila + 1
+
+    def actualizar(self, cuit, id_factura, imputado=None, respaldo=None):
+        with self._lock:
+            k = self._k(cuit, id_factura)
+            entrada = self._mapa.get(k)
+            if entrada is None:
+                return
+            self._quitar_abierta(k, entrada)
+            if imputado is not None:
+                entrada["imputado"] = round(imputado, 2)
+            if respaldo is not None:
+                entrada["respaldo"] = round(respaldo, 2)
+            self._poner_abierta(k, entrada)
+
+    def agregar(self, cuit, id_factura, fila, respaldo, imputado):
+        with self._lock:
+            k = self._k(cuit, id_factura)
+            if k in self._mapa:
+                self._quitar_abierta(k, self._mapa[k])
+            self._mapa[k] = {
+                "fila": fila, "respaldo": round(respaldo, 2), "imputado": round(imputado, 2),
+            }
+            self._poner_abierta(k, self._mapa[k])
+            self._ultima_fila = max(self._ultima_fila, fila)
+
+    def mejor_ajuste(self, cuit, monto):
+        """Factura abierta del proveedor con el menor saldo >= monto.
+
+        Returns:
+            dict {"id_factura", "saldo", "fila"} o None si ninguna alcanza.
+        """
+        with self._lock:
+            lista = self._abiertas.get(self._cuit(cuit), [])
+            i = bisect.bisect_left(lista, (monto - SALDO_MINIMO,))
+            if i == len(lista):
+                return None
+            saldo, id_factura, cuit_hoja = lista[i]
+            return {"id_factura": id_factura, "saldo": saldo, "fila": self._mapa[(cuit_hoja, id_factura)]["fila"]}
+
+    def asignar(self, cuit, monto):
+        """Reparte monto entre facturas abiertas del proveedor.
+
+        Si una sola alcanza, usa el mejor ajuste. Si no, toma de mayor a menor
+        saldo (la menor cantidad de facturas posible) hasta cubrir el monto.
+
+        Returns:
+            list de {"id_factura", "saldo", "fila", "monto"}; vacía si el saldo
+            total del proveedor no alcanza.
+        """
+        with self._lock:
+            unica = self.mejor_ajuste(cuit, monto)
+            if unica:
+                return [dict(unica, monto=round(monto, 2))]
+            lista = self._abiertas.get(self._cuit(cuit), [])
+            if sum(item[0] for item in lista) < monto - SALDO_MINIMO:
+                return []
+            asignacion, restante = [], monto
+            for saldo, id_factura, cuit_hoja in reversed(lista):
+                if restante < SALDO_MINIMO:
+                    break
+                tomado = min(saldo, restante)
+                asignacion.append({"id_factura": id_factura, "saldo": saldo, "monto": round(tomado, 2),
+                                   "fila": self._mapa[(cuit_hoja, id_factura)]["fila"]})
+                restante -= tomado
+            return asignacion
+
+    def __len__(self):
+        with self._lock:
+            return len(self._mapa)
+
+
+class IndicePendientes:
+    """Rendiciones en PENDIENTE REVISIÓN, por fila de RENDICIONES_LOG.
+
+    Cada pendiente es el dict que arma data.py (con "row_idx", "clave" y
+    "fecha"). data.py agrega al loguear una rendición pendiente y quita al
+    aprobar/rechazar. Si el log se ordena o se insertan filas, "row_idx" puede
+    quedar viejo hasta la próxima carga (TTL): por eso aprobar/rechazar
+    trabajan con la clave_fila y re-verifican la fila antes de escribir.
+    """
+
+    def __init__(self, ttl=TTL_SEGUNDOS):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._por_fila = {}
+        self._orden = []  # [(fecha[:10], row_idx)] ordenado
+        self._clave = None
+        self._cargado_en = 0.0
+
+    @staticmethod
+    def _item(pendiente):
+        return str(pendiente.get("fecha", ""))[:10], pendiente["row_idx"]
+
+    def bloqueo(self):
+        return self._lock
+
+    def vigente(self, clave=None):
+        with self._lock:
+            return (self._clave is not None and self._clave == clave
+                    and time.monotonic() - self._cargado_en < self.ttl)
+
+    def cargar(self, pendientes, clave=None):
+        with self._lock:
+            self._por_fila = {p["row_idx"]: p for p in pendientes}
+            self._orden = sorted(self._item(p) for p in pendientes)
+            self._clave = clave
+            self._cargado_en = time.monotonic()
+            logger.info(f"Índice de pendientes cargado: {len(self._por_fila)} rendiciones")
+
+    def invalidar(self):
+        with self._lock:
+            self._clave = None
+
+    def agregar(self, pendiente, clave=None):
+        """Suma una rendición recién logueada (si el índice está cargado para esa hoja)."""
+        with self._lock:
+            if not self.vigente(clave):
+                return  # la próxima carga la va a leer del log
+            self.quitar(pendiente["row_idx"])
+            self._por_fila[pendiente["row_idx"]] = pendiente
+            bisect.insort(self._orden, self._item(pendiente))
+
+    def quitar(self, row_idx):
+        with self._lock:
+            pendiente = self._por_fila.pop(row_idx, None)
+            if pendiente is None:
+                return
+            item = self._item(pendiente)
+            i = bisect.bisect_left(self._orden, item)
+            if i < len(self._orden) and self._orden[i] == item:
+                del self._orden[i]
+
+    def obtener(self, row_idx):
+        with self._lock:
+            return self._por_fila.get(row_idx)
+
+    def consultar(self, fecha_desde=None, fecha_hasta=None, oficina=None, usuario=None,
+                  pagina=1, por_pagina=20):
+        """Pendientes filtrados, ordenados por fecha.
+
+        Args:
+            fecha_desde / fecha_hasta: "YYYY-MM-DD" inclusive (None = abierto).
+            oficina / usuario: igualdad exacta (None o "" = todos).
+            pagina: 1-based.
+
+        Returns:
+            (list, int): (pendientes de la página, total que cumple el filtro)
+        """
+        with self._lock:
+            ini = bisect.bisect_left(self._orden, (fecha_desde,)) if fecha_desde else 0
+            fin = bisect.bisect_right(self._orden, (fecha_hasta, float("inf"))) if fecha_hasta else len(self._orden)
+            filtrados = [
+                self._por_fila[row_idx] for _, row_idx in self._orden[ini:fin]
+                if (not oficina or self._por_fila[row_idx].get("oficina") == oficina)
+                and (not usuario or self._por_fila[row_idx].get("usuario") == usuario)
+            ]
+        desde = max(0, (pagina - 1) * por_pagina)
+        return filtrados[desde:desde + por_pagina], len(filtrados)
+
+    def valores(self, campo):
+        """Valores distintos de un campo (para armar los filtros)."""
+        with self._lock:
+            return sorted({str(p.get(campo, "")) for p in self._por_fila.values() if p.get(campo)})
+
+    def __len__(self):
+        with self._lock:
+            return len(self._por_fila)
+
+
+def clave_fila(id_operacion, numero_carpeta):
+    """Clave estable de una fila de RENDICIONES_LOG.
+
+    El ID Operación (timestamp + sufijo aleatorio, ver
+    data.nuevo_id_operacion) se comparte entre las filas prorrateadas de un
+    mismo guardado (una por carpeta); con la carpeta queda única.
+    """
+    return f"{str(id_operacion).strip()}/{str(numero_carpeta).strip()}"
+
+
+class IndiceFilasLog:
+    """clave_fila → fila y Rendicion_ID → filas de RENDICIONES_LOG."""
+
+    def __init__(self, ttl=TTL_SEGUNDOS):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._filas = {}
+        self._por_rendicion = {}
+        self._clave = None
+        self._cargado_en = 0.0
+        self.version = 0
+
+    def bloqueo(self):
+        return self._lock
+
+    def vigente(self, clave=None):
+        with self._lock:
+            return (self._clave is not None and self._clave == clave
+                    and time.monotonic() - self._cargado_en < self.ttl)
+
+    def cargar(self, ids_operacion, carpetas, rendicion_ids, clave=None):
+        """Construye el índice desde las columnas A, E y AO (sin header, fila 2 en adelante)."""
+        with self._lock:
+            self._filas, self._por_rendicion = {}, {}
+            for i, id_op in enumerate(ids_operacion):
+                if not str(id_op).strip():
+                    continue
+                carpeta = carpetas[i] if i < len(carpetas) else ""
+                rid = str(rendicion_ids[i]).strip() if i < len(rendicion_ids) else ""
+                self._registrar(i + 2, id_op, carpeta, rid)
+            self._clave = clave
+            self._cargado_en = time.monotonic()
+            self.version += 1
+            logger.info(f"Índice de filas del log cargado (v{self.version}): {len(self._filas)} filas")
+
+    def _registrar(self, fila, id_operacion, carpeta, rendicion_id):
+        k = clave_fila(id_operacion, carpeta)
+        if k in self._filas:
+            logger.warning(f"Clave de fila duplicada en RENDICIONES_LOG: {k} (filas {self._filas[k]} y {fila})")
+            return
+        self._filas[k] = fila
+        if rendicion_id:
+            self._por_rendicion.setdefault(rendicion_id, []).append(fila)
+
+    def invalidar(self):
+        with self._lock:
+            self._clave = None
+
+    def agregar(self, fila, id_operacion, carpeta, rendicion_id="", clave=None):
+        """Suma una fila recién logueada (si el índice está cargado para esa hoja)."""
+        with self._lock:
+            if self.vigente(clave):
+                self._registrar(fila, id_operacion, carpeta, str(rendicion_id or "").strip())
+
+    def resolver(self, clave):
+        with self._lock:
+            return self._filas.get(clave)
+
+    def filas_de_rendicion(self, rendicion_id):
+        with self._lock:
+            return list(self._por_rendicion.get(str(rendicion_id).strip(), []))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._filas)
+
+
+class IndiceExportados:
+    """Claves de fila (ver clave_fila) ya exportadas a Dux.
+
+    Se carga de EXPORT_DUX_ITEMS y, vencido el TTL, se actualiza leyendo solo
+    las filas de ITEMS agregadas desde la última lectura (`filas_leidas`).
+    """
+
+    EXPORTADA = "EXPORTADA"
+
+    def __init__(self, ttl=TTL_SEGUNDOS):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._exportadas = set()
+        self.filas_leidas = 0  # filas de EXPORT_DUX_ITEMS leídas (header incluido)
+        self.version = 0  # cambia con cada carga o lote registrado
+        self._clave = None
+        self._cargado_en = 0.0
+
+    def bloqueo(self):
+        return self._lock
+
+    def vigente(self, clave=None):
+        with self._lock:
+            return (self._clave is not None and self._clave == clave
+                    and time.monotonic() - self._cargado_en < self.ttl)
+
+    def cargado_para(self, clave=None):
+        """True si hay una carga de esa hoja (aunque venció): alcanza con leer la cola."""
+        with self._lock:
+            return self._clave is not None and self._clave == clave
+
+    def cargar(self, items, filas_leidas, clave=None, incremental=False):
+        """items: [(clave_fila, estado)]. incremental=True suma a lo ya cargado."""
+        with self._lock:
+            if not incremental:
+                self._exportadas = set()
+            for clave_item, estado in items:
+                if estado == self.EXPORTADA:
+                    self._exportadas.add(clave_item)
+            self.filas_leidas = filas_leidas
+            if items or not incremental:
+                self.version += 1
+            self._clave = clave
+            self._cargado_en = time.monotonic()
+            logger.info(f"Índice de export Dux {'actualizado' if incremental else 'cargado'}: "
+                        f"{len(self._exportadas)} exportadas ({len(items)} ítems leídos)")
+
+    def registrar(self, claves):
+        """Aplica un lote ya escrito en la hoja (filas_leidas no cambia: la
+        próxima lectura de la cola las vuelve a ver, sin efecto)."""
+        with self._lock:
+            self._exportadas.update(claves)
+            self.version += 1
+
+    def invalidar(self):
+        with self._lock:
+            self._clave = None
+
+    def exportada(self, clave_item):
+        with self._lock:
+            return clave_item in self._exportadas
+
+
+INDICE_SALDOS = IndiceSaldos()
+INDICE_PENDIENTES = IndicePendientes()
+INDICE_FILAS_LOG = IndiceFilasLog()
+INDICE_EXPORTADOS = IndiceExportados()
@@ -8,10 +8,17 @@ SMTP Gmail (Google Workspace). Credenciales en st.secrets:
     password = "xxxx xxxx xxxx xxxx"   # app password de Gmail
     from_name = "Expoconsult Rendiciones"
     dry_run = false
+
+Las alertas no se mandan dentro del guardado: se encolan en un outbox en
+SQLite (almacen_local) y un hilo de envío las despacha reusando una única
+conexión SMTP autenticada. Las alertas de una misma rendición que llegan
+dentro del período de silencio salen juntas en un solo mail (digest).
 """
 
+import time
 import smtplib
 import logging
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
@@ -19,6 +26,9 @@ from datetime import datetime
 import streamlit as st
 import gspread
 
+import almacen_local
+from almacen_local import a_json, de_json, ahora
+
 logger = logging.getLogger(__name__)
 
 # ==========================================
@@ -203,42 +213,119 @@ def _generar_html_exceso(payload, ticket_url):
     """
 
 
+def _generar_html_digest(items):
+    """Cuerpo HTML de un digest: varias alertas de la misma rendición.
+
+    Args:
+        items: lista de (payload, ticket_url).
+    """
+    primero = items[0][0]
+    filas = []
+    total_exceso = 0.0
+    for i, (payload, ticket_url) in enumerate(items):
+        sugerido = float(payload.get("monto_sugerido_concepto", 0) or 0)
+        imputado = float(payload.get("monto_a_imputar", 0) or 0)
+        diferencia = imputado - sugerido
+        total_exceso += diferencia
+        link_html = f'<a href="{ticket_url}">Ver</a>' if ticket_url else "---"
+        fondo = ' style="background: #f5f5f5;"' if i % 2 == 0 else ""
+        filas.append(f"""
+            <tr{fondo}>
+                <td style="padding: 6px; border: 1px solid #ddd;">{payload.get("concepto", "---")}</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">{payload.get("proveedor_nombre", "---")}</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">{payload.get("numero_carpeta", "---")}</td>
+                <td style="padding: 6px; border: 1px solid #ddd; text-align: right;">${sugerido:,.2f}</td>
+                <td style="padding: 6px; border: 1px solid #ddd; text-align: right;">${imputado:,.2f}</td>
+                <td style="padding: 6px; border: 1px solid #ddd; text-align: right; color: #d32f2f;">+${diferencia:,.2f}</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">{link_html}</td>
+            </tr>""")
+
+    return f"""
+    <html>
+    <body style="font-family: Arial, sans-serif; color: #333; max-width: 800px;">
+        <h2 style="color: #d32f2f;">{len(items)} comprobantes exceden el monto sugerido</h2>
+        <p>Rendici&oacute;n <strong>{primero.get("rendicion_id", "---")}</strong> de
+        <strong>{primero.get("usuario", "---")}</strong> ({primero.get("oficina", "---")}, {primero.get("fecha", "---")}).
+        Todos quedaron en estado <strong>PENDIENTE REVISI&Oacute;N</strong>.</p>
+
+        <table style="border-collapse: collapse; width: 100%; margin: 16px 0; font-size: 13px;">
+            <tr style="background: #eeeeee; font-weight: bold;">
+                <td style="padding: 6px; border: 1px solid #ddd;">Concepto</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">Proveedor</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">Carpeta</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">Sugerido</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">Imputado</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">Diferencia</td>
+                <td style="padding: 6px; border: 1px solid #ddd;">Comprobante</td>
+            </tr>{"".join(filas)}
+        </table>
+        <p><strong>Exceso total:</strong> ${total_exceso:,.2f}</p>
+
+        <p style="font-size: 12px; color: #999;">
+            Este mensaje fue generado autom&aacute;ticamente por Expoconsult Rendiciones.
+        </p>
+    </body>
+    </html>
+    """
+
+
 # ==========================================
 # ENVÍO DE MAIL
 # ==========================================
 
-def enviar_alerta_exceso(payload, ticket_url, gsheets_client, sheet_id):
-    """Envía mail de alerta de exceso a los autorizantes configurados.
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+INACTIVIDAD_CIERRE_SEG = 300  # cerrar la conexión SMTP tras 5 min sin uso
 
-    Args:
-        payload: dict con datos de la rendición.
-        ticket_url: URL del comprobante en Drive.
-        gsheets_client: gspread client para leer destinatarios.
-        sheet_id: ID del spreadsheet.
 
-    Returns:
-        (bool, str): (éxito, mensaje).
-    """
-    config = _get_smtp_config()
+class _ConexionSMTP:
+    """Una conexión SMTP_SSL autenticada, reusada entre envíos."""
 
-    if not config["user"] or not config["password"]:
-        msg = "SMTP no configurado (faltan credenciales en st.secrets[smtp])"
-        logger.warning(msg)
-        return False, msg
+    def __init__(self):
+        self._server = None
+        self._usuario = None
+        self.ultimo_uso = 0.0
 
-    destinatarios = leer_destinatarios(gsheets_client, sheet_id)
-    if not destinatarios:
-        msg = "No hay destinatarios activos en CONFIG_NOTIFICACIONES"
-        logger.warning(msg)
-        return False, msg
+    def obtener(self, config):
+        if self._server is not None and self._usuario == config["user"]:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.cerrar()
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30)
+        server.login(config["user"], config["password"])
+        self._server, self._usuario = server, config["user"]
+        logger.info("Conexión SMTP abierta")
+        return server
 
-    emails_to = [d["email"] for d in destinatarios]
-    operador = payload.get("usuario", "---")
-    monto = float(payload.get("monto_a_imputar", 0) or 0)
+    def cerrar(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+        self._server = None
 
-    subject = f"[REVISION] Rendicion excede monto sugerido — {operador} — ${monto:,.2f}"
-    html_body = _generar_html_exceso(payload, ticket_url)
+    def cerrar_si_inactiva(self):
+        if self._server is not None and time.monotonic() - self.ultimo_uso > INACTIVIDAD_CIERRE_SEG:
+            self.cerrar()
+            logger.info("Conexión SMTP cerrada por inactividad")
 
+
+_conexion = _ConexionSMTP()
+
+
+def _enviar_mail(config, emails_to, subject, html_body, conexion=None):
+    """Envía (o loguea en dry_run) un mail HTML.
+
+    Args:
+        conexion: _ConexionSMTP a reusar; None abre y cierra una conexión propia.
+
+    Returns:
+        (bool, str): (éxito, mensaje).
+    """
     # DRY RUN: log to stdout instead of sending
     if config["dry_run"]:
         logger.info("=" * 60)
@@ -268,13 +355,222 @@ def enviar_alerta_exceso(payload, ticket_url, gsheets_client, sheet_id):
         msg["To"] = ", ".join(emails_to)
         msg.attach(MIMEText(html_body, "html"))
 
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(config["user"], config["password"])
-            server.sendmail(config["user"], emails_to, msg.as_string())
+        if conexion is None:
+            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT) as server:
+                server.login(config["user"], config["password"])
+                server.sendmail(config["user"], emails_to, msg.as_string())
+        else:
+            conexion.obtener(config).sendmail(config["user"], emails_to, msg.as_string())
+            conexion.ultimo_uso = time.monotonic()
 
         logger.info(f"Mail enviado a {len(emails_to)} destinatarios: {emails_to}")
         return True, f"Mail enviado a {len(emails_to)} destinatarios"
 
     except Exception as e:
+        if conexion is not None:
+            conexion.cerrar()
         logger.error(f"Error enviando mail SMTP: {e}")
         return False, str(e)
+
+
+def _preparar_envio(gsheets_client, sheet_id):
+    """Config SMTP + destinatarios. Returns (config, emails_to, error)."""
+    config = _get_smtp_config()
+
+    if not config["user"] or not config["password"]:
+        msg = "SMTP no configurado (faltan credenciales en st.secrets[smtp])"
+        logger.warning(msg)
+        return config, [], msg
+
+    destinatarios = leer_destinatarios(gsheets_client, sheet_id)
+    if not destinatarios:
+        msg = "No hay destinatarios activos en CONFIG_NOTIFICACIONES"
+        logger.warning(msg)
+        return config, [], msg
+
+    return config, [d["email"] for d in destinatarios], ""
+
+
+def enviar_alerta_exceso(payload, ticket_url, gsheets_client, sheet_id):
+    """Envía mail de alerta de exceso a los autorizantes configurados.
+
+    Envío inmediato, con conexión propia. El guardado usa encolar_alerta_exceso.
+
+    Args:
+        payload: dict con datos de la rendición.
+        ticket_url: URL del comprobante en Drive.
+        gsheets_client: gspread client para leer destinatarios.
+        sheet_id: ID del spreadsheet.
+
+    Returns:
+        (bool, str): (éxito, mensaje).
+    """
+    config, emails_to, error = _preparar_envio(gsheets_client, sheet_id)
+    if error:
+        return False, error
+
+    operador = payload.get("usuario", "---")
+    monto = float(payload.get("monto_a_imputar", 0) or 0)
+    subject = f"[REVISION] Rendicion excede monto sugerido — {operador} — ${monto:,.2f}"
+    return _enviar_mail(config, emails_to, subject, _generar_html_exceso(payload, ticket_url))
+
+
+# ==========================================
+# OUTBOX (cola persistente + digest por rendición)
+# ==========================================
+
+# Una rendición se despacha cuando pasa este tiempo sin alertas nuevas...
+PERIODO_SILENCIO_SEG = 90
+# ...o cuando su alerta más vieja lleva esto esperando, lo que ocurra primero.
+ESPERA_MAXIMA_SEG = 600
+INTERVALO_ENVIO_SEG = 15
+MAX_INTENTOS_ENVIO = 5
+
+_ESQUEMA_OUTBOX = """
+CREATE TABLE IF NOT EXISTS outbox_notificaciones (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rendicion_id TEXT NOT NULL,
+    sheet_id TEXT,
+    payload TEXT NOT NULL,
+    ticket_url TEXT,
+    estado TEXT NOT NULL DEFAULT 'PENDIENTE',
+    intentos INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    creado TEXT,
+    creado_ts REAL,
+    enviado TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_estado ON outbox_notificaciones(estado, rendicion_id);
+"""
+
+_cliente_sheets = None  # último gspread client recibido, para leer destinatarios
+_hilo_envio = None
+_hilo_lock = threading.Lock()
+_envio_lock = threading.Lock()
+
+
+def _conn_outbox():
+    return almacen_local.conectar(_ESQUEMA_OUTBOX)
+
+
+def encolar_alerta_exceso(payload, ticket_url, gsheets_client, sheet_id):
+    """Encola la alerta de exceso en el outbox; el hilo de envío la despacha.
+
+    Mismos argumentos que enviar_alerta_exceso.
+
+    Returns:
+        (bool, str): (éxito, mensaje).
+    """
+    global _cliente_sheets
+    if gsheets_client is not None:
+        _cliente_sheets = gsheets_client
+    rendicion_id = str(payload.get("rendicion_id") or "") or f"SIN-RENDICION-{datetime.now():%Y%m%d%H%M%S%f}"
+    with _conn_outbox() as conn:
+        conn.execute(
+            "INSERT INTO outbox_notificaciones (rendicion_id, sheet_id, payload, ticket_url, creado, creado_ts) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (rendicion_id, sheet_id, a_json(payload), ticket_url or "", ahora(), time.time()),
+        )
+    iniciar_envio()
+    return True, "Alerta encolada para envío"
+
+
+def _obtener_cliente_sheets():
+    """Cliente para leer destinatarios; tras un reinicio se crea uno nuevo."""
+    global _cliente_sheets
+    if _cliente_sheets is None:
+        import data  # import diferido: data importa este módulo
+        _cliente_sheets, _ = data.get_gsheets_client()
+    return _cliente_sheets
+
+
+def _grupos_listos(forzar=False):
+    """Rendiciones con alertas pendientes listas para despachar."""
+    with _conn_outbox() as conn:
+        grupos = conn.execute(
+            "SELECT rendicion_id, MIN(creado_ts) AS primero, MAX(creado_ts) AS ultimo "
+            "FROM outbox_notificaciones WHERE estado = 'PENDIENTE' GROUP BY rendicion_id"
+        ).fetchall()
+    ahora_ts = time.time()
+    return [
+        g["rendicion_id"] for g in grupos
+        if forzar or ahora_ts - g["ultimo"] >= PERIODO_SILENCIO_SEG or ahora_ts - g["primero"] >= ESPERA_MAXIMA_SEG
+    ]
+
+
+def procesar_outbox(forzar=False):
+    """Despacha las rendiciones listas: un mail por rendición, una conexión SMTP.
+
+    Args:
+        forzar: ignora el período de silencio (ej: botón "enviar ahora").
+
+    Returns:
+        int: cantidad de mails enviados.
+    """
+    with _envio_lock:
+        enviados = 0
+        for rendicion_id in _grupos_listos(forzar):
+            with _conn_outbox() as conn:
+                filas = conn.execute(
+                    "SELECT * FROM outbox_notificaciones WHERE estado = 'PENDIENTE' AND rendicion_id = ? "
+                    "ORDER BY id", (rendicion_id,)
+                ).fetchall()
+            if not filas:
+                continue
+            ids = [f["id"] for f in filas]
+            items = [(de_json(f["payload"], {}), f["ticket_url"]) for f in filas]
+
+            config, emails_to, error = _preparar_envio(_obtener_cliente_sheets(), filas[0]["sheet_id"])
+            if not error:
+                payload = items[0][0]
+                operador = payload.get("usuario", "---")
+                if len(items) == 1:
+                    monto = float(payload.get("monto_a_imputar", 0) or 0)
+                    subject = f"[REVISION] Rendicion excede monto sugerido — {operador} — ${monto:,.2f}"
+                    html_body = _generar_html_exceso(payload, items[0][1])
+                else:
+                    monto = sum(float(p.get("monto_a_imputar", 0) or 0) for p, _ in items)
+                    subject = (f"[REVISION] {len(items)} comprobantes exceden monto sugerido — "
+                               f"{operador} — {rendicion_id} — ${monto:,.2f}")
+                    html_body = _generar_html_digest(items)
+                ok, error = _enviar_mail(config, emails_to, subject, html_body, conexion=_conexion)
+                if ok:
+                    error = ""
+
+            marcas = ", ".join("?" * len(ids))
+            with _conn_outbox() as conn:
+                if not error:
+                    conn.execute(f"UPDATE outbox_notificaciones SET estado = 'ENVIADO', enviado = ?, error = NULL "
+                                 f"WHERE id IN ({marcas})", [ahora(), *ids])
+                    enviados += 1
+                else:
+                    conn.execute(f"UPDATE outbox_notificaciones SET intentos = intentos + 1, error = ?, "
+                                 f"estado = CASE WHEN intentos + 1 >= ? THEN 'ERROR' ELSE 'PENDIENTE' END "
+                                 f"WHERE id IN ({marcas})", [error, MAX_INTENTOS_ENVIO, *ids])
+        _conexion.cerrar_si_inactiva()
+        return enviados
+
+
+def _bucle_envio():
+    while True:
+        try:
+            procesar_outbox()
+        except Exception as e:
+            logger.error(f"Error procesando outbox de notificaciones: {e}")
+        time.sleep(INTERVALO_ENVIO_SEG)
+
+
+def iniciar_envio():
+    """Arranca el hilo de envío del outbox (idempotente)."""
+    global _hilo_envio
+    with _hilo_lock:
+        if _hilo_envio is None or not _hilo_envio.is_alive():
+            _hilo_envio = threading.Thread(target=_bucle_envio, name="outbox-notificaciones", daemon=True)
+            _hilo_envio.start()
+
+
+def resumen_outbox():
+    """Cantidad de alertas por estado (para el panel de administración)."""
+    with _conn_outbox() as conn:
+        return {r["estado"]: r["n"] for r in conn.execute(
+            "SELECT estado, COUNT(*) AS n FROM outbox_notificaciones GROUP BY estado")}
@@ -0,0 +1,218 @@
+"""
+ocr_backends.py — Backends de extracción intercambiables para ocr_comprobantes.
+
+ocr_comprobantes arma prompts, schemas y failover; el backend solo ejecuta
+una llamada "modelo + partes + schema → JSON". Así el camino de OCR se puede
+correr sin API key (benchmarks, pruebas de carga, demos):
+
+  BackendGemini  → google.generativeai (producción). Opcionalmente graba
+                   cada respuesta como fixture para reproducirla después.
+  BackendReplay  → reproduce respuestas grabadas en un directorio de
+                   fixtures, con latencia configurable e inyección de errores.
+
+Selección por variables de entorno (o set_backend() desde código):
+  OCR_BACKEND=gemini|replay      (default gemini)
+  OCR_FIXTURES_DIR=fixtures/ocr  (replay: de dónde leer / gemini: dónde grabar
+                                  si OCR_GRABAR_FIXTURES=1)
+  OCR_REPLAY_LATENCIA_MS=800     (latencia simulada por llamada)
+  OCR_REPLAY_TASA_ERROR=0.1      (fracción de llamadas que fallan)
+  OCR_REPLAY_SEMILLA=0           (semilla de los errores, para que sea determinista)
+
+Formato de fixture: <sha256 de la imagen>.json con la respuesta de extracción
+del comprobante (mismo dict que devuelve el modelo).
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR_DEFAULT = os.path.join("fixtures", "ocr")
+
+
+def huella_archivo(file_bytes):
+    """Clave de fixture de un comprobante (sha256 del contenido)."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def _blobs(partes):
+    """Bytes de cada imagen/PDF incluido en las partes del request, en orden."""
+    return [p["data"] for p in partes if isinstance(p, dict) and "data" in p]
+
+
+class BackendOCR:
+    """Interfaz: una llamada de extracción en modo JSON estructurado."""
+
+    nombre = "base"
+
+    def generar(self, modelo, partes, schema):
+        """Ejecuta una llamada.
+
+        Args:
+            modelo: nombre del modelo (los backends locales lo ignoran).
+            partes: lista de textos y {"mime_type", "data"} como en generate_content.
+            schema: schema de respuesta (COMPROBANTE_SCHEMA, LOTE_SCHEMA, ...).
+
+        Returns:
+            (obj|None, str|None, usage): (JSON parseado, error, usage_metadata).
+            Un JSON inválido se señala levantando ValueError.
+        """
+        raise NotImplementedError
+
+
+# ==========================================
+# GEMINI
+# ==========================================
+
+class BackendGemini(BackendOCR):
+    nombre = "gemini"
+
+    def __init__(self, grabar_en=None):
+        self.grabar_en = grabar_en
+
+    def generar(self, modelo, partes, schema):
+        import google.generativeai as genai
+
+        response = genai.GenerativeModel(modelo).generate_content(
+            partes,
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=schema,
+                temperature=0,
+            ),
+        )
+        usage = getattr(response, "usage_metadata", None)
+        text = getattr(response, "text", None) if response else None
+        if not text:
+            if response and getattr(response, "candidates", None) and response.candidates[0].finish_reason:
+                return None, f"La IA bloqueó la respuesta (Razón: {response.candidates[0].finish_reason})", usage
+            return None, "Respuesta vacía", usage
+
+        raw = json.loads(text)
+        if self.grabar_en:
+            self._grabar(partes, schema, raw)
+        return raw, None, usage
+
+    def _grabar(self, partes, schema, raw):
+        """Guarda respuestas de extracción individuales como fixtures de replay."""
+        blobs = _blobs(partes)
+        if len(blobs) != 1 or schema.get("type") != "OBJECT" or "monto_total" not in schema.get("properties", {}):
+            return  # clasificación y lotes se derivan de la extracción al reproducir
+        try:
+            os.makedirs(self.grabar_en, exist_ok=True)
+            path = os.path.join(self.grabar_en, f"{huella_archivo(blobs[0])}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(raw, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logger.warning(f"No se pudo grabar fixture OCR: {e}")
+
+
+# ==========================================
+# REPLAY (local, determinista)
+# ==========================================
+
+class BackendReplay(BackendOCR):
+    """Reproduce respuestas grabadas. No hace I/O de red.
+
+    Una imagen sin fixture devuelve error (como un comprobante ilegible). Los
+    requests de clasificación y de lote se arman a partir del fixture de
+    extracción de cada imagen.
+    """
+
+    nombre = "replay"
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR_DEFAULT, latencia_ms=0, tasa_error=0.0, semilla=0):
+        self.fixtures_dir = fixtures_dir
+        self.latencia_ms = latencia_ms
+        self.tasa_error = tasa_error
+        self._rng = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self.llamadas = 0
+
+    def _fixture(self, file_bytes):
+        clave = huella_archivo(file_bytes)
+        if clave not in self._cache:
+            path = os.path.join(self.fixtures_dir, f"{clave}.json")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._cache[clave] = json.load(f)
+            except (OSError, ValueError):
+                self._cache[clave] = None
+        return self._cache[clave]
+
+    def _usage(self, partes, respuesta):
+        # Aproximación ~4 caracteres por token, para que los logs de etapa tengan números
+        chars_in = sum(len(p) for p in partes if isinstance(p, str))
+        return SimpleNamespace(
+            prompt_token_count=chars_in // 4 + 258 * len(_blobs(partes)),
+            candidates_token_count=len(json.dumps(respuesta or "")) // 4,
+        )
+
+    def generar(self, modelo, partes, schema):
+        with self._lock:
+            self.llamadas += 1
+            falla = self.tasa_error > 0 and self._rng.random() < self.tasa_error
+            tipo_falla = self._rng.choice(("excepcion", "json")) if falla else None
+        if self.latencia_ms:
+            time.sleep(self.latencia_ms / 1000.0)
+        if tipo_falla == "excepcion":
+            raise RuntimeError(f"Error inyectado (replay) en {modelo}")
+        if tipo_falla == "json":
+            raise ValueError("Error inyectado (replay): JSON inválido")
+
+        fixtures = [self._fixture(b) for b in _blobs(partes)]
+        props = schema.get("properties", {})
+
+        if schema.get("type") == "ARRAY":
+            respuesta = [dict(fx, indice=i) for i, fx in enumerate(fixtures) if fx]
+        elif not fixtures or fixtures[0] is None:
+            return None, "Respuesta vacía", self._usage(partes, None)
+        elif "letra" in props:
+            respuesta = {"letra": str(fixtures[0].get("tipo_factura") or "C").upper(),
+                         "layout": fixtures[0].get("layout", "OTRO")}
+        else:
+            respuesta = {k: v for k, v in fixtures[0].items() if k in props}
+        return respuesta, None, self._usage(partes, respuesta)
+
+
+# ==========================================
+# SELECCIÓN
+# ==========================================
+
+_backend = None
+
+
+def backend_desde_entorno():
+    """Construye el backend según OCR_BACKEND y variables asociadas."""
+    tipo = os.environ.get("OCR_BACKEND", "gemini").strip().lower()
+    fixtures_dir = os.environ.get("OCR_FIXTURES_DIR", FIXTURES_DIR_DEFAULT)
+    if tipo == "replay":
+        return BackendReplay(
+            fixtures_dir=fixtures_dir,
+            latencia_ms=float(os.environ.get("OCR_REPLAY_LATENCIA_MS", "0") or 0),
+            tasa_error=float(os.environ.get("OCR_REPLAY_TASA_ERROR", "0") or 0),
+            semilla=int(os.environ.get("OCR_REPLAY_SEMILLA", "0") or 0),
+        )
+    grabar = os.environ.get("OCR_GRABAR_FIXTURES", "").strip() in ("1", "true", "si")
+    return BackendGemini(grabar_en=fixtures_dir if grabar else None)
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = backend_desde_entorno()
+        logger.info(f"Backend OCR: {_backend.nombre}")
+    return _backend
+
+
+def set_backend(backend):
+    """Reemplaza el backend activo (benchmarks / pruebas). None = volver al de entorno."""
+    global _backend
+    _backend = backend
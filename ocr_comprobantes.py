@@ -0,0 +1,554 @@
+"""
+ocr_comprobantes.py — Extracción de comprobantes con Gemini (salida estructurada).
+
+El contrato de extracción se define UNA vez como schema (COMPROBANTE_SCHEMA)
+y se pide con el modo JSON estructurado del modelo (response_mime_type +
+response_schema). La respuesta se valida y se coerciona a ComprobanteEscaneado,
+así no hace falta recuperar el JSON con regex ni re-escanear por respuestas
+malformadas, y el prompt ya no necesita describir el formato de salida.
+
+Las imágenes se procesan en dos etapas: un modelo liviano clasifica letra y
+layout, y después se extrae con la plantilla corta de ese tipo
+(PLANTILLAS_EXTRACCION, versionadas). Cada etapa loguea tokens y latencia.
+
+La llamada al modelo pasa por ocr_backends (Gemini en producción, replay de
+fixtures para correr sin API key).
+
+Uso:  from ocr_comprobantes import escanear_comprobante
+"""
+
+import re
+import time
+import logging
+from dataclasses import dataclass, field, asdict
+
+import extraccion_pdf
+import ocr_backends
+
+logger = logging.getLogger(__name__)
+
+# Orden de failover entre modelos gratuitos de Gemini
+MODELOS_GEMINI = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.0-flash-lite"]
+
+# ==========================================
+# SCHEMA DE EXTRACCIÓN
+# ==========================================
+
+_NUMERO = {"type": "NUMBER"}
+_TEXTO_NULLABLE = {"type": "STRING", "nullable": True}
+_PERCEPCION = {
+    "type": "OBJECT",
+    "properties": {
+        "jurisdiccion": {"type": "STRING"},
+        "monto": _NUMERO,
+    },
+    "required": ["jurisdiccion", "monto"],
+}
+
+COMPROBANTE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "tipo_factura": {"type": "STRING", "enum": ["A", "B", "C", "M", "TICKET"]},
+        "codigo_afip": _TEXTO_NULLABLE,
+        "fecha": {"type": "STRING", "nullable": True, "description": "DD/MM/AAAA"},
+        "proveedor": _TEXTO_NULLABLE,
+        "cuit_proveedor": {"type": "STRING", "nullable": True, "description": "11 dígitos sin guiones"},
+        "cuit_cliente": {"type": "STRING", "nullable": True, "description": "11 dígitos sin guiones"},
+        "sucursal": {"type": "STRING", "nullable": True, "description": "punto de venta"},
+        "numero_comprobante": _TEXTO_NULLABLE,
+        "neto_gravado": _NUMERO,
+        "no_gravado": _NUMERO,
+        "exento": _NUMERO,
+        "iva_21": _NUMERO,
+        "iva_10_5": _NUMERO,
+        "iva_27": _NUMERO,
+        "perc_iva": _NUMERO,
+        "perc_ganancias": _NUMERO,
+        "perc_iibb_lista": {"type": "ARRAY", "items": _PERCEPCION},
+        "perc_municipal": dict(_PERCEPCION, nullable=True),
+        "monto_total": {"type": "NUMBER", "nullable": True},
+    },
+    "required": ["tipo_factura", "neto_gravado", "no_gravado", "exento", "iva_21",
+                 "iva_10_5", "iva_27", "perc_iva", "perc_ganancias",
+                 "perc_iibb_lista", "monto_total"],
+}
+
+# Schema reducido para B/C/TICKET: no se discriminan impuestos, así que el
+# modelo solo devuelve encabezado + total y no_gravado se completa localmente.
+COMPROBANTE_BC_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {k: COMPROBANTE_SCHEMA["properties"][k] for k in (
+        "tipo_factura", "codigo_afip", "fecha", "proveedor", "cuit_proveedor",
+        "cuit_cliente", "sucursal", "numero_comprobante", "monto_total")},
+    "required": ["tipo_factura", "monto_total"],
+}
+
+CLASIFICACION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "letra": {"type": "STRING", "enum": ["A", "B", "C", "M", "TICKET"]},
+        "layout": {"type": "STRING",
+                   "enum": ["FACTURA_ELECTRONICA", "TICKET_FISCAL", "COMBUSTIBLE", "MANUSCRITO", "OTRO"]},
+    },
+    "required": ["letra", "layout"],
+}
+
+# ==========================================
+# PROMPTS (solo reglas de negocio — el formato lo impone el schema)
+# ==========================================
+
+# Etapa 1: clasificación rápida (modelo liviano, respuesta de 2 campos)
+PROMPT_CLASIFICACION = """
+Clasificá este comprobante argentino. letra = letra de la factura (A, B, C, M) o TICKET si no tiene letra.
+layout = FACTURA_ELECTRONICA, TICKET_FISCAL (controlador fiscal), COMBUSTIBLE (estación de servicio), MANUSCRITO u OTRO.
+"""
+
+_REGLAS_ENCABEZADO = """
+CUITs: cuit_proveedor = el PRIMERO, en el encabezado (emisor). cuit_cliente = el del receptor, más abajo; en Factura B suele no estar (null).
+Básicos: tipo_factura = letra (A, B, C, M) o TICKET. codigo_afip = "COD. XX" a 3 dígitos. sucursal = punto de venta (en XXXXX-YYYYYYYY es XXXXX; en combustibles NO es "Nro. Estación").
+"""
+
+_REGLAS_LEGIBILIDAD = """
+Si algo es ilegible, borroso o cortado (sobre todo CUITs y montos), devolvé null: no adivines.
+"""
+
+_REGLAS_DESGLOSE_A = """
+Desglosá cada centavo. neto_gravado = base imponible. no_gravado = impuestos internos, combustibles, fondo hídrico, cargos que no son IVA ni percepción. exento si se discrimina. IVA por alícuota. La percepción municipal NO va en no_gravado.
+
+Percepciones, una línea por vez (NO sumes líneas distintas):
+- "PERC IVA", "PER IVA", "RG 2408", "R.G. 2408" → perc_iva.
+- "PER IB", "PERC IIBB", "Per IIBB", "ING BRUTOS" → una entrada de perc_iibb_lista por línea. Jurisdicción según esta tabla (si no coincide, texto literal en mayúsculas):
+__TABLA_JURISDICCIONES__
+- "Per Mun", "PERC MUN", "MUNICIPAL" → perc_municipal (si hay varias, sumá montos con la jurisdicción de la primera).
+- "PERC GCIAS", "PER GAN", "RG 830" → perc_ganancias.
+- Ignorá descuentos y líneas negativas. En "PERC X.XX% [BASE] MONTO" el monto es el último número.
+
+Antes de responder verificá que la suma de componentes sea igual a monto_total (±1).
+"""
+
+# Etapa 2: plantillas de extracción por tipo. Cambiar el texto de una
+# plantilla => subir su versión (queda en el log de cada escaneo).
+PLANTILLAS_EXTRACCION = {
+    "A": {
+        "version": "A-v1",
+        "schema": COMPROBANTE_SCHEMA,
+        "texto": ("Sos auditor contable experto en AFIP. Extraé los datos de esta factura A/M."
+                  + _REGLAS_ENCABEZADO + _REGLAS_DESGLOSE_A + _REGLAS_LEGIBILIDAD),
+    },
+    "BC": {
+        "version": "BC-v1",
+        "schema": COMPROBANTE_BC_SCHEMA,
+        "texto": ("Extraé el encabezado y el total de este comprobante B, C o ticket (no discrimina impuestos)."
+                  + _REGLAS_ENCABEZADO + "monto_total = total final pagado.\n" + _REGLAS_LEGIBILIDAD),
+    },
+    # Fallback cuando la clasificación falla: prompt completo en una sola etapa
+    "GENERAL": {
+        "version": "GENERAL-v1",
+        "schema": COMPROBANTE_SCHEMA,
+        "texto": ("Sos auditor contable experto en AFIP (Argentina). Extraé los datos del comprobante."
+                  + _REGLAS_ENCABEZADO + "\nFactura A o M:" + _REGLAS_DESGLOSE_A
+                  + "\nFactura B, C o TICKET: NO discrimines impuestos. Todo el total va a no_gravado; el resto en 0.\n"
+                  + _REGLAS_LEGIBILIDAD),
+    },
+}
+
+
+def plantilla_para(letra):
+    """Letra clasificada → clave de PLANTILLAS_EXTRACCION."""
+    letra = str(letra or "").strip().upper()
+    if letra in ("A", "M"):
+        return "A"
+    if letra in ("B", "C", "TICKET"):
+        return "BC"
+    return "GENERAL"
+
+
+def construir_prompt(plantilla="GENERAL"):
+    """Texto de la plantilla con la tabla de jurisdicciones compartida."""
+    return PLANTILLAS_EXTRACCION[plantilla]["texto"].replace(
+        "__TABLA_JURISDICCIONES__", extraccion_pdf.tabla_jurisdicciones_prompt(indent="  ")
+    )
+
+
+# ==========================================
+# RESULTADO TIPADO
+# ==========================================
+
+def _a_float(value, default=0.0):
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    parsed = extraccion_pdf.parse_importe(value)
+    return parsed if parsed is not None else default
+
+
+def _solo_digitos(value):
+    return re.sub(r"\D", "", str(value)) if value not in (None, "") else ""
+
+
+def _coercionar_percepcion(raw):
+    if not isinstance(raw, dict):
+        return None
+    monto = _a_float(raw.get("monto"))
+    if monto <= 0:
+        return None
+    juris = str(raw.get("jurisdiccion") or "").strip().upper()
+    return {"jurisdiccion": extraccion_pdf.JURISDICCION_ALIAS.get(juris.replace(" ", ""), juris),
+            "monto": monto}
+
+
+@dataclass
+class ComprobanteEscaneado:
+    """Resultado validado de un escaneo. a_dict() da el formato de scan_receipt."""
+    tipo_factura: str = "C"
+    codigo_afip: str = None
+    fecha: str = None
+    proveedor: str = None
+    cuit_proveedor: str = None
+    cuit_cliente: str = None
+    sucursal: str = None
+    numero_comprobante: str = None
+    neto_gravado: float = 0.0
+    no_gravado: float = 0.0
+    exento: float = 0.0
+    iva_21: float = 0.0
+    iva_10_5: float = 0.0
+    iva_27: float = 0.0
+    perc_iva: float = 0.0
+    perc_ganancias: float = 0.0
+    perc_iibb_lista: list = field(default_factory=list)
+    perc_municipal: dict = None
+    monto_total: float = None
+    warning_total_no_cuadra: bool = False
+
+    @classmethod
+    def desde_dict(cls, raw):
+        """Valida y coerciona la respuesta del modelo.
+
+        Los campos inválidos quedan en None (el formulario pide carga manual)
+        en vez de hacer fallar todo el escaneo.
+        """
+        if not isinstance(raw, dict):
+            raise ValueError(f"Se esperaba un objeto JSON, llegó {type(raw).__name__}")
+
+        tipo = str(raw.get("tipo_factura") or "C").strip().upper()
+        if tipo not in ("A", "B", "C", "M", "TICKET"):
+            tipo = "C"
+
+        cuit_prov = _solo_digitos(raw.get("cuit_proveedor") or raw.get("cuit"))
+        cuit_cli = _solo_digitos(raw.get("cuit_cliente"))
+        suc = _solo_digitos(raw.get("sucursal"))
+        num = _solo_digitos(raw.get("numero_comprobante"))
+        afip = _solo_digitos(raw.get("codigo_afip"))
+
+        fecha = str(raw.get("fecha") or "").strip() or None
+        if fecha and not re.fullmatch(r"\d{2}/\d{2}/\d{4}", fecha):
+            fecha = None
+
+        total = raw.get("monto_total")
+        res = cls(
+            tipo_factura=tipo,
+            codigo_afip=afip.zfill(3) if afip else None,
+            fecha=fecha,
+            proveedor=str(raw.get("proveedor") or "").strip() or None,
+            cuit_proveedor=cuit_prov if len(cuit_prov) == 11 else None,
+            cuit_cliente=cuit_cli if len(cuit_cli) == 11 else None,
+            sucursal=suc.zfill(5) if suc and len(suc) <= 5 else None,
+            numero_comprobante=num.zfill(8) if num and len(num) <= 8 else None,
+            neto_gravado=_a_float(raw.get("neto_gravado")),
+            no_gravado=_a_float(raw.get("no_gravado")),
+            exento=_a_float(raw.get("exento")),
+            iva_21=_a_float(raw.get("iva_21")),
+            iva_10_5=_a_float(raw.get("iva_10_5")),
+            iva_27=_a_float(raw.get("iva_27")),
+            perc_iva=_a_float(raw.get("perc_iva")),
+            perc_ganancias=_a_float(raw.get("perc_ganancias")),
+            perc_iibb_lista=[p for p in (_coercionar_percepcion(x) for x in raw.get("perc_iibb_lista") or []) if p],
+            perc_municipal=_coercionar_percepcion(raw.get("perc_municipal")),
+            monto_total=_a_float(total, default=None),
+        )
+        # B/C/TICKET nunca discriminan: todo el total a no_gravado
+        if tipo in ("B", "C", "TICKET") and res.monto_total:
+            res.neto_gravado = res.exento = res.iva_21 = res.iva_10_5 = res.iva_27 = 0.0
+            res.perc_iva = res.perc_ganancias = 0.0
+            res.perc_iibb_lista = []
+            res.perc_municipal = None
+            res.no_gravado = res.monto_total
+        res.warning_total_no_cuadra = bool(raw.get("warning_total_no_cuadra")) or not res.suma_cuadra()
+        return res
+
+    def suma_componentes(self):
+        muni = self.perc_municipal["monto"] if self.perc_municipal else 0.0
+        return (self.neto_gravado + self.no_gravado + self.exento + self.iva_21
+                + self.iva_10_5 + self.iva_27 + self.perc_iva + self.perc_ganancias
+                + sum(p["monto"] for p in self.perc_iibb_lista) + muni)
+
+    def suma_cuadra(self, tolerancia=1.0):
+        if not self.monto_total:
+            return True  # Sin total no hay contra qué validar (el form lo marca)
+        return abs(self.suma_componentes() - self.monto_total) <= tolerancia
+
+    def a_dict(self):
+        """Dict con el mismo formato que devolvía scan_receipt."""
+        return asdict(self)
+
+
+# ==========================================
+# LLAMADA AL MODELO
+# ==========================================
+
+# Modelo rápido para la etapa de clasificación
+MODELOS_CLASIFICACION = ["gemini-2.0-flash-lite", "gemini-2.0-flash"]
+
+
+def _registrar_etapa(etapa, modelo, version, usage, t0):
+    """Loguea tokens y latencia de una etapa (clasificación / extracción)."""
+    latencia_ms = (time.perf_counter() - t0) * 1000
+    tokens_in = getattr(usage, "prompt_token_count", None)
+    tokens_out = getattr(usage, "candidates_token_count", None)
+    logger.info(
+        f"OCR etapa={etapa} plantilla={version} modelo={modelo} "
+        f"tokens_in={tokens_in} tokens_out={tokens_out} latencia_ms={latencia_ms:.0f}"
+    )
+    return {"etapa": etapa, "plantilla": version, "modelo": modelo,
+            "tokens_in": tokens_in, "tokens_out": tokens_out, "latencia_ms": round(latencia_ms)}
+
+
+def _generar(modelo, partes, schema=COMPROBANTE_SCHEMA):
+    """Una llamada en modo JSON vía el backend activo. Devuelve (obj, error_str, usage)."""
+    return ocr_backends.get_backend().generar(modelo, partes, schema)
+
+
+def _generar_con_failover(partes, schema, etapa, version, modelos, reintento=None,
+                          validar=None):
+    """Prueba cada modelo en orden (y un reintento con pausa si se indica).
+
+    Si se pasa `validar`, se aplica a cada respuesta dentro del loop: un
+    ValueError/TypeError (respuesta fuera de schema) pasa al siguiente modelo.
+
+    Returns:
+        (dict|None, str): (JSON parseado — o lo que devuelva `validar` —, último error).
+    """
+    last_error = ""
+    intentos = [(m, 0) for m in modelos] + ([(reintento, 2)] if reintento else [])
+    for modelo, pausa in intentos:
+        if pausa:
+            time.sleep(pausa)
+        t0 = time.perf_counter()
+        try:
+            raw, error, usage = _generar(modelo, partes, schema)
+            _registrar_etapa(etapa, modelo, version, usage, t0)
+            if error:
+                last_error = error
+                continue
+            if validar is not None:
+                raw = validar(raw)
+            return raw, ""
+        except (ValueError, TypeError) as ex:
+            # JSON inválido o fuera de schema: probar el siguiente modelo
+            last_error = f"Respuesta inválida de {modelo}: {ex}"
+            logger.warning(last_error)
+        except Exception as ex:
+            last_error = str(ex)
+    return None, last_error
+
+
+def clasificar_comprobante(image_bytes, mime_type="image/jpeg"):
+    """Etapa 1: devuelve {"letra", "layout"} o None si no se pudo clasificar."""
+    partes = [PROMPT_CLASIFICACION, {"mime_type": mime_type, "data": image_bytes}]
+    raw, error = _generar_con_failover(partes, CLASIFICACION_SCHEMA, "clasificacion",
+                                       "CLASIF-v1", MODELOS_CLASIFICACION)
+    if not isinstance(raw, dict) or not raw.get("letra"):
+        logger.info(f"Clasificación fallida ({error or 'sin letra'}) — se usa plantilla GENERAL")
+        return None
+    return {"letra": str(raw["letra"]).upper(), "layout": str(raw.get("layout") or "OTRO").upper()}
+
+
+def escanear_comprobante(image_bytes, mime_type="image/jpeg"):
+    """Extrae los datos de un comprobante.
+
+    PDFs digitales se parsean localmente (extraccion_pdf). El resto va a Gemini
+    en dos etapas: clasificación rápida de letra/layout y luego extracción con
+    la plantilla corta de ese tipo, en modo JSON estructurado con failover
+    entre MODELOS_GEMINI.
+
+    Returns:
+        dict en el formato de scan_receipt, o str con el mensaje de error.
+    """
+    if "pdf" in str(mime_type).lower():
+        local_result = extraccion_pdf.extraer_comprobante_pdf(image_bytes)
+        if local_result:
+            return local_result
+
+    clasificacion = clasificar_comprobante(image_bytes, mime_type)
+    clave = plantilla_para(clasificacion["letra"]) if clasificacion else "GENERAL"
+    plantilla = PLANTILLAS_EXTRACCION[clave]
+
+    def _validar(raw):
+        if not isinstance(raw, dict):
+            raise ValueError(f"Se esperaba un objeto JSON, llegó {type(raw).__name__}")
+        if clasificacion and not raw.get("tipo_factura"):
+            raw["tipo_factura"] = clasificacion["letra"]
+        return ComprobanteEscaneado.desde_dict(raw).a_dict()
+
+    partes = [construir_prompt(clave), {"mime_type": mime_type, "data": image_bytes}]
+    resultado, last_error = _generar_con_failover(partes, plantilla["schema"], "extraccion",
+                                                  plantilla["version"], MODELOS_GEMINI,
+                                                  reintento="gemini-2.5-flash", validar=_validar)
+    if resultado is not None:
+        return resultado
+
+    return f"Error al consultar la IA: {last_error if last_error else 'No se pudo extraer texto del comprobante'}"
+
+
+# ==========================================
+# LOTE (varios comprobantes en un solo request)
+# ==========================================
+
+# Por encima de esto la respuesta se vuelve larga y un error tira todo el lote
+MAX_LOTE = 8
+
+LOTE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(COMPROBANTE_SCHEMA["properties"],
+                           indice={"type": "INTEGER", "description": "número de comprobante recibido"}),
+        "required": ["indice"] + COMPROBANTE_SCHEMA["required"],
+    },
+}
+
+PROMPT_LOTE = """
+Vas a recibir {n} comprobantes, cada uno precedido por "COMPROBANTE <indice>".
+Devolvé un elemento por comprobante, con su indice, aplicando a cada uno las reglas de abajo
+de forma independiente (no mezcles datos entre comprobantes).
+"""
+
+
+def _escanear_sublote(archivos):
+    """Un request con hasta MAX_LOTE imágenes. Devuelve {indice_local: dict}."""
+    partes = [PROMPT_LOTE.format(n=len(archivos)) + construir_prompt("GENERAL")]
+    for i, (file_bytes, mime) in enumerate(archivos):
+        partes.append(f"COMPROBANTE {i}")
+        partes.append({"mime_type": mime, "data": file_bytes})
+
+    raw, error = _generar_con_failover(partes, LOTE_SCHEMA, "lote",
+                                       PLANTILLAS_EXTRACCION["GENERAL"]["version"], MODELOS_GEMINI)
+    if not isinstance(raw, list):
+        logger.warning(f"Lote sin respuesta utilizable ({error}) — se escanea de a uno")
+        return {}
+
+    resultados = {}
+    for item in raw:
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.get("indice"))
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= idx < len(archivos) or idx in resultados:
+            continue  # índice inventado o repetido: ese archivo se re-escanea solo
+        try:
+            resultados[idx] = ComprobanteEscaneado.desde_dict(item).a_dict()
+        except (ValueError, TypeError) as ex:
+            logger.warning(f"Lote: comprobante {idx} fuera de schema: {ex}")
+    return resultados
+
+
+def escanear_lote(archivos):
+    """Escanea varios comprobantes con las instrucciones enviadas una sola vez.
+
+    Los PDFs digitales se resuelven localmente; las imágenes restantes se
+    agrupan de a MAX_LOTE por request. Los resultados vuelven mapeados por
+    índice y cualquier archivo sin resultado válido (faltante, índice
+    repetido, fuera de schema) se re-escanea individualmente.
+
+    Args:
+        archivos: lista de (bytes, mime_type).
+
+    Returns:
+        list: un resultado por archivo, en el mismo orden, con el formato de
+        escanear_comprobante (dict o str de error).
+    """
+    resultados = [None] * len(archivos)
+    pendientes = []
+    for i, (file_bytes, mime) in enumerate(archivos):
+        if "pdf" in str(mime).lower():
+            local_result = extraccion_pdf.extraer_comprobante_pdf(file_bytes)
+            if local_result:
+                resultados[i] = local_result
+                continue
+        pendientes.append(i)
+
+    for inicio in range(0, len(pendientes), MAX_LOTE):
+        bloque = pendientes[inicio:inicio + MAX_LOTE]
+        if len(bloque) == 1:
+            continue  # un solo archivo: el camino individual ya es óptimo
+        parciales = _escanear_sublote([archivos[i] for i in bloque])
+        for local_idx, res in parciales.items():
+            resultados[bloque[local_idx]] = res
+
+    for i, res in enumerate(resultados):
+        if res is None:
+            resultados[i] = escanear_comprobante(*archivos[i])
+
+    logger.info(f"Lote OCR: {len(archivos)} archivos, {len(archivos) - len(pendientes)} PDFs locales")
+    return resultados
+
+
+# ==========================================
+# MAPEO A FORMULARIO
+# ==========================================
+
+def campos_formulario(scan_result):
+    """Resultado de escaneo → valores iniciales de los inputs del formulario.
+
+    Las claves son las keys de session_state de app.py (scan_*_input).
+    """
+    tipo = str(scan_result.get("tipo_factura") or "C").upper().strip()
+    if tipo not in ["A", "B", "C", "M", "Ticket"]:
+        tipo = "C"
+    return {
+        "scan_suc_input": str(scan_result.get("sucursal") or "").replace("-", ""),
+        "scan_num_input": str(scan_result.get("numero_comprobante") or "").replace("-", ""),
+        "scan_tipo_input": tipo,
+        "scan_cuit_input": str(scan_result.get("cuit_proveedor") or scan_result.get("cuit") or ""),
+        "scan_cuit_cliente_input": str(scan_result.get("cuit_cliente") or ""),
+        "scan_provider_input": str(scan_result.get("proveedor") or ""),
+    }
+
+
+def desglose_formulario(data_ia):
+    """Resultado de escaneo → desglose por columna del log (formato legacy del form).
+
+    Acepta el formato plano actual y el legacy con "desglose" anidado.
+
+    Returns:
+        (dict, list, dict, float, float): (desglose, perc_iibb_lista,
+        perc_municipal, monto_neto, monto_total).
+    """
+    monto_total = float(data_ia.get("monto_total") or data_ia.get("monto_total_columna_Z") or 0.0)
+    monto_neto = float(data_ia.get("neto_gravado") or 0.0)
+    if "neto_gravado" in data_ia and "desglose" not in data_ia:
+        iibb_lista = data_ia.get("perc_iibb_lista") or []
+        perc_muni = data_ia.get("perc_municipal") or {}
+        desglose = {
+            "neto_gravado_aux": monto_neto,
+            "columna_R_no_gravado": float(data_ia.get("no_gravado") or 0),
+            "columna_S_iva_21": float(data_ia.get("iva_21") or 0),
+            "columna_T_iva_105": float(data_ia.get("iva_10_5") or 0),
+            "columna_U_iva_27": float(data_ia.get("iva_27") or 0),
+            "columna_V_perc_iva": float(data_ia.get("perc_iva") or 0),
+            "columna_W_perc_ganancias": float(data_ia.get("perc_ganancias") or 0),
+            "columna_X_perc_iibb": float(iibb_lista[0]["monto"]) if iibb_lista else 0,
+            "columna_Y_jurisdiccion_code": iibb_lista[0].get("jurisdiccion", "") if iibb_lista else "",
+            "monto_total_columna_Z": monto_total,
+        }
+        return desglose, iibb_lista, perc_muni, monto_neto, monto_total
+
+    desglose = data_ia.get("desglose", {})
+    return desglose, [], {}, float(desglose.get("neto_gravado_aux") or 0.0), monto_total
+
@@ -0,0 +1,263 @@
+"""
+preproceso_comprobante.py — Normalización de comprobantes antes de OCR y Drive.
+
+Las fotos de celular y de st.camera_input llegan a resolución completa
+(3-8 MB). Esta etapa las deja en un tamaño apto para OCR antes de mandarlas
+a Gemini y a upload_receipt_to_drive:
+
+  Imágenes: rotación EXIF → recorte al documento → downscale → JPEG optimizado.
+  PDFs:     se descartan páginas en blanco y las copias DUPLICADO/TRIPLICADO.
+            El PDF recortado es solo para OCR: a Drive se sube el original.
+
+Devuelve el archivo más chico entre el original y el procesado (salvo una
+foto rotada por EXIF, que va siempre procesada), y un dict con el detalle de
+bytes ahorrados.
+
+Uso:  from preproceso_comprobante import normalizar_comprobante
+"""
+
+import io
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Lado mayor en px. ~1600 px sobre un ticket de 8 cm equivale a ~500 dpi,
+# sobrado para OCR; una A4 queda en ~190 dpi.
+MAX_LADO_OCR = 1600
+CALIDAD_JPEG = 80
+
+# El recorte solo se aplica si el documento ocupa al menos esta fracción
+# de la foto (evita recortes absurdos sobre fotos sin fondo distinguible).
+MIN_FRACCION_DOCUMENTO = 0.25
+UMBRAL_FONDO = 40  # diferencia de gris contra el color del borde
+
+
+def _info_base(file_bytes, mime_type):
+    return {
+        "mime_original": mime_type,
+        "bytes_originales": len(file_bytes),
+        "bytes_finales": len(file_bytes),
+        "bytes_ahorrados": 0,
+        "paginas_originales": None,
+        "paginas_enviadas": None,
+        "acciones": [],
+    }
+
+
+# ==========================================
+# IMÁGENES
+# ==========================================
+
+def _recortar_documento(img):
+    """Recorta la foto al rectángulo del documento.
+
+    Toma como fondo el color medio del borde de la foto y recorta al bbox de
+    lo que difiere de ese fondo. Devuelve (imagen, recortada: bool).
+    """
+    from PIL import ImageChops, ImageFilter, ImageStat
+
+    gris = img.convert("L")
+    w, h = gris.size
+    borde = max(2, min(w, h) // 50)
+    franjas = [gris.crop((0, 0, w, borde)), gris.crop((0, h - borde, w, h)),
+               gris.crop((0, 0, borde, h)), gris.crop((w - borde, 0, w, h))]
+    fondo = int(sum(ImageStat.Stat(f).median[0] for f in franjas) / len(franjas))
+
+    diff = ImageChops.difference(gris, gris.point(lambda _: fondo))
+    # Suavizar para que el ruido del sensor no extienda el bbox
+    mascara = diff.filter(ImageFilter.MedianFilter(5)).point(lambda p: 255 if p > UMBRAL_FONDO else 0)
+    bbox = mascara.getbbox()
+    if not bbox:
+        return img, False
+
+    x0, y0, x1, y1 = bbox
+    area = (x1 - x0) * (y1 - y0)
+    if area < MIN_FRACCION_DOCUMENTO * w * h or area > 0.97 * w * h:
+        return img, False
+
+    margen = borde
+    bbox = (max(0, x0 - margen), max(0, y0 - margen), min(w, x1 + margen), min(h, y1 + margen))
+    return img.crop(bbox), True
+
+
+def normalizar_imagen(file_bytes, mime_type="image/jpeg", max_lado=MAX_LADO_OCR,
+                      calidad=CALIDAD_JPEG):
+    """Aplica rotación EXIF, recorte, downscale y re-encode JPEG.
+
+    Returns:
+        (bytes, str, dict): (archivo, mime, info). Si Pillow no está instalado
+        o falla, devuelve el original sin tocar.
+    """
+    info = _info_base(file_bytes, mime_type)
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.info("Pillow no instalado — normalización de imágenes deshabilitada")
+        return file_bytes, mime_type, info
+
+    try:
+        img = Image.open(io.BytesIO(file_bytes))
+        # exif_transpose devuelve siempre una imagen nueva: la rotación se
+        # decide por el tag Orientation (0x0112), 1 = sin rotar
+        rotada = img.getexif().get(0x0112, 1) != 1
+        if rotada:
+            info["acciones"].append("rotación EXIF")
+        img = ImageOps.exif_transpose(img)
+
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        img, recortada = _recortar_documento(img)
+        if recortada:
+            info["acciones"].append(f"recorte {img.size[0]}x{img.size[1]}")
+
+        if max(img.size) > max_lado:
+            img.thumbnail((max_lado, max_lado), Image.LANCZOS)
+            info["acciones"].append(f"resize {img.size[0]}x{img.size[1]}")
+
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=calidad, optimize=True, progressive=True)
+        nuevo = out.getvalue()
+    except Exception as e:
+        logger.warning(f"No se pudo normalizar la imagen: {e}")
+        return file_bytes, mime_type, info
+
+    # Si la versión procesada no es más chica (ej: PNG ya liviano), quedarse
+    # con el original; no si hubo rotación: el original llega de costado al OCR
+    if len(nuevo) >= len(file_bytes) and not rotada:
+        info["acciones"] = []
+        return file_bytes, mime_type, info
+
+    info["bytes_finales"] = len(nuevo)
+    info["bytes_ahorrados"] = max(0, len(file_bytes) - len(nuevo))
+    return nuevo, "image/jpeg", info
+
+
+# ==========================================
+# PDFs
+# ==========================================
+
+_RE_COPIA = re.compile(r"\b(ORIGINAL|DUPLICADO|TRIPLICADO|CUADRUPLICADO)\b", re.IGNORECASE)
+
+
+def _firma_pagina(texto):
+    """Texto de la página sin la marca ORIGINAL/DUPLICADO ni espacios."""
+    return re.sub(r"\s+", "", _RE_COPIA.sub("", texto or ""))
+
+
+def _pagina_vacia(page, texto):
+    """Una página sin texto y sin imágenes no aporta nada al OCR."""
+    if (texto or "").strip():
+        return False
+    try:
+        recursos = page.get("/Resources") or {}
+        xobjects = recursos.get("/XObject") or {}
+        if len(xobjects) > 0:
+            return False
+    except Exception:
+        return False
+    return True
+
+
+def normalizar_pdf(file_bytes):
+    """Deja solo las páginas del PDF que importan.
+
+    Descarta páginas vacías y copias (DUPLICADO/TRIPLICADO con el mismo texto
+    que una página ya incluida). No hay tope de páginas: una factura de varias
+    hojas llega completa al OCR.
+
+    Returns:
+        (bytes, str, dict): (archivo, "application/pdf", info).
+    """
+    mime = "application/pdf"
+    info = _info_base(file_bytes, mime)
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        logger.info("pypdf no instalado — normalización de PDFs deshabilitada")
+        return file_bytes, mime, info
+
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+        total = len(reader.pages)
+        info["paginas_originales"] = total
+        info["paginas_enviadas"] = total
+        if total <= 1:
+            return file_bytes, mime, info
+
+        firmas = set()
+        elegidas = []
+        for idx, page in enumerate(reader.pages):
+            texto = page.extract_text() or ""
+            if _pagina_vacia(page, texto):
+                continue
+            firma = _firma_pagina(texto)
+            if firma and firma in firmas:
+                continue  # DUPLICADO / TRIPLICADO de una página ya elegida
+            firmas.add(firma)
+            elegidas.append(idx)
+
+        if not elegidas:
+            elegidas = [0]
+        if len(elegidas) == total:
+            return file_bytes, mime, info
+
+        writer = PdfWriter()
+        for idx in elegidas:
+            writer.add_page(reader.pages[idx])
+        for page in writer.pages:
+            try:
+                page.compress_content_streams()
+            except Exception:
+                pass
+        out = io.BytesIO()
+        writer.write(out)
+        nuevo = out.getvalue()
+    except Exception as e:
+        logger.warning(f"No se pudo normalizar el PDF: {e}")
+        return file_bytes, mime, info
+
+    info["paginas_enviadas"] = len(elegidas)
+    info["acciones"].append(f"páginas {len(elegidas)}/{total}")
+    if len(nuevo) >= len(file_bytes):
+        return file_bytes, mime, info
+
+    info["bytes_finales"] = len(nuevo)
+    info["bytes_ahorrados"] = len(file_bytes) - len(nuevo)
+    return nuevo, mime, info
+
+
+# ==========================================
+# ENTRADA ÚNICA
+# ==========================================
+
+def normalizar_comprobante(file_bytes, mime_type="image/jpeg"):
+    """Normaliza un comprobante (imagen o PDF) antes de OCR y subida a Drive.
+
+    Args:
+        file_bytes: contenido original del archivo.
+        mime_type: MIME informado por st.file_uploader / st.camera_input.
+
+    Returns:
+        (bytes, str, dict): (archivo normalizado, mime, info). info incluye
+        bytes_originales, bytes_finales, bytes_ahorrados, paginas_* y acciones.
+    """
+    if not file_bytes:
+        return file_bytes, mime_type, _info_base(b"", mime_type)
+
+    if "pdf" in str(mime_type).lower():
+        resultado = normalizar_pdf(file_bytes)
+    elif str(mime_type).lower().startswith("image/"):
+        resultado = normalizar_imagen(file_bytes, mime_type)
+    else:
+        return file_bytes, mime_type, _info_base(file_bytes, mime_type)
+
+    info = resultado[2]
+    if info["bytes_ahorrados"] > 0:
+        pct = info["bytes_ahorrados"] / info["bytes_originales"] * 100
+        logger.info(
+            f"Comprobante normalizado: {info['bytes_originales'] / 1024:,.0f} KB → "
+            f"{info['bytes_finales'] / 1024:,.0f} KB (-{pct:.0f}%) [{', '.join(info['acciones'])}]"
+        )
+    return resultado
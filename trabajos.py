@@ -0,0 +1,234 @@
+"""
+trabajos.py — Cola de trabajos durable con pool de workers.
+
+Cada trabajo queda registrado en SQLite (almacen_local) antes de ejecutarse,
+con sus datos, el archivo adjunto y los pasos ya completados. Si un paso
+falla, el trabajo se reintenta automáticamente con backoff; agotados los
+reintentos queda en ERROR y se puede relanzar con reintentar(), que retoma
+desde el primer paso no completado. Al arrancar el proceso se reanudan los
+trabajos que quedaron a medio hacer.
+
+Uso:
+    @trabajos.registrar("mi_tipo")
+    def ejecutar(datos, archivo, paso): ...
+
+    trabajo_id = trabajos.encolar("mi_tipo", datos, archivo)
+    trabajos.obtener(trabajo_id)["estado"]
+
+`paso(nombre, funcion)` ejecuta la función solo si ese paso no se completó en
+un intento anterior, y persiste su resultado.
+"""
+
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import almacen_local
+from almacen_local import a_json, de_json, ahora
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 2
+MAX_INTENTOS_AUTO = 3
+BACKOFF_SEGUNDOS = [2, 10, 30]
+
+PENDIENTE = "PENDIENTE"
+EN_CURSO = "EN CURSO"
+OK = "OK"
+ERROR = "ERROR"
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    estado TEXT NOT NULL,
+    datos TEXT,
+    archivo BLOB,
+    pasos TEXT,
+    resultado TEXT,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    creado TEXT,
+    actualizado TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos(estado);
+"""
+
+_HANDLERS = {}
+_executor = None
+_executor_lock = threading.Lock()
+_en_ejecucion = set()  # IDs tomados por un worker de este proceso
+
+
+def registrar(tipo):
+    """Decorador: asocia una función ejecutora a un tipo de trabajo."""
+    def deco(funcion):
+        _HANDLERS[tipo] = funcion
+        return funcion
+    return deco
+
+
+def _conn():
+    return almacen_local.conectar(_ESQUEMA)
+
+
+def _fila_a_dict(row, con_archivo=False):
+    if row is None:
+        return None
+    d = {
+        "id": row["id"], "tipo": row["tipo"], "estado": row["estado"],
+        "datos": de_json(row["datos"], {}), "pasos": de_json(row["pasos"], {}),
+        "resultado": de_json(row["resultado"]), "intentos": row["intentos"],
+        "error": row["error"] or "", "creado": row["creado"], "actualizado": row["actualizado"],
+    }
+    if con_archivo:
+        d["archivo"] = row["archivo"]
+    return d
+
+
+def _actualizar(trabajo_id, **campos):
+    campos["actualizado"] = ahora()
+    sets = ", ".join(f"{k} = ?" for k in campos)
+    with _conn() as conn:
+        conn.execute(f"UPDATE trabajos SET {sets} WHERE id = ?", [*campos.values(), trabajo_id])
+
+
+# ==========================================
+# POOL
+# ==========================================
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="trabajo")
+            # Primer uso en este proceso: retomar lo que quedó colgado por un reinicio
+            with _conn() as conn:
+                colgados = [r["id"] for r in conn.execute(
+                    "SELECT id FROM trabajos WHERE estado IN (?, ?) ORDER BY creado", (PENDIENTE, EN_CURSO))]
+            for trabajo_id in colgados:
+                logger.info(f"Reanudando trabajo {trabajo_id}")
+                _executor.submit(_ejecutar, trabajo_id)
+    return _executor
+
+
+def _ejecutar(trabajo_id):
+    with _executor_lock:
+        if trabajo_id in _en_ejecucion:
+            return
+        _en_ejecucion.add(trabajo_id)
+    try:
+        _ejecutar_trabajo(trabajo_id)
+    finally:
+        with _executor_lock:
+            _en_ejecucion.discard(trabajo_id)
+
+
+def _ejecutar_trabajo(trabajo_id):
+    with _conn() as conn:
+        row = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+    trabajo = _fila_a_dict(row, con_archivo=True)
+    if not trabajo or trabajo["estado"] == OK:
+        return
+
+    handler = _HANDLERS.get(trabajo["tipo"])
+    if handler is None:
+        _actualizar(trabajo_id, estado=ERROR, error=f"Tipo de trabajo desconocido: {trabajo['tipo']}")
+        return
+
+    intentos = trabajo["intentos"] + 1
+    _actualizar(trabajo_id, estado=EN_CURSO, intentos=intentos, error="")
+    pasos = trabajo["pasos"]
+
+    def paso(nombre, funcion):
+        if nombre in pasos:
+            return pasos[nombre]
+        resultado = funcion()
+        pasos[nombre] = resultado
+        _actualizar(trabajo_id, pasos=a_json(pasos))
+        return resultado
+
+    try:
+        resultado = handler(trabajo["datos"], trabajo.get("archivo"), paso)
+    except Exception as e:
+        logger.error(f"Trabajo {trabajo_id} falló (intento {intentos}): {e}")
+        if intentos < MAX_INTENTOS_AUTO:
+            _actualizar(trabajo_id, estado=PENDIENTE, error=str(e))
+            espera = BACKOFF_SEGUNDOS[min(intentos - 1, len(BACKOFF_SEGUNDOS) - 1)]
+            timer = threading.Timer(espera, lambda: _get_executor().submit(_ejecutar, trabajo_id))
+            timer.daemon = True
+            timer.start()
+        else:
+            _actualizar(trabajo_id, estado=ERROR, error=str(e))
+        return
+
+    # El archivo ya no hace falta una vez terminado
+    _actualizar(trabajo_id, estado=OK, resultado=a_json(resultado), archivo=None)
+    logger.info(f"Trabajo {trabajo_id} completado ({trabajo['tipo']}, intento {intentos})")
+
+
+# ==========================================
+# API
+# ==========================================
+
+def iniciar():
+    """Levanta el pool y reanuda trabajos pendientes (idempotente)."""
+    _get_executor()
+
+
+def encolar(tipo, datos, archivo=None):
+    """Registra el trabajo y lo manda al pool. Devuelve el ID de inmediato."""
+    if tipo not in _HANDLERS:
+        raise ValueError(f"Tipo de trabajo no registrado: {tipo}")
+    executor = _get_executor()
+    trabajo_id = f"T-{uuid.uuid4().hex[:10].upper()}"
+    with _conn() as conn:
+        conn.execute(
+            "INSERT INTO trabajos (id, tipo, estado, datos, archivo, pasos, intentos, creado, actualizado) "
+            "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+            (trabajo_id, tipo, PENDIENTE, a_json(datos), archivo, a_json({}), ahora(), ahora()),
+        )
+    executor.submit(_ejecutar, trabajo_id)
+    return trabajo_id
+
+
+def obtener(trabajo_id):
+    """Estado actual del trabajo (sin el archivo adjunto) o None."""
+    with _conn() as conn:
+        row = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+    return _fila_a_dict(row)
+
+
+def listar(estados=None, limite=50):
+    """Trabajos más recientes, opcionalmente filtrados por estado."""
+    query = "SELECT * FROM trabajos"
+    params = []
+    if estados:
+        query += f" WHERE estado IN ({', '.join('?' * len(estados))})"
+        params = list(estados)
+    query += " ORDER BY creado DESC LIMIT ?"
+    with _conn() as conn:
+        return [_fila_a_dict(r) for r in conn.execute(query, [*params, limite])]
+
+
+def reintentar(trabajo_id):
+    """Relanza un trabajo en ERROR desde el primer paso pendiente."""
+    trabajo = obtener(trabajo_id)
+    if not trabajo or trabajo["estado"] != ERROR:
+        return False
+    _actualizar(trabajo_id, estado=PENDIENTE, intentos=0, error="")
+    _get_executor().submit(_ejecutar, trabajo_id)
+    return True
+
+
+def esperar(trabajo_id, timeout=30.0, intervalo=0.2):
+    """Bloquea hasta que el trabajo termine (OK/ERROR) o venza el timeout."""
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        trabajo = obtener(trabajo_id)
+        if trabajo and trabajo["estado"] in (OK, ERROR):
+            return trabajo
+        time.sleep(intervalo)
+    return obtener(trabajo_id)